@@ -0,0 +1,75 @@
+"""
+Micro-benchmark the "eager" and "sdpa" attention backends of S3Gen across sequence lengths.
+
+Times one conformer encoder attention layer (RelPositionMultiHeadedAttention, 512 channels, 8 heads) and one CFM
+decoder attention layer (BasicTransformerBlock.attn1, 8 x 64 heads, CFG-doubled batch) with random weights, and
+reports the largest difference between the two backends. A 20 s chunk is 500 speech tokens and 1000 mel frames
+before the prompt is added. Runs on CPU by default; from the repository root:
+
+    python benchmarks/bench_attention.py --lengths 250 500 1000 2000 --threads 8
+"""
+import argparse
+import time
+
+import torch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", type=int, nargs="+", default=[250, 500, 1000, 2000])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    from chatterbox_tts.models.s3gen.transformer.attention import RelPositionMultiHeadedAttention
+    from chatterbox_tts.models.s3gen.transformer.embedding import EspnetRelPositionalEncoding
+    from chatterbox_tts.models.s3gen.matcha.transformer import BasicTransformerBlock
+
+    torch.manual_seed(0)
+    encoder_attn = RelPositionMultiHeadedAttention(8, 512, 0.0).to(args.device).eval()
+    pos_enc = EspnetRelPositionalEncoding(512, 0.0).to(args.device)
+    decoder_block = BasicTransformerBlock(dim=256, num_attention_heads=8, attention_head_dim=64, activation_fn="gelu")
+    decoder_block = decoder_block.to(args.device).eval()
+
+    def timed(fn) -> tuple[torch.Tensor, float]:
+        fn()  # warm up
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(args.iters):
+            out = fn()
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        return out, (time.time() - start_time) / args.iters * 1000
+
+    print(f"{'layer':>8} {'T':>5} {'eager':>9} {'sdpa':>9} {'speedup':>7} {'max diff':>9}")
+    with torch.inference_mode():
+        for length in args.lengths:
+            x = torch.randn(1, length, 512, device=args.device)
+            x, pos_emb = pos_enc(x)
+            mask = torch.ones(1, 1, length, dtype=torch.bool, device=args.device)
+
+            hidden = torch.randn(2, length, 256, device=args.device)
+            bias = torch.zeros(2, 1, length, device=args.device)
+
+            layers = {
+                "encoder": lambda: encoder_attn(x, x, x, mask, pos_emb)[0],
+                "decoder": lambda: decoder_block.attn1(hidden, attention_mask=bias),
+            }
+            for name, fn in layers.items():
+                results = {}
+                for backend in ("eager", "sdpa"):
+                    encoder_attn.attention_backend = backend
+                    decoder_block.set_attention_backend(backend)
+                    results[backend] = timed(fn)
+                (eager_out, eager_ms), (sdpa_out, sdpa_ms) = results["eager"], results["sdpa"]
+                diff = (eager_out - sdpa_out).abs().max().item()
+                print(f"{name:>8} {length:5} {eager_ms:7.2f}ms {sdpa_ms:7.2f}ms {eager_ms / sdpa_ms:6.2f}x {diff:9.2e}")
+
+
+if __name__ == "__main__":
+    main()
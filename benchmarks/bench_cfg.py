@@ -0,0 +1,85 @@
+"""
+Benchmark T3 with and without classifier-free guidance.
+
+Each mode runs in its own process (so each vLLM engine gets the GPU to itself), generates speech tokens
+for the chunks of a text file in one batch, and reports T3 speech tokens/s and the KV-cache capacity
+vLLM allocated. Run from the repository root, since the engine loads ./t3-model:
+
+    python benchmarks/bench_cfg.py --text docs/benchmark-text-1.txt --cfg-scales 0.5 0
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import torch
+
+
+def run_mode(args) -> dict:
+    from chatterbox_tts.tts import ChatterboxTTS
+
+    model = ChatterboxTTS.from_pretrained(
+        max_batch_size=args.batch_size,
+        max_model_len=args.max_model_len,
+        cfg_scale=args.cfg_scale,
+    )
+
+    with open(args.text) as f:
+        prompts = [line.strip() for line in f.read().split("\n") if line.strip()][:args.batch_size]
+    _, cond_emb = model.get_audio_conditionals(None)
+    sampling_params = model.make_sampling_params(seed=0)
+
+    # Warm up, then time a full batch
+    model.generate_speech_tokens(prompts[:2], [cond_emb] * 2, sampling_params)
+    torch.cuda.synchronize()
+    start_time = time.time()
+    speech_tokens = model.generate_speech_tokens(prompts, [cond_emb] * len(prompts), sampling_params)
+    torch.cuda.synchronize()
+    elapsed = time.time() - start_time
+
+    cache_config = model.t3.llm.llm_engine.vllm_config.cache_config
+    num_gpu_blocks = getattr(cache_config, "num_gpu_blocks", None)
+    return {
+        "cfg_scale": args.cfg_scale,
+        "prompts": len(prompts),
+        "speech_tokens": sum(len(t) for t in speech_tokens),
+        "seconds": elapsed,
+        "tokens_per_second": sum(len(t) for t in speech_tokens) / elapsed,
+        "kv_cache_tokens": num_gpu_blocks * cache_config.block_size if num_gpu_blocks else None,
+        "max_memory_allocated_mb": torch.cuda.max_memory_allocated() / 1024**2,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text", type=str, default="docs/benchmark-text-1.txt")
+    parser.add_argument("--cfg-scales", type=float, nargs="+", default=[0.5, 0.0])
+    parser.add_argument("--batch-size", type=int, default=60)
+    parser.add_argument("--max-model-len", type=int, default=1000)
+    # Internal: run a single mode and print its results as JSON
+    parser.add_argument("--cfg-scale", type=float, default=None)
+    args = parser.parse_args()
+
+    if args.cfg_scale is not None:
+        print("RESULT " + json.dumps(run_mode(args)))
+        return
+
+    results = []
+    for cfg_scale in args.cfg_scales:
+        print(f"Running with cfg_scale={cfg_scale}")
+        out = subprocess.run(
+            [sys.executable, __file__, "--text", args.text, "--batch-size", str(args.batch_size),
+             "--max-model-len", str(args.max_model_len), "--cfg-scale", str(cfg_scale)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(next(line for line in out.splitlines() if line.startswith("RESULT "))[7:]))
+
+    print(f"{'cfg_scale':>10} {'tokens':>8} {'seconds':>8} {'tokens/s':>9} {'KV tokens':>10} {'peak MB':>8}")
+    for r in results:
+        print(f"{r['cfg_scale']:>10} {r['speech_tokens']:>8} {r['seconds']:>8.2f} {r['tokens_per_second']:>9.1f} "
+              f"{r['kv_cache_tokens'] or 'n/a':>10} {r['max_memory_allocated_mb']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark the quality and latency of limiting S3Gen's classifier-free guidance to an interval of the ODE.
+
+Generates the speech tokens for a few chunks once, then renders their mels with CFG applied only while the estimator
+is evaluated at t in each interval; the other evaluations run at half the batch. The CFM starts from its fixed
+`rand_noise` buffer, so every run is compared to always-on CFG (0:1) by mean absolute log-mel error. Run from the
+repository root:
+
+    python benchmarks/bench_cfg_interval.py --intervals 0:1 0:0.5 0:0.3 0:0
+"""
+import argparse
+import time
+
+import torch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text", type=str, default="docs/benchmark-text-1.txt")
+    parser.add_argument("--chunks", type=int, default=8)
+    parser.add_argument("--diffusion-steps", type=int, default=10)
+    parser.add_argument("--intervals", type=str, nargs="+", default=["0:1", "0:0.7", "0:0.5", "0:0.3", "0.2:1", "0:0"])
+    args = parser.parse_args()
+
+    from chatterbox_tts.tts import ChatterboxTTS
+
+    model = ChatterboxTTS.from_pretrained(max_batch_size=args.chunks)
+    decoder = model.s3gen.flow.decoder
+
+    with open(args.text) as f:
+        prompts = [line.strip() for line in f.read().split("\n") if line.strip()][:args.chunks]
+    s3gen_ref, cond_emb = model.get_audio_conditionals(None)
+    speech_tokens = model.generate_speech_tokens(prompts, [cond_emb] * len(prompts), model.make_sampling_params(seed=0))
+    print(f"{len(speech_tokens)} chunks, {sum(len(t) for t in speech_tokens)} speech tokens")
+
+    def render(cfg_interval: tuple[float, float]) -> tuple[list[torch.Tensor], float]:
+        decoder.cfg_interval = cfg_interval
+        torch.cuda.synchronize()
+        start_time = time.time()
+        with torch.inference_mode():
+            mels = [
+                model.s3gen.flow_inference(tokens, ref_dict=s3gen_ref, finalize=True, n_timesteps=args.diffusion_steps).float()
+                for tokens in speech_tokens
+            ]
+        torch.cuda.synchronize()
+        return mels, time.time() - start_time
+
+    # Warm up
+    render((0.0, 1.0))
+
+    reference, reference_time = render((0.0, 1.0))
+
+    print(f"{'interval':>9} {'mel L1':>8} {'time':>7} {'speedup':>7}")
+    for interval in args.intervals:
+        start, end = (float(t) for t in interval.split(":"))
+        mels, elapsed = render((start, end))
+        error = sum((mel - ref).abs().mean().item() for mel, ref in zip(mels, reference)) / len(mels)
+        print(f"{interval:>9} {error:8.4f} {elapsed:6.2f}s {reference_time / elapsed:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark the quality of the S3Gen flow matching ODE solvers against the number of estimator evaluations (NFE).
+
+Generates the speech tokens for a few chunks once, then renders their mels with every solver configuration. The
+CFM starts from its fixed `rand_noise` buffer, so all runs integrate the same ODE from the same noise, and are
+compared to a high-NFE reference solution (RK4 over 16 cosine steps, 64 NFE) by mean absolute log-mel error.
+The default, 10-step Euler, is the quality to match. Run from the repository root:
+
+    python benchmarks/bench_cfm_solvers.py --configs euler:10 euler:5 heun:2:linear dpm_2m:4 dpm_2m:5:sway:-0.5
+
+Each config is solver:steps, optionally followed by :t_scheduler (default cosine).
+"""
+import argparse
+import time
+
+import torch
+
+DEFAULT_CONFIGS = [
+    "euler:10", "euler:5", "euler:4",
+    "midpoint:2", "heun:2", "heun:2:linear", "rk4:1",
+    "dpm_2m:4", "dpm_2m:5", "dpm_2m:4:linear", "dpm_2m:5:linear", "dpm_2m:5:sway:-0.5",
+    "adaptive:4",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text", type=str, default="docs/benchmark-text-1.txt")
+    parser.add_argument("--chunks", type=int, default=8)
+    parser.add_argument("--configs", type=str, nargs="+", default=DEFAULT_CONFIGS)
+    parser.add_argument("--reference", type=str, default="rk4:16")
+    args = parser.parse_args()
+
+    from chatterbox_tts.tts import ChatterboxTTS
+
+    model = ChatterboxTTS.from_pretrained(max_batch_size=args.chunks)
+    decoder = model.s3gen.flow.decoder
+
+    # Count estimator evaluations
+    nfe = 0
+    forward_estimator = decoder.forward_estimator
+
+    def counted_forward_estimator(*args, **kwargs):
+        nonlocal nfe
+        nfe += 1
+        return forward_estimator(*args, **kwargs)
+
+    decoder.forward_estimator = counted_forward_estimator
+
+    with open(args.text) as f:
+        prompts = [line.strip() for line in f.read().split("\n") if line.strip()][:args.chunks]
+    s3gen_ref, cond_emb = model.get_audio_conditionals(None)
+    speech_tokens = model.generate_speech_tokens(prompts, [cond_emb] * len(prompts), model.make_sampling_params(seed=0))
+    print(f"{len(speech_tokens)} chunks, {sum(len(t) for t in speech_tokens)} speech tokens")
+
+    def render(config: str) -> tuple[list[torch.Tensor], float, float]:
+        nonlocal nfe
+        solver, steps, *t_scheduler = config.split(":")
+        decoder.solver = solver
+        decoder.t_scheduler = ":".join(t_scheduler) or "cosine"
+
+        nfe = 0
+        torch.cuda.synchronize()
+        start_time = time.time()
+        with torch.inference_mode():
+            mels = [
+                model.s3gen.flow_inference(tokens, ref_dict=s3gen_ref, finalize=True, n_timesteps=int(steps)).float()
+                for tokens in speech_tokens
+            ]
+        torch.cuda.synchronize()
+        return mels, nfe / len(speech_tokens), time.time() - start_time
+
+    # Warm up
+    render("euler:2")
+
+    reference, reference_nfe, _ = render(args.reference)
+    print(f"Reference {args.reference}: {reference_nfe:.0f} NFE")
+
+    print(f"{'config':>20} {'NFE':>5} {'mel L1':>8} {'time':>7}")
+    for config in args.configs:
+        mels, config_nfe, elapsed = render(config)
+        error = sum((mel - ref).abs().mean().item() for mel, ref in zip(mels, reference)) / len(mels)
+        print(f"{config:>20} {config_nfe:5.1f} {error:8.4f} {elapsed:6.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark the whole pipeline on CPU: the torch T3 backend, then S3Gen, with a given number of threads and dtypes.
+
+Generates the speech tokens for a few chunks in one batch and renders them, reporting T3 speech tokens/s, the
+S3Gen time and the real-time factor of each stage (seconds of compute per second of audio). Run from the
+repository root:
+
+    python benchmarks/bench_cpu.py --chunks 4 --threads 16 --s3gen-dtype bfloat16
+"""
+import argparse
+import time
+
+import torch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text", type=str, default="docs/benchmark-text-1.txt")
+    parser.add_argument("--chunks", type=int, default=4)
+    parser.add_argument("--diffusion-steps", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--interop-threads", type=int, default=None)
+    parser.add_argument("--t3-dtype", type=str, default="float32")
+    parser.add_argument("--s3gen-dtype", type=str, default=None)
+    parser.add_argument("--cfg-scale", type=float, default=0.5)
+    args = parser.parse_args()
+
+    from chatterbox_tts.tts import ChatterboxTTS
+
+    model = ChatterboxTTS.from_pretrained(
+        target_device="cpu",
+        max_batch_size=args.chunks,
+        t3_dtype=args.t3_dtype,
+        s3gen_dtype=args.s3gen_dtype,
+        num_threads=args.threads,
+        num_interop_threads=args.interop_threads,
+        cfg_scale=args.cfg_scale,
+    )
+    print(f"{torch.get_num_threads()} intra-op threads, {torch.get_num_interop_threads()} inter-op threads")
+
+    with open(args.text) as f:
+        prompts = [line.strip() for line in f.read().split("\n") if line.strip()][:args.chunks]
+    s3gen_ref, cond_emb = model.get_audio_conditionals(None)
+    sampling_params = model.make_sampling_params(seed=0)
+
+    start_time = time.time()
+    speech_tokens = model.generate_speech_tokens(prompts, [cond_emb] * len(prompts), sampling_params)
+    t3_time = time.time() - start_time
+    n_tokens = sum(len(t) for t in speech_tokens)
+
+    start_time = time.time()
+    wavs = [model.render_speech_tokens(tokens, s3gen_ref, args.diffusion_steps) for tokens in speech_tokens]
+    s3gen_time = time.time() - start_time
+    audio_seconds = sum(wav.shape[-1] for wav in wavs) / model.sr
+
+    print(f"{len(prompts)} chunks, {n_tokens} speech tokens, {audio_seconds:.1f}s of audio")
+    print(f"T3:    {t3_time:6.2f}s  {n_tokens / t3_time:6.1f} tokens/s  RTF {t3_time / audio_seconds:.2f}")
+    print(f"S3Gen: {s3gen_time:6.2f}s  RTF {s3gen_time / audio_seconds:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark the quality and latency of reusing the S3Gen decoder's mid-block features across ODE steps (DeepCache).
+
+Generates the speech tokens for a few chunks once, then renders their mels with each deep cache interval. The
+CFM starts from its fixed `rand_noise` buffer, so every run is compared to the uncached render at the same number
+of steps by mean absolute log-mel error. Plain Euler at fewer steps is listed alongside, as the other way to spend
+less compute. Run from the repository root:
+
+    python benchmarks/bench_deep_cache.py --intervals 1 2 3 5 --fewer-steps 5 7
+"""
+import argparse
+import time
+
+import torch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text", type=str, default="docs/benchmark-text-1.txt")
+    parser.add_argument("--chunks", type=int, default=8)
+    parser.add_argument("--diffusion-steps", type=int, default=10)
+    parser.add_argument("--intervals", type=int, nargs="+", default=[1, 2, 3, 5])
+    parser.add_argument("--fewer-steps", type=int, nargs="+", default=[5, 7])
+    args = parser.parse_args()
+
+    from chatterbox_tts.tts import ChatterboxTTS
+
+    model = ChatterboxTTS.from_pretrained(max_batch_size=args.chunks)
+    decoder = model.s3gen.flow.decoder
+
+    with open(args.text) as f:
+        prompts = [line.strip() for line in f.read().split("\n") if line.strip()][:args.chunks]
+    s3gen_ref, cond_emb = model.get_audio_conditionals(None)
+    speech_tokens = model.generate_speech_tokens(prompts, [cond_emb] * len(prompts), model.make_sampling_params(seed=0))
+    print(f"{len(speech_tokens)} chunks, {sum(len(t) for t in speech_tokens)} speech tokens")
+
+    def render(diffusion_steps: int, deep_cache_interval: int) -> tuple[list[torch.Tensor], float]:
+        decoder.deep_cache_interval = deep_cache_interval
+        torch.cuda.synchronize()
+        start_time = time.time()
+        with torch.inference_mode():
+            mels = [
+                model.s3gen.flow_inference(tokens, ref_dict=s3gen_ref, finalize=True, n_timesteps=diffusion_steps).float()
+                for tokens in speech_tokens
+            ]
+        torch.cuda.synchronize()
+        return mels, time.time() - start_time
+
+    # Warm up
+    render(2, 1)
+
+    reference, reference_time = render(args.diffusion_steps, 1)
+
+    runs = [(args.diffusion_steps, interval) for interval in args.intervals if interval != 1]
+    runs += [(steps, 1) for steps in args.fewer_steps]
+    print(f"{'steps':>5} {'interval':>8} {'mel L1':>8} {'time':>7} {'speedup':>7}")
+    print(f"{args.diffusion_steps:5} {1:8} {0:8.4f} {reference_time:6.2f}s {1:6.2f}x")
+    for diffusion_steps, interval in runs:
+        mels, elapsed = render(diffusion_steps, interval)
+        error = sum((mel - ref).abs().mean().item() for mel, ref in zip(mels, reference)) / len(mels)
+        print(f"{diffusion_steps:5} {interval:8} {error:8.4f} {elapsed:6.2f}s {reference_time / elapsed:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
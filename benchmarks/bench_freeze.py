@@ -0,0 +1,114 @@
+"""
+Check `freeze_for_inference` against the unfrozen modules, and time both on CPU.
+
+Builds HiFT (with its F0 predictor), CAMPPlus and the voice encoder as S3Gen and ChatterboxTTS configure them,
+optionally loading the released weights, then runs each one before and after freezing it in place on the same
+input. Modules are not deep-copied, as removing the weight norm of a copy also removes it from the original's
+shared parametrized class. Without weights, the BatchNorm statistics are randomised so the folding is not a no-op. Run from the
+repository root:
+
+    python benchmarks/bench_freeze.py --ckpt-dir ~/.cache/huggingface/hub/models--ResembleAI--chatterbox/snapshots/<rev>
+"""
+import argparse
+import time
+from pathlib import Path
+
+import torch
+
+
+def load_prefixed(module: torch.nn.Module, state_dict: dict, prefix: str):
+    module.load_state_dict({k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)})
+
+
+def randomise_batchnorms(module: torch.nn.Module):
+    for m in module.modules():
+        if isinstance(m, torch.nn.modules.batchnorm._BatchNorm):
+            m.running_mean.normal_(0, 0.5)
+            m.running_var.uniform_(0.5, 2.0)
+            if m.affine:
+                m.weight.data.uniform_(0.5, 1.5)
+                m.bias.data.normal_(0, 0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt-dir", type=str, default=None)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--iters", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    from chatterbox_tts.models.s3gen.const import S3GEN_SR
+    from chatterbox_tts.models.s3gen.f0_predictor import ConvRNNF0Predictor
+    from chatterbox_tts.models.s3gen.hifigan import HiFTGenerator
+    from chatterbox_tts.models.s3gen.xvector import CAMPPlus
+    from chatterbox_tts.models.voice_encoder import VoiceEncoder
+
+    torch.manual_seed(0)
+    hift = HiFTGenerator(
+        sampling_rate=S3GEN_SR,
+        upsample_rates=[8, 5, 3],
+        upsample_kernel_sizes=[16, 11, 7],
+        source_resblock_kernel_sizes=[7, 7, 11],
+        source_resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+        f0_predictor=ConvRNNF0Predictor(),
+    )
+    f0_predictor = ConvRNNF0Predictor()
+    campplus = CAMPPlus()
+    ve = VoiceEncoder()
+
+    if args.ckpt_dir is not None:
+        from safetensors.torch import load_file
+
+        s3gen_weights = load_file(Path(args.ckpt_dir) / "s3gen.safetensors")
+        load_prefixed(hift, s3gen_weights, "mel2wav.")
+        load_prefixed(campplus, s3gen_weights, "speaker_encoder.")
+        ve.load_state_dict(load_file(Path(args.ckpt_dir) / "ve.safetensors"))
+    else:
+        randomise_batchnorms(campplus)
+    f0_predictor.load_state_dict(hift.f0_predictor.state_dict())
+
+    mel_frames = int(args.seconds * 50)
+    mel = torch.randn(1, 80, mel_frames) - 5  # roughly log-mel scaled
+    fbank = torch.randn(1, int(args.seconds * 100), 80)
+    ve_mels = torch.rand(8, 160, 40)
+
+    def run_hift(m):
+        # The source excitation has a random phase and noise, so compare with the same generator state
+        torch.manual_seed(0)
+        return m.inference(speech_feat=mel)[0]
+
+    modules = {
+        "hift": (hift, run_hift),
+        "f0_predictor": (f0_predictor, lambda m: m(mel)),
+        "campplus": (campplus, lambda m: m(fbank)),
+        "voice_encoder": (ve, lambda m: m(ve_mels)),
+    }
+
+    def timed(fn) -> tuple[torch.Tensor, float]:
+        fn()  # warm up
+        start_time = time.time()
+        for _ in range(args.iters):
+            out = fn()
+        return out, (time.time() - start_time) / args.iters * 1000
+
+    print(f"{'module':>14} {'unfrozen':>10} {'frozen':>10} {'speedup':>7} {'max diff':>9}")
+    with torch.inference_mode():
+        for name, (module, run) in modules.items():
+            module.eval()
+            out, unfrozen_ms = timed(lambda: run(module))
+            if name == "f0_predictor":
+                module.remove_weight_norm()
+                module.requires_grad_(False)
+            else:
+                module.freeze_for_inference()
+            frozen_out, frozen_ms = timed(lambda: run(module))
+            diff = (out - frozen_out).abs().max().item()
+            print(f"{name:>14} {unfrozen_ms:8.1f}ms {frozen_ms:8.1f}ms {unfrozen_ms / frozen_ms:6.2f}x {diff:9.2e}")
+
+
+if __name__ == "__main__":
+    main()
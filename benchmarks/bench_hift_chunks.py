@@ -0,0 +1,85 @@
+"""
+Benchmark chunked HiFT vocoding (`HiFTGenerator.decode_chunked`) against vocoding the whole mel at once.
+
+Each config is "chunk_frames:workers" (50 mel frames per second), and "0:1" is the unchunked reference. The source
+excitation is seeded identically for every run, so the max difference to the reference comes from the window edges
+alone. Peak memory is only reported on CUDA. Uses random weights unless `--ckpt-dir` holds s3gen.safetensors; from
+the repository root:
+
+    python benchmarks/bench_hift_chunks.py --seconds 10 30 60 --configs 0:1 250:1 250:4 --threads 8
+"""
+import argparse
+import time
+from pathlib import Path
+
+import torch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt-dir", type=str, default=None)
+    parser.add_argument("--seconds", type=float, nargs="+", default=[10.0, 30.0])
+    parser.add_argument("--configs", type=str, nargs="+", default=["0:1", "250:1", "250:2", "500:1"])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--iters", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    from chatterbox_tts.models.s3gen.const import S3GEN_SR
+    from chatterbox_tts.models.s3gen.f0_predictor import ConvRNNF0Predictor
+    from chatterbox_tts.models.s3gen.hifigan import HiFTGenerator
+
+    torch.manual_seed(0)
+    hift = HiFTGenerator(
+        sampling_rate=S3GEN_SR,
+        upsample_rates=[8, 5, 3],
+        upsample_kernel_sizes=[16, 11, 7],
+        source_resblock_kernel_sizes=[7, 7, 11],
+        source_resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+        f0_predictor=ConvRNNF0Predictor(),
+    )
+    if args.ckpt_dir is not None:
+        from safetensors.torch import load_file
+
+        s3gen_weights = load_file(Path(args.ckpt_dir) / "s3gen.safetensors")
+        hift.load_state_dict({k[len("mel2wav."):]: v for k, v in s3gen_weights.items() if k.startswith("mel2wav.")})
+    hift = hift.to(args.device)
+    hift.freeze_for_inference()
+
+    cuda = args.device.startswith("cuda")
+
+    def run(mel: torch.Tensor) -> torch.Tensor:
+        torch.manual_seed(0)
+        return hift.inference(speech_feat=mel)[0]
+
+    def timed(mel: torch.Tensor) -> tuple[torch.Tensor, float, str]:
+        run(mel)  # warm up
+        if cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start_time = time.time()
+        for _ in range(args.iters):
+            out = run(mel)
+        if cuda:
+            torch.cuda.synchronize()
+        peak = f"{torch.cuda.max_memory_allocated() / 1024**2:7.1f}MB" if cuda else "-"
+        return out, (time.time() - start_time) / args.iters * 1000, peak
+
+    print(f"{'seconds':>7} {'config':>7} {'time':>10} {'speedup':>7} {'peak':>9} {'max diff':>9}")
+    for seconds in args.seconds:
+        mel = torch.randn(1, 80, int(seconds * 50), device=args.device) - 5  # roughly log-mel scaled
+        reference, reference_ms = None, None
+        for config in ["0:1"] + [c for c in args.configs if c != "0:1"]:
+            hift.chunk_frames, hift.chunk_workers = (int(v) for v in config.split(":"))
+            out, ms, peak = timed(mel)
+            if reference is None:
+                reference, reference_ms = out, ms
+            diff = (out - reference).abs().max().item()
+            print(f"{seconds:7.1f} {config:>7} {ms:8.1f}ms {reference_ms / ms:6.2f}x {peak:>9} {diff:9.2e}")
+
+
+if __name__ == "__main__":
+    main()
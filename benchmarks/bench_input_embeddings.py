@@ -0,0 +1,243 @@
+"""
+Micro-benchmark for T3 input embedding assembly (`build_input_embeddings`).
+
+Replays mixed prefill/decode step layouts on CPU, checks the vectorised implementation against the
+original per-token loop, and times both. Layouts are either synthesised from a simulated vLLM schedule,
+or recorded from a running server by setting CHATTERBOX_RECORD_LAYOUTS=<dir> and passed with --recorded <dir>.
+
+    python benchmarks/bench_input_embeddings.py --sequences 60 --token-budget 512
+"""
+import argparse
+import glob
+import random
+import time
+
+import torch
+from torch import nn
+
+from chatterbox_tts.models.t3.modules.input_layout import (
+    CONDITIONING_SIZE,
+    PREFILL_TOKEN_OFFSET,
+    build_input_embeddings,
+)
+from chatterbox_tts.models.t3.modules.t3_config import T3Config
+
+
+# The legacy reference uses the original id layout: prompt ids as is, and speech tokens offset by 1000
+SPEECH_TOKEN_OFFSET = 1000
+PREFILL_COND_START_TOKEN = 695
+PREFILL_COND_END_TOKEN = 696
+PREFILL_END_TOKEN = 697
+PREFILL_COND_TOKEN = 698
+
+
+def to_current_ids(input_ids: torch.Tensor) -> torch.Tensor:
+    return torch.where(input_ids < SPEECH_TOKEN_OFFSET, input_ids + PREFILL_TOKEN_OFFSET, input_ids - SPEECH_TOKEN_OFFSET)
+
+
+def to_legacy_ids(input_ids: torch.Tensor) -> torch.Tensor:
+    return torch.where(input_ids >= PREFILL_TOKEN_OFFSET, input_ids - PREFILL_TOKEN_OFFSET, input_ids + SPEECH_TOKEN_OFFSET)
+
+
+class EmbeddingTables:
+    def __init__(self, t3conf: T3Config, dim: int):
+        self.speech_emb = nn.Embedding(t3conf.speech_tokens_dict_size, dim)
+        self.text_emb = nn.Embedding(t3conf.text_tokens_dict_size, dim)
+        self.text_pos_emb = torch.randn(t3conf.max_text_tokens + 2, dim)
+        self.speech_pos_emb = torch.randn(t3conf.max_speech_tokens + 2 + 2, dim)
+        self.start_speech_token = t3conf.start_speech_token
+
+
+def legacy_split_prefill_decode(input_ids, multimodal_embeddings):
+    """The original token-by-token segmentation, kept as the reference"""
+    remaining_multimodal_embeddings = torch.cat(multimodal_embeddings, dim=0)
+    in_prefill_block = input_ids[0] < SPEECH_TOKEN_OFFSET
+    output = []
+    buffer = []
+
+    def flush():
+        nonlocal remaining_multimodal_embeddings
+        if in_prefill_block:
+            mme, remaining_multimodal_embeddings = remaining_multimodal_embeddings \
+                .split([len(buffer), len(remaining_multimodal_embeddings) - len(buffer)], dim=0)
+            output.append((torch.tensor(buffer).to(input_ids.device), mme))
+        else:
+            output.append((torch.tensor(buffer).to(input_ids.device), None))
+
+    for input_id in input_ids:
+        if (in_prefill_block != (input_id < SPEECH_TOKEN_OFFSET)) or (input_id == PREFILL_COND_START_TOKEN):
+            if buffer:
+                flush()
+            buffer = []
+            in_prefill_block = (input_id < SPEECH_TOKEN_OFFSET)
+        buffer.append(input_id)
+
+    if buffer:
+        flush()
+    return output
+
+
+def legacy_input_embeddings(tables: EmbeddingTables, input_ids, multimodal_embeddings):
+    """The original per-block assembly, kept as the reference"""
+    def start_of_speech_emb(device):
+        token = torch.tensor([tables.start_speech_token]).to(device)
+        return tables.speech_emb(token.unsqueeze(0))[0] + tables.speech_pos_emb[0:1]
+
+    out = []
+    for ids, mme in legacy_split_prefill_decode(input_ids, multimodal_embeddings):
+        if mme is None:
+            embeds = tables.speech_emb(ids - SPEECH_TOKEN_OFFSET)
+            out.append(torch.cat([embeds, embeds], dim=1))
+            continue
+
+        if ids[0] == PREFILL_COND_START_TOKEN and ids[-1] == PREFILL_END_TOKEN:
+            text_ids = ids[CONDITIONING_SIZE:-1]
+            text_emb = tables.text_emb(text_ids) + tables.text_pos_emb[0:len(text_ids)]
+            cond, sos = mme[0:CONDITIONING_SIZE], start_of_speech_emb(ids.device)
+            out.append(torch.cat([
+                torch.cat([cond, text_emb, sos], dim=0),
+                torch.cat([cond, torch.zeros_like(text_emb), sos], dim=0),
+            ], dim=1))
+        elif ids[0] == PREFILL_COND_START_TOKEN:
+            text_ids = ids[CONDITIONING_SIZE:]
+            text_emb = tables.text_emb(text_ids) + tables.text_pos_emb[0:len(text_ids)]
+            cond = mme[0:min(CONDITIONING_SIZE, len(mme))]
+            out.append(torch.cat([
+                torch.cat([cond, text_emb], dim=0),
+                torch.cat([cond, torch.zeros_like(text_emb)], dim=0),
+            ], dim=1))
+        elif ids[-1] == PREFILL_END_TOKEN:
+            indices = torch.where(ids == PREFILL_COND_END_TOKEN)[0]
+            sos = start_of_speech_emb(ids.device)
+            if len(indices) > 0:
+                text_ids = ids[indices[0]+1:-1]
+                text_emb = tables.text_emb(text_ids) + tables.text_pos_emb[0:len(text_ids)]
+                cond = mme[:indices[0]+1]
+                out.append(torch.cat([
+                    torch.cat([cond, text_emb, sos], dim=0),
+                    torch.cat([cond, torch.zeros_like(text_emb), sos], dim=0),
+                ], dim=1))
+            else:
+                text_ids = ids[:-1]
+                text_pos = torch.sum(mme[0:len(text_ids)], dim=1) - 1
+                text_emb = tables.text_emb(text_ids) + tables.text_pos_emb[text_pos.long().tolist()]
+                out.append(torch.cat([
+                    torch.cat([text_emb, sos], dim=0),
+                    torch.cat([torch.zeros_like(text_emb), sos], dim=0),
+                ], dim=1))
+        else:
+            raise ValueError(f"Unknown prefill block: {ids}")
+
+    return torch.cat(out, dim=0)
+
+
+def make_prompt(dim: int, rng: random.Random) -> tuple[list[int], torch.Tensor]:
+    """Prompt ids and multimodal embedding, laid out the way T3MultiModalProcessor.apply does it"""
+    text_ids = [rng.randrange(1, 690) for _ in range(rng.randrange(10, 300))]
+    ids = [PREFILL_COND_START_TOKEN, *([PREFILL_COND_TOKEN] * (CONDITIONING_SIZE - 2)), PREFILL_COND_END_TOKEN, *text_ids, PREFILL_END_TOKEN]
+    triangular = (torch.arange(dim)[None, :] <= torch.arange(len(text_ids))[:, None]).float()
+    mm = torch.cat([torch.randn(CONDITIONING_SIZE, dim), triangular, torch.zeros(1, dim)], dim=0)
+    return ids, mm
+
+
+def synthesise_layouts(num_sequences: int, token_budget: int, num_steps: int, dim: int, seed: int = 0):
+    """
+    Simulate a chunked-prefill schedule: every step decodes one token for each running sequence and fills
+    the rest of the token budget with prefill, splitting the last prompt across two steps if needed.
+    """
+    rng = random.Random(seed)
+    running = 0
+    partial = None  # (ids, mm) left over from the previous step
+    layouts = []
+    for _ in range(num_steps):
+        # Running sequences (including the rest of a split prompt) come first, then newly scheduled prompts.
+        # That way the tail of a split prompt never directly follows another prefill block, which would
+        # make it indistinguishable from text.
+        running_blocks = [([SPEECH_TOKEN_OFFSET + rng.randrange(6561)], None) for _ in range(running)]
+        budget = token_budget - running
+        if partial is not None:
+            running_blocks.append(partial)
+            budget -= len(partial[0])
+            partial = None
+            running += 1
+        rng.shuffle(running_blocks)
+
+        new_blocks = []
+        while budget > 0 and running < num_sequences:
+            ids, mm = make_prompt(dim, rng)
+            if len(ids) > budget:
+                new_blocks.append((ids[:budget], mm[:budget]))
+                partial = (ids[budget:], mm[budget:])
+                break
+            new_blocks.append((ids, mm))
+            budget -= len(ids)
+            running += 1
+
+        # Sequences finish at random, making room for new prompts
+        running -= sum(rng.random() < 0.05 for _ in range(running))
+
+        blocks = running_blocks + new_blocks
+        input_ids = torch.tensor([i for ids, _ in blocks for i in ids])
+        layouts.append((input_ids, [mm for _, mm in blocks if mm is not None]))
+    return layouts
+
+
+def time_it(fn, layouts, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for input_ids, mm in layouts:
+            fn(input_ids, mm)
+    return (time.perf_counter() - start) / (repeats * len(layouts)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recorded", type=str, default=None, help="Directory of layouts recorded with CHATTERBOX_RECORD_LAYOUTS")
+    parser.add_argument("--sequences", type=int, default=60)
+    parser.add_argument("--token-budget", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    t3conf = T3Config()
+    tables = EmbeddingTables(t3conf, t3conf.n_channels)
+
+    if args.recorded:
+        layouts = []
+        for path in sorted(glob.glob(f"{args.recorded}/*.pt")):
+            record = torch.load(path, weights_only=True)
+            layouts.append((to_legacy_ids(record["input_ids"]), record["multimodal_embeddings"]))
+    else:
+        layouts = synthesise_layouts(args.sequences, args.token_budget, args.steps, t3conf.n_channels)
+    layouts = [(ids, mm) for ids, mm in layouts if mm]
+    print(f"Replaying {len(layouts)} mixed prefill/decode steps, {sum(len(ids) for ids, _ in layouts) / len(layouts):.0f} tokens on average")
+
+    # Layouts are kept in the legacy id layout; convert them up front so the conversion isn't timed
+    current_ids = {id(ids): to_current_ids(ids) for ids, _ in layouts}
+
+    def vectorised(input_ids, mm):
+        return build_input_embeddings(
+            current_ids[id(input_ids)], mm,
+            speech_emb=tables.speech_emb,
+            text_emb=tables.text_emb,
+            text_pos_emb=tables.text_pos_emb,
+            speech_pos_emb=tables.speech_pos_emb,
+            start_speech_token=tables.start_speech_token,
+        )
+
+    def legacy(input_ids, mm):
+        return legacy_input_embeddings(tables, input_ids, mm)
+
+    with torch.inference_mode():
+        max_diff = max((vectorised(ids, mm) - legacy(ids, mm)).abs().max().item() for ids, mm in layouts)
+        print(f"Max abs difference vs legacy: {max_diff:.3g}")
+
+        legacy_ms = time_it(legacy, layouts, args.repeats)
+        vectorised_ms = time_it(vectorised, layouts, args.repeats)
+    print(f"legacy:     {legacy_ms:8.3f} ms/step")
+    print(f"vectorised: {vectorised_ms:8.3f} ms/step ({legacy_ms / vectorised_ms:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Load test the BatchScheduler and S3Gen on CPU, with the mock T3 engine standing in for the GPU.
+
+`--clients` threads each submit `--requests` requests of `--chunks` lines of the text, one after the other, through a
+shared BatchScheduler like the server's. T3MockEngine emits deterministic tokens at `--tokens-per-second` per
+sequence, so the batching windows, the T3 stepping loop and the real S3Gen rendering all run with a GPU-like T3
+timing. Reports the latency of the requests and the throughput in seconds of audio per second. Run from the
+repository root:
+
+    python benchmarks/bench_mock_t3.py --clients 1 4 8 --tokens-per-second 50 --threads 8
+"""
+import argparse
+import statistics
+import threading
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text", type=str, default="docs/benchmark-text-1.txt")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--requests", type=int, default=2)
+    parser.add_argument("--chunks", type=int, default=2)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--batch-size", type=int, default=60)
+    parser.add_argument("--batch-window", type=float, default=0.05)
+    parser.add_argument("--diffusion-steps", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    from chatterbox_tts.scheduler import BatchScheduler
+    from chatterbox_tts.tts import ChatterboxTTS
+
+    model = ChatterboxTTS.from_pretrained(
+        target_device="cpu",
+        t3_backend="mock",
+        t3_mock_tokens_per_second=args.tokens_per_second,
+        max_batch_size=args.batch_size,
+        num_threads=args.threads,
+    )
+    scheduler = BatchScheduler(model, max_batch_size=args.batch_size, batch_window=args.batch_window)
+
+    with open(args.text) as f:
+        lines = [line.strip() for line in f.read().split("\n") if line.strip()]
+    s3gen_ref, cond_emb = model.get_audio_conditionals(None)
+
+    def run_client(client: int, latencies: list[float], samples: list[int]):
+        for request in range(args.requests):
+            start = (client * args.requests + request) * args.chunks % len(lines)
+            prompts = [lines[(start + i) % len(lines)] for i in range(args.chunks)]
+            start_time = time.time()
+            futures = scheduler.submit(prompts, s3gen_ref, cond_emb, diffusion_steps=args.diffusion_steps, seed=0)
+            wavs = [future.result() for future in futures]
+            latencies.append(time.time() - start_time)
+            samples.append(sum(wav.shape[-1] for wav in wavs))
+
+    # Warm up
+    run_client(0, [], [])
+
+    print(f"{'clients':>7} {'requests':>8} {'p50':>8} {'p95':>8} {'audio/s':>8}")
+    for clients in args.clients:
+        latencies, samples = [], []
+        threads = [threading.Thread(target=run_client, args=(c, latencies, samples)) for c in range(clients)]
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start_time
+
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        audio_per_second = sum(samples) / model.sr / elapsed
+        print(f"{clients:7d} {len(latencies):8d} {statistics.median(latencies):7.2f}s {p95:7.2f}s {audio_per_second:7.2f}x")
+
+    scheduler.shutdown()
+    model.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark end-to-end generation with and without overlapping S3Gen with T3.
+
+Sequential runs T3 over the whole batch, then renders every chunk with S3Gen. Overlapped is
+`generate_with_conds`, which hands each chunk to the S3Gen worker as soon as T3 finishes it, so the
+wall time should approach max(T3, S3Gen) instead of their sum. Run from the repository root:
+
+    python benchmarks/bench_overlap.py --text docs/benchmark-text-1.txt
+"""
+import argparse
+import time
+
+import torch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text", type=str, default="docs/benchmark-text-1.txt")
+    parser.add_argument("--batch-size", type=int, default=60)
+    parser.add_argument("--max-model-len", type=int, default=1000)
+    parser.add_argument("--diffusion-steps", type=int, default=10)
+    args = parser.parse_args()
+
+    from chatterbox_tts.tts import ChatterboxTTS
+
+    model = ChatterboxTTS.from_pretrained(max_batch_size=args.batch_size, max_model_len=args.max_model_len)
+
+    with open(args.text) as f:
+        prompts = [line.strip() for line in f.read().split("\n") if line.strip()][:args.batch_size]
+    s3gen_ref, cond_emb = model.get_audio_conditionals(None)
+    sampling_params = model.make_sampling_params(seed=0)
+
+    def sequential():
+        speech_tokens = model.generate_speech_tokens(prompts, [cond_emb] * len(prompts), sampling_params)
+        t3_done = time.time()
+        wavs = [model.render_speech_tokens(tokens, s3gen_ref, args.diffusion_steps) for tokens in speech_tokens]
+        return wavs, t3_done
+
+    def overlapped():
+        return model.generate_with_conds(prompts, s3gen_ref, cond_emb, diffusion_steps=args.diffusion_steps, seed=0), None
+
+    # Warm up both paths
+    model.generate_with_conds(prompts[:2], s3gen_ref, cond_emb, diffusion_steps=args.diffusion_steps, seed=0)
+
+    results = {}
+    for name, fn in [("sequential", sequential), ("overlapped", overlapped)]:
+        torch.cuda.synchronize()
+        start_time = time.time()
+        wavs, t3_done = fn()
+        torch.cuda.synchronize()
+        results[name] = (time.time() - start_time, t3_done - start_time if t3_done else None, sum(w.shape[-1] for w in wavs))
+
+    t3_time = results["sequential"][1]
+    s3gen_time = results["sequential"][0] - t3_time
+    print(f"T3 alone: {t3_time:.2f}s, S3Gen alone: {s3gen_time:.2f}s")
+    for name, (seconds, _, samples) in results.items():
+        print(f"{name:>11}: {seconds:7.2f}s for {samples / model.sr:7.1f}s of audio (RTF {seconds / (samples / model.sr):.3f})")
+
+
+if __name__ == "__main__":
+    main()
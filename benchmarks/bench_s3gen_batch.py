@@ -0,0 +1,62 @@
+"""
+Benchmark batched S3Gen rendering against the serial per-chunk loop.
+
+Generates the speech tokens for the chunks of a text file once, then renders all of them with
+`render_speech_tokens` one at a time and with `render_speech_tokens_batch` for a few bucket sizes.
+Run from the repository root:
+
+    python benchmarks/bench_s3gen_batch.py --text docs/benchmark-text-1.txt --batch-sizes 4 8 16
+"""
+import argparse
+import time
+
+import torch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text", type=str, default="docs/benchmark-text-1.txt")
+    parser.add_argument("--chunks", type=int, default=60)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--max-batch-tokens", type=int, default=4096)
+    parser.add_argument("--diffusion-steps", type=int, default=10)
+    args = parser.parse_args()
+
+    from chatterbox_tts.tts import ChatterboxTTS
+
+    model = ChatterboxTTS.from_pretrained(max_batch_size=args.chunks)
+
+    with open(args.text) as f:
+        prompts = [line.strip() for line in f.read().split("\n") if line.strip()][:args.chunks]
+    s3gen_ref, cond_emb = model.get_audio_conditionals(None)
+    speech_tokens = model.generate_speech_tokens(prompts, [cond_emb] * len(prompts), model.make_sampling_params(seed=0))
+    print(f"{len(speech_tokens)} chunks, {sum(len(t) for t in speech_tokens)} speech tokens")
+
+    def serial():
+        return [model.render_speech_tokens(tokens, s3gen_ref, args.diffusion_steps) for tokens in speech_tokens]
+
+    def batched(batch_size):
+        with torch.inference_mode():
+            return model.s3gen.inference_batch(
+                speech_tokens, [s3gen_ref] * len(speech_tokens), n_timesteps=args.diffusion_steps,
+                max_batch_size=batch_size, max_batch_tokens=args.max_batch_tokens,
+            )
+
+    # Warm up
+    serial()
+    batched(args.batch_sizes[0])
+
+    runs = [("serial", serial)] + [(f"batch {b}", lambda b=b: batched(b)) for b in args.batch_sizes]
+    for name, fn in runs:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start_time = time.time()
+        wavs = fn()
+        torch.cuda.synchronize()
+        elapsed = time.time() - start_time
+        audio_seconds = sum(w.shape[-1] for w in wavs) / model.sr
+        print(f"{name:>9}: {elapsed:6.2f}s, RTF {elapsed / audio_seconds:.4f}, peak {torch.cuda.max_memory_allocated() / 1024**2:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
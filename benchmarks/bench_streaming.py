@@ -0,0 +1,47 @@
+"""
+Benchmark the latency to first audio of incremental streaming (`generate_incremental_stream`) against rendering
+the whole prompt at once, for a few chunk sizes. Run from the repository root:
+
+    python benchmarks/bench_streaming.py --token-hop-lens 25 50
+"""
+import argparse
+import time
+
+DEFAULT_TEXT = (
+    "Streaming synthesis renders speech while the model is still generating it, so a listener hears the start of "
+    "a long sentence well before the end of it has been decided."
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text", type=str, default=DEFAULT_TEXT)
+    parser.add_argument("--token-hop-lens", type=int, nargs="+", default=[25, 50])
+    parser.add_argument("--diffusion-steps", type=int, default=10)
+    args = parser.parse_args()
+
+    from chatterbox_tts.tts import ChatterboxTTS
+
+    model = ChatterboxTTS.from_pretrained(max_batch_size=1)
+
+    # Warm up
+    list(model.generate_incremental_stream(args.text, diffusion_steps=args.diffusion_steps, seed=0))
+
+    start_time = time.time()
+    wav = model.generate(args.text, diffusion_steps=args.diffusion_steps, seed=0)[0]
+    print(f"{'whole prompt':>14}: first audio {time.time() - start_time:6.2f}s, {wav.shape[-1] / model.sr:5.1f}s of audio")
+
+    for token_hop_len in args.token_hop_lens:
+        start_time = time.time()
+        first_audio = None
+        samples = 0
+        for chunk in model.generate_incremental_stream(args.text, diffusion_steps=args.diffusion_steps, token_hop_len=token_hop_len, seed=0):
+            if first_audio is None:
+                first_audio = time.time() - start_time
+            samples += chunk.shape[-1]
+        total = time.time() - start_time
+        print(f"{f'hop {token_hop_len}':>14}: first audio {first_audio:6.2f}s, {samples / model.sr:5.1f}s of audio in {total:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,24 @@
 # ====== Configuration ======
-AUDIO_PROMPT_PATH = "docs/corey.mp3"
+AUDIO_PROMPT_PATH = "docs/corey.mp3"  # Default voice when a request doesn't name one
+VOICE_DIR = "voices"  # Enrolled voices are persisted here and preloaded at startup
+VOICE_CACHE_MAX_BYTES = 512 * 1024 * 1024
 MAX_CHUNK_SIZE = 400
+DEVICE = "cuda"  # "cpu" runs T3 on the pure PyTorch backend instead of vLLM, for GPU-less nodes
+T3_BACKEND = None  # "vllm", "torch", or "mock" for deterministic fake tokens when load testing; None picks by DEVICE
+T3_MOCK_TOKENS_PER_SECOND = 50.0  # Decoding rate of each sequence with the mock T3 backend
+CPU_THREADS = None  # torch intra-op threads when DEVICE is "cpu"; None keeps torch's default (one per core)
+S3GEN_DTYPE = None  # Autocast dtype of S3Gen's flow, e.g. "bfloat16" on CPUs with AMX; None is float32
+CFG_SCALE = 0.5  # Classifier-free guidance weight for T3. 0 disables CFG, roughly halving T3 compute at some cost in quality
 BATCH_SIZE = 60
+BATCH_WINDOW = 0.05  # Seconds to wait for more chunks from concurrent requests before running a batch
+MAX_BATCH_TOKENS = None  # Optional cap on the (worst case) number of tokens per batch
+JOB_WORKERS = 4  # Jobs running concurrently; their chunks are coalesced by the batch scheduler
+MAX_QUEUED_JOBS = 16  # Jobs waiting for or running inference; further submissions get a 429
+MAX_FINISHED_JOBS = 200  # Finished jobs kept around for status polling / download
+
+# Cache of speech tokens / rendered audio for repeated sentences. Set CACHE_DIR to None to keep it in memory only.
+CACHE_ENABLED = True
+CACHE_DIR = "cache"
+CACHE_MAX_TOKEN_BYTES = 64 * 1024 * 1024
+CACHE_MAX_WAV_BYTES = 1024 * 1024 * 1024
+CACHE_MAX_DISK_BYTES = 10 * 1024 * 1024 * 1024
@@ -0,0 +1,152 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+import configuration
+import system_events
+import utils
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at MAX_QUEUED_JOBS"""
+    pass
+
+
+@dataclass
+class Job:
+    id: str
+    text_chunks: list[str]
+    voice: Optional[str] = None  # Enrolled voice ID or name; None for the default voice
+    exaggeration: float = 0.5
+    min_p: float = 0.1
+
+    status: str = "queued"  # queued -> running -> finished | failed
+    completed_chunks: int = 0
+    audio_path: Optional[str] = None
+    error: Optional[str] = None
+
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("finished", "failed")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "voice": self.voice,
+            "total_chunks": len(self.text_chunks),
+            "completed_chunks": self.completed_chunks,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Runs speech generation jobs on dedicated worker threads, so the HTTP event loop never blocks on
+    inference. Chunks of concurrently running jobs are coalesced by the batch scheduler.
+    At most `max_queued` jobs may be waiting or running.
+    """
+
+    def __init__(self, max_queued: int = configuration.MAX_QUEUED_JOBS, max_finished: int = configuration.MAX_FINISHED_JOBS,
+                 workers: int = configuration.JOB_WORKERS):
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts-job")
+
+    def pending_count(self) -> int:
+        return sum(1 for job in self.jobs.values() if not job.done)
+
+    def submit(self, text_chunks: list[str], voice: Optional[str] = None, exaggeration: float = 0.5, min_p: float = 0.1) -> Job:
+        with self.lock:
+            if self.pending_count() >= self.max_queued:
+                raise QueueFullError(f"Job queue is full ({self.max_queued} jobs pending)")
+
+            job = Job(id=uuid.uuid4().hex, text_chunks=text_chunks, voice=voice, exaggeration=exaggeration, min_p=min_p)
+            self.jobs[job.id] = job
+            self._prune_finished()
+
+        self.executor.submit(self._run, job)
+        print(f"[JOBS] Queued job {job.id} with {len(text_chunks)} chunks")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _prune_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def _run(self, job: Job):
+        model = system_events.get_model()
+        scheduler = system_events.get_scheduler()
+        if model is None or scheduler is None:
+            job.status = "failed"
+            job.error = "Model not loaded"
+            job.finished_at = time.time()
+            return
+
+        job.status = "running"
+        job.started_at = time.time()
+        audio_path = f"{utils.get_output_dir('audio')}/job_{job.id}.mp3"
+
+        try:
+            mp3 = utils.MP3Stream(model.sr)
+            with open(audio_path, "wb") as f:
+                for wav in scheduler.generate_stream(
+                    job.text_chunks,
+                    audio_prompt_path=job.voice or configuration.AUDIO_PROMPT_PATH,
+                    exaggeration=job.exaggeration,
+                    min_p=job.min_p,
+                ):
+                    f.write(mp3.write(wav))
+                    job.completed_chunks += 1
+                f.write(mp3.close())
+
+            job.audio_path = audio_path
+            job.status = "finished"
+            print(f"[JOBS] Job {job.id} finished in {time.time() - job.started_at:.2f} seconds")
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            print(f"[JOBS] Job {job.id} failed: {e}")
+        finally:
+            job.finished_at = time.time()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Global job manager, created on first use
+manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> JobManager:
+    """Get the global job manager instance"""
+    global manager
+    with _manager_lock:
+        if manager is None:
+            manager = JobManager()
+        return manager
+
+
+def shutdown():
+    """Stop accepting work and drop jobs that haven't started yet"""
+    if manager is not None:
+        manager.shutdown()
+        print("[JOBS] Job manager shutdown.")
@@ -18,6 +18,12 @@ if __name__ == "__main__":
     print("  POST /tts-batch           - Batch text-to-speech")
     print("  POST /process-file        - Process text file (like benchmark.py)")
     print("  POST /set-prompt          - Upload new voice prompt")
+    print("  POST /voices              - Enroll a voice from an uploaded audio clip")
+    print("  POST /voices/batch        - Enroll many voices at once")
+    print("  GET  /voices              - List enrolled voices")
+    print("  POST /jobs                - Queue a speech job, returns a job ID")
+    print("  GET  /jobs/{id}           - Job status and per-chunk progress")
+    print("  GET  /jobs/{id}/audio     - Download the audio of a finished job")
     print()
     print("Example usage:")
     print("  curl -X POST http://localhost:8081/tts \\")
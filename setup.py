@@ -44,6 +44,7 @@ setup(
         "gradio",
         "fastapi",
         "uvicorn",
+        "python-multipart",
     ],
     extras_require={
         "dev": ["build", "twine"],
@@ -0,0 +1,202 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional
+import hashlib
+import os
+import threading
+
+import torch
+
+from .text_utils import punc_norm
+
+if TYPE_CHECKING:
+    from .models.t3.engine import SamplingParams
+
+
+# Sampling params that affect which speech tokens T3 produces
+SAMPLING_KEY_FIELDS = (
+    "n", "temperature", "top_p", "top_k", "min_p", "seed",
+    "presence_penalty", "frequency_penalty", "repetition_penalty",
+    "max_tokens", "min_tokens", "stop_token_ids",
+)
+
+
+def tensor_fingerprint(t: torch.Tensor) -> str:
+    """Content hash of a tensor, including its shape and dtype"""
+    h = hashlib.sha256(f"{tuple(t.shape)}:{t.dtype}".encode())
+    h.update(t.detach().cpu().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def dict_fingerprint(d: dict[str, Any]) -> str:
+    """Content hash of a dict of tensors / plain values, such as an S3Gen reference dict"""
+    h = hashlib.sha256()
+    for k in sorted(d.keys()):
+        v = d[k]
+        h.update(k.encode())
+        h.update((tensor_fingerprint(v) if torch.is_tensor(v) else repr(v)).encode())
+    return h.hexdigest()
+
+
+def sampling_fingerprint(sampling_params: "SamplingParams") -> str:
+    return repr(tuple(getattr(sampling_params, f, None) for f in SAMPLING_KEY_FIELDS))
+
+
+def hash_key(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+class TensorCache:
+    """
+    LRU cache of CPU tensors, bounded by their total size in bytes.
+    If `disk_dir` is set, every entry is also written there, and entries evicted from memory
+    (or from a previous run) are reloaded on access. The disk store is bounded by `max_disk_bytes`.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str | Path] = None, max_disk_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.entries: OrderedDict[str, torch.Tensor] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.disk_dir = Path(disk_dir) if disk_dir is not None else None
+        self.disk_entries: OrderedDict[str, int] = OrderedDict()
+        self.disk_size = 0
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            # Least recently used first
+            for path in sorted(self.disk_dir.glob("*.pt"), key=lambda p: p.stat().st_mtime):
+                self.disk_entries[path.stem] = path.stat().st_size
+                self.disk_size += path.stat().st_size
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _path(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.pt"
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+            if key in self.disk_entries:
+                path = self._path(key)
+                try:
+                    value = torch.load(path, weights_only=True)
+                    os.utime(path)
+                    self.disk_entries.move_to_end(key)
+                    self._put_memory(key, value)
+                    self.hits += 1
+                    return value
+                except Exception as e:
+                    print(f"[CACHE] Failed to load {path}: {e}")
+                    self._remove_disk(key)
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: torch.Tensor):
+        # Clone so that a view doesn't keep (or serialise) a larger storage alive
+        value = value.detach().cpu().clone()
+        with self.lock:
+            self._put_memory(key, value)
+
+            if self.disk_dir is not None and key not in self.disk_entries:
+                path = self._path(key)
+                try:
+                    # Write to a temporary file first so a crash never leaves a truncated entry behind
+                    tmp_path = path.with_suffix(".tmp")
+                    torch.save(value, tmp_path)
+                    os.replace(tmp_path, path)
+                    self.disk_entries[key] = path.stat().st_size
+                    self.disk_size += self.disk_entries[key]
+                except Exception as e:
+                    print(f"[CACHE] Failed to write {path}: {e}")
+
+                while self.max_disk_bytes is not None and self.disk_size > self.max_disk_bytes and self.disk_entries:
+                    self._remove_disk(next(iter(self.disk_entries)))
+
+    def _put_memory(self, key: str, value: torch.Tensor):
+        nbytes = value.numel() * value.element_size()
+        if nbytes > self.max_bytes:
+            return
+
+        if key in self.entries:
+            old = self.entries.pop(key)
+            self.size -= old.numel() * old.element_size()
+
+        self.entries[key] = value
+        self.size += nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.numel() * evicted.element_size()
+
+    def _remove_disk(self, key: str):
+        self.disk_size -= self.disk_entries.pop(key)
+        self._path(key).unlink(missing_ok=True)
+
+
+class SpeechCache:
+    """
+    Content-addressed two-tier cache.
+    - Tier one maps (normalised text, conditionals, sampling params) to T3 speech tokens.
+      The conditionals already contain the voice and the exaggeration.
+    - Tier two maps (speech tokens, S3Gen reference, diffusion steps) to waveforms.
+      It is keyed by the tokens themselves, so a token hit can be re-rendered at a different step count.
+    """
+
+    def __init__(
+        self,
+        max_token_bytes: int = 64 * 1024 * 1024,
+        max_wav_bytes: int = 1024 * 1024 * 1024,
+        disk_dir: Optional[str | Path] = None,
+        max_disk_bytes: Optional[int] = None,
+    ):
+        disk_dir = Path(disk_dir) if disk_dir is not None else None
+        self.tokens = TensorCache(max_token_bytes, disk_dir / "tokens" if disk_dir else None, max_disk_bytes)
+        self.wavs = TensorCache(max_wav_bytes, disk_dir / "wavs" if disk_dir else None, max_disk_bytes)
+
+    def token_key(self, text: str, cond_emb_fingerprint: str, sampling_params: "SamplingParams",
+                  engine_tag: Optional[str] = None, cfg_scale: float = 0.5) -> str:
+        parts = [punc_norm(text), cond_emb_fingerprint, sampling_fingerprint(sampling_params)]
+        # The default is left out, so entries cached before the CFG scale was configurable stay valid
+        if cfg_scale != 0.5:
+            parts += [f"cfg_scale={cfg_scale}"]
+        # Tokens of engines that don't sample T3 (T3Engine.cache_tag) must not be served to the ones that do
+        if engine_tag is not None:
+            parts += [f"engine={engine_tag}"]
+        return hash_key("tokens", *parts)
+
+    def wav_key(self, speech_tokens: torch.Tensor, s3gen_ref_fingerprint: str, diffusion_steps: int,
+                solver: str = "euler", t_scheduler: str = "cosine", deep_cache_interval: int = 1,
+                cfg_interval: tuple[float, float] = (0.0, 1.0), hift_chunk_frames: int = 0,
+                autocast_dtype: Optional[torch.dtype] = None) -> str:
+        parts = [tensor_fingerprint(speech_tokens), s3gen_ref_fingerprint, str(diffusion_steps)]
+        # The defaults are left out, so entries cached before the solver was configurable stay valid
+        if (solver, t_scheduler) != ("euler", "cosine"):
+            parts += [solver, t_scheduler]
+        if deep_cache_interval != 1:
+            parts += [f"deep_cache_interval={deep_cache_interval}"]
+        if tuple(cfg_interval) != (0.0, 1.0):
+            parts += [f"cfg_interval={cfg_interval[0]},{cfg_interval[1]}"]
+        if hift_chunk_frames != 0:
+            parts += [f"hift_chunk_frames={hift_chunk_frames}"]
+        if autocast_dtype is not None:
+            parts += [f"autocast_dtype={autocast_dtype}"]
+        return hash_key("wav", *parts)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "token_entries": len(self.tokens),
+            "token_hits": self.tokens.hits,
+            "token_misses": self.tokens.misses,
+            "wav_entries": len(self.wavs),
+            "wav_hits": self.wavs.hits,
+            "wav_misses": self.wavs.misses,
+        }
@@ -11,6 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from dataclasses import dataclass, field
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -34,6 +37,27 @@ def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
 
 
 
+@dataclass
+class DecoderPlan:
+    """
+    The parts of a ConditionalDecoder pass that only depend on the mask and the conditioning, which stay the same
+    for every step of an ODE solve. Built once per solve by `ConditionalDecoder.make_plan`.
+    """
+    # Padding mask and attention bias per resolution, from the input resolution down to the mid blocks
+    masks: list[torch.Tensor]
+    attn_biases: list[torch.Tensor]
+    # mu, spks (repeated over time) and cond, packed along channels
+    conditioning: torch.Tensor
+    # Output of the time MLP per time step, filled in for the t_span up front and for other time steps on first use
+    time_embeddings: dict[float, torch.Tensor] = field(default_factory=dict)
+
+    # DeepCache (Ma et al., 2023): the mid blocks only run on every deep_cache_interval-th evaluation. The ones in
+    # between reuse their last output, and only run the down and up blocks around it. 1 disables the cache.
+    deep_cache_interval: int = 1
+    deep_features: Optional[torch.Tensor] = None
+    evaluations: int = 0
+
+
 class Transpose(torch.nn.Module):
     def __init__(self, dim0: int, dim1: int):
         super().__init__()
@@ -230,7 +254,37 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None):
+    def embed_time(self, t: torch.Tensor) -> torch.Tensor:
+        t = self.time_embeddings(t).to(t.dtype)
+        return self.time_mlp(t)
+
+    def make_plan(self, mask, mu, spks=None, cond=None, t_span: Optional[torch.Tensor] = None,
+                  deep_cache_interval: int = 1) -> DecoderPlan:
+        """Precompute everything but x and t, for `forward` to reuse across the steps of an ODE solve"""
+        conditioning = mu
+        if spks is not None:
+            spks = repeat(spks, "b c -> b c t", t=mu.shape[-1])
+            conditioning = pack([conditioning, spks], "b * t")[0]
+        if cond is not None:
+            conditioning = pack([conditioning, cond], "b * t")[0]
+
+        # Each down block halves the time resolution, except the last one
+        masks = [mask]
+        for _ in self.down_blocks[:-1]:
+            masks.append(masks[-1][:, :, ::2])
+        attn_biases = []
+        for mask_res in masks:
+            # attn_mask = torch.matmul(mask_res.transpose(1, 2).contiguous(), mask_res)
+            attn_mask = add_optional_chunk_mask(mask_res.transpose(1, 2), mask_res.bool(), False, False, 0, self.static_chunk_size, -1)
+            attn_biases.append(mask_to_bias(attn_mask == 1, mu.dtype))
+
+        plan = DecoderPlan(masks=masks, attn_biases=attn_biases, conditioning=conditioning, deep_cache_interval=deep_cache_interval)
+        if t_span is not None:
+            for t, t_emb in zip(t_span.tolist(), self.embed_time(t_span.to(mu.dtype))):
+                plan.time_embeddings[t] = t_emb.unsqueeze(0)
+        return plan
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, plan: Optional[DecoderPlan] = None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -239,75 +293,79 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
-
-        Raises:
-            ValueError: _description_
-            ValueError: _description_
+            plan (DecoderPlan, optional): from `make_plan`. If given, mask, mu, spks and cond are taken from the
+                plan, and t is a float shared by the whole batch. x may have fewer rows than the plan, which then
+                only uses its leading rows (e.g. the conditional half of a CFG batch).
 
         Returns:
-            _type_: _description_
+            torch.Tensor: shape (batch_size, out_channels, time)
         """
+        if plan is None:
+            plan = self.make_plan(mask, mu, spks, cond)
+            t = self.embed_time(t)
+        else:
+            t_emb = plan.time_embeddings.get(t)
+            if t_emb is None:
+                t_emb = plan.time_embeddings[t] = self.embed_time(torch.full((1,), t, device=x.device, dtype=x.dtype))
+            t = t_emb.expand(x.size(0), -1)
+        batch_size = x.size(0)
+        masks, attn_biases, conditioning = plan.masks, plan.attn_biases, plan.conditioning
+        if batch_size < conditioning.size(0):
+            masks = [m[:batch_size] for m in masks]
+            attn_biases = [b[:batch_size] for b in attn_biases]
+            conditioning = conditioning[:batch_size]
+        mask = masks[0]
+
+        # Cached features from a smaller batch are missing rows, so those have to be recomputed
+        reuse_deep_features = (
+            plan.deep_features is not None and plan.deep_features.size(0) >= batch_size
+            and plan.evaluations % plan.deep_cache_interval != 0
+        )
+        plan.evaluations += 1
 
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
-
-        x = pack([x, mu], "b * t")[0]
-
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+        x = pack([x, conditioning], "b * t")[0]
 
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        for (resnet, transformer_blocks, downsample), mask_down, attn_bias in zip(self.down_blocks, masks, attn_biases):
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
-                    attention_mask=attn_mask,
+                    attention_mask=attn_bias,
                     timestep=t,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
-            x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
-
-        for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
+            if len(hiddens) < len(self.down_blocks) or not reuse_deep_features:
+                x = downsample(x * mask_down)
+        mask_mid, attn_bias = masks[-1], attn_biases[-1]
+
+        if reuse_deep_features:
+            x = plan.deep_features[:batch_size]
+        else:
+            for resnet, transformer_blocks in self.mid_blocks:
+                x = resnet(x, mask_mid, t)
+                x = rearrange(x, "b c t -> b t c").contiguous()
+                for transformer_block in transformer_blocks:
+                    x = transformer_block(
+                        hidden_states=x,
+                        attention_mask=attn_bias,
+                        timestep=t,
+                    )
+                x = rearrange(x, "b t c -> b c t").contiguous()
+            if plan.deep_cache_interval > 1:
+                plan.deep_features = x
 
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+        for (resnet, transformer_blocks, upsample), mask_up, attn_bias in zip(self.up_blocks, masks[::-1], attn_biases[::-1]):
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
-                    attention_mask=attn_mask,
+                    attention_mask=attn_bias,
                     timestep=t,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
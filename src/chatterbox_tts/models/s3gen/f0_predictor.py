@@ -14,6 +14,7 @@
 import torch
 import torch.nn as nn
 from torch.nn.utils.parametrizations import weight_norm
+from torch.nn.utils.parametrize import remove_parametrizations
 
 
 class ConvRNNF0Predictor(nn.Module):
@@ -49,6 +50,11 @@ class ConvRNNF0Predictor(nn.Module):
         )
         self.classifier = nn.Linear(in_features=cond_channels, out_features=self.num_class)
 
+    def remove_weight_norm(self):
+        for l in self.condnet:
+            if isinstance(l, nn.Conv1d):
+                remove_parametrizations(l, "weight")
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.condnet(x)
         x = x.transpose(1, 2)
@@ -203,32 +203,52 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   embedding,
                   finalize,
                   n_timesteps: int):
+        """
+        Batched over B sequences: `token` [B, T] and `prompt_token` [B, T'] are right padded, with their lengths
+        in `token_len` and `prompt_token_len`, and `prompt_feat` [B, T'', 80] is zero padded to `prompt_feat_len`
+        (None means every prompt is unpadded). Returns the generated mels [B, 80, T_mel], zero padded and left
+        aligned, and their lengths. With B = 1 this is exactly the unbatched computation.
+        """
         embedding = embedding.to(self.spk_embed_affine_layer.weight.dtype)
         prompt_feat = prompt_feat.to(self.spk_embed_affine_layer.weight.dtype)
 
-        assert token.shape[0] == 1
+        batch_size = token.shape[0]
+        device = token.device
+        if prompt_feat_len is None:
+            prompt_feat_len = torch.full((batch_size,), prompt_feat.shape[1], device=device)
+        token_len, prompt_token_len, prompt_feat_len = token_len.to(device), prompt_token_len.to(device), prompt_feat_len.to(device)
+
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
         embedding = self.spk_embed_affine_layer(embedding)
 
-        # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+        # concat text and prompt_text, per sequence: [prompt tokens | tokens | padding]
+        if batch_size == 1:
+            token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        else:
+            pos = torch.arange(int((prompt_token_len + token_len).max()), device=device)[None, :]
+            from_prompt = prompt_token.gather(1, pos.clamp(max=prompt_token.shape[1] - 1).expand(batch_size, -1))
+            from_token = token.gather(1, (pos - prompt_token_len[:, None]).clamp(0, token.shape[1] - 1))
+            token = torch.where(pos < prompt_token_len[:, None], from_prompt, from_token)
+            token_len = prompt_token_len + token_len
+        mask = (~make_pad_mask(token_len, token.shape[1])).unsqueeze(-1).to(embedding)
         token = self.input_embedding(torch.clamp(token, min=0)) * mask
 
         # text encode
         h, h_lengths = self.encoder(token, token_len)
+        mel_len = token_len * self.token_mel_ratio
         if finalize is False:
-            h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
-        mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
+            mel_len = mel_len - self.pre_lookahead_len * self.token_mel_ratio
+            h = h[:, :int(mel_len.max())]
+        mel_len1, mel_len2 = prompt_feat_len, mel_len - prompt_feat_len
         h = self.encoder_proj(h)
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
+        conds = torch.zeros([batch_size, h.shape[1], self.output_size], device=token.device).to(h.dtype)
+        conds[:, :prompt_feat.shape[1]] = prompt_feat
         conds = conds.transpose(1, 2)
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
+        mask = (~make_pad_mask(mel_len, h.shape[1])).to(h)
         feat, _ = self.decoder(
             mu=h.transpose(1, 2).contiguous(),
             mask=mask.unsqueeze(1),
@@ -236,6 +256,14 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             cond=conds,
             n_timesteps=n_timesteps,
         )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat, None  # NOTE jrm: why are they returning None here?
+
+        # Cut the generated frames out of [prompt mels | generated mels | padding]
+        if batch_size == 1:
+            feat = feat[:, :, int(mel_len1):]
+            assert feat.shape[2] == mel_len2
+            return feat, mel_len2
+        pos = torch.arange(int(mel_len2.max()), device=device)[None, :]
+        index = (pos + mel_len1[:, None]).clamp(max=feat.shape[2] - 1)
+        feat = feat.gather(2, index[:, None, :].expand(-1, feat.shape[1], -1))
+        feat = feat * (pos < mel_len2[:, None])[:, None, :]
+        return feat, mel_len2
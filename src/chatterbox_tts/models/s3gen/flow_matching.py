@@ -15,6 +15,7 @@ import threading
 import torch
 import torch.nn.functional as F
 from .matcha.flow_matching import BASECFM
+from .ode_solvers import SOLVERS, make_t_span
 from omegaconf import OmegaConf
 
 
@@ -39,6 +40,11 @@ class ConditionalCFM(BASECFM):
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
+        # Run the estimator's mid blocks on every n-th evaluation only, see DecoderPlan
+        self.deep_cache_interval = cfm_params.get("deep_cache_interval", 1)
+        # Only apply CFG when the estimator is evaluated at t in [start, end]. The other evaluations run the
+        # conditional half of the batch alone, at half the cost.
+        self.cfg_interval = tuple(cfm_params.get("cfg_interval", (0.0, 1.0)))
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
@@ -74,14 +80,12 @@ class ConditionalCFM(BASECFM):
         mu_cache = torch.concat([mu[:, :, :prompt_len], mu[:, :, -34:]], dim=2)
         flow_cache = torch.stack([z_cache, mu_cache], dim=-1)
 
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        t_span = make_t_span(n_timesteps, self.t_scheduler, device=mu.device, dtype=mu.dtype)
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond):
+    def solve(self, x, t_span, mu, mask, spks, cond):
         """
-        Fixed euler solver for ODEs.
+        Integrates the CFG velocity from noise to mel with `self.solver`, one of `ode_solvers.SOLVERS`.
         Args:
             x (torch.Tensor): random noise
             t_span (torch.Tensor): n_timesteps interpolated
@@ -94,55 +98,64 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
-
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+        if self.solver not in SOLVERS:
+            raise ValueError(f"Unknown solver: {self.solver}, expected one of {list(SOLVERS)}")
 
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        for step in range(1, len(t_span)):
+        # The batch runs as [cond rows | uncond rows]
+        batch_size = mu.size(0)
+        x_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in = torch.zeros([2 * batch_size, 1, x.size(2)], device=x.device, dtype=x.dtype)
+        mu_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        t_in = torch.zeros([2 * batch_size], device=x.device, dtype=x.dtype)
+        spks_in = torch.zeros([2 * batch_size, 80], device=x.device, dtype=x.dtype)
+        cond_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in[:batch_size] = mask
+        mask_in[batch_size:] = mask
+        mu_in[:batch_size] = mu
+        spks_in[:batch_size] = spks
+        cond_in[:batch_size] = cond
+
+        # Masks, conditioning and time embeddings are the same for every step, so the decoder only builds them once
+        plan = None
+        if isinstance(self.estimator, torch.nn.Module):
+            plan = self.estimator.make_plan(mask_in, mu_in, spks_in, cond_in, t_span, self.deep_cache_interval)
+
+        def velocity(x, t):
             # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
+            guided = self.inference_cfg_rate != 0 and self.cfg_interval[0] <= t <= self.cfg_interval[1]
+            n = 2 * batch_size if guided else batch_size
+            x_in[:batch_size] = x
+            if guided:
+                x_in[batch_size:] = x
+            if plan is None:
+                t_in[:] = t
             dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in
+                x_in[:n], mask_in[:n],
+                mu_in[:n], t if plan is not None else t_in[:n],
+                spks_in[:n],
+                cond_in[:n],
+                plan=plan,
             )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+            if not guided:
+                # The TRT engine writes its output into x_in, which the next evaluation overwrites
+                return dphi_dt if plan is not None else dphi_dt.clone()
+            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [batch_size, batch_size], dim=0)
+            return (1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt
 
-        return sol[-1].float()
+        return SOLVERS[self.solver](velocity, x, t_span).float()
 
-    def forward_estimator(self, x, mask, mu, t, spks, cond):
+    def forward_estimator(self, x, mask, mu, t, spks, cond, plan=None):
         if isinstance(self.estimator, torch.nn.Module):
-            return self.estimator.forward(x, mask, mu, t, spks, cond)
+            return self.estimator.forward(x, mask, mu, t, spks, cond, plan=plan)
         else:
             with self.lock:
-                self.estimator.set_input_shape('x', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                self.estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('t', (2,))
-                self.estimator.set_input_shape('spks', (2, 80))
-                self.estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                self.estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                self.estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('t', (x.size(0),))
+                self.estimator.set_input_shape('spks', (x.size(0), 80))
+                self.estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 # run trt engine
                 self.estimator.execute_v2([x.contiguous().data_ptr(),
                                            mask.contiguous().data_ptr(),
@@ -222,7 +235,5 @@ class CausalConditionalCFM(ConditionalCFM):
 
         z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+        t_span = make_t_span(n_timesteps, self.t_scheduler, device=mu.device, dtype=mu.dtype)
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
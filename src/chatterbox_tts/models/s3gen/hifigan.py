@@ -17,6 +17,7 @@
 
 """HIFI-GAN"""
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional, List
 import numpy as np
 from scipy.signal import get_window
@@ -24,8 +25,8 @@ import torch
 import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
-from torch.nn.utils import remove_weight_norm
 from torch.nn.utils.parametrizations import weight_norm
+from torch.nn.utils.parametrize import remove_parametrizations
 from torch.distributions.uniform import Uniform
 from torch import nn, sin, pow
 from torch.nn import Parameter
@@ -70,12 +71,30 @@ class Snake(nn.Module):
 
         self.no_div_by_zero = 0.000000001
 
+        # Set by freeze_for_inference
+        self.register_buffer("frozen_alpha", None, persistent=False)
+        self.register_buffer("frozen_inv_alpha", None, persistent=False)
+
+    def freeze_for_inference(self):
+        '''
+        Precompute alpha lined up with x, and 1 / alpha, instead of deriving them from the parameter on every call.
+        '''
+        with torch.no_grad():
+            alpha = self.alpha.detach().unsqueeze(0).unsqueeze(-1)
+            if self.alpha_logscale:
+                alpha = torch.exp(alpha)
+            self.frozen_alpha = alpha
+            self.frozen_inv_alpha = 1.0 / (alpha + self.no_div_by_zero)
+
     def forward(self, x):
         '''
         Forward pass of the function.
         Applies the function to the input elementwise.
         Snake ∶= x + 1/a * sin^2 (xa)
         '''
+        if self.frozen_alpha is not None:
+            return x + self.frozen_inv_alpha * pow(sin(x * self.frozen_alpha), 2)
+
         alpha = self.alpha.unsqueeze(0).unsqueeze(-1) # line up with x to [B, C, T]
         if self.alpha_logscale:
             alpha = torch.exp(alpha)
@@ -162,8 +181,8 @@ class ResBlock(torch.nn.Module):
 
     def remove_weight_norm(self):
         for idx in range(len(self.convs1)):
-            remove_weight_norm(self.convs1[idx])
-            remove_weight_norm(self.convs2[idx])
+            remove_parametrizations(self.convs1[idx], "weight")
+            remove_parametrizations(self.convs2[idx], "weight")
 
 
 class SineGen(torch.nn.Module):
@@ -307,6 +326,9 @@ class HiFTGenerator(nn.Module):
             lrelu_slope: float = 0.1,
             audio_limit: float = 0.99,
             f0_predictor: torch.nn.Module = None,
+            chunk_frames: int = 0,
+            chunk_overlap_frames: int = 16,
+            chunk_workers: int = 1,
     ):
         super(HiFTGenerator, self).__init__()
 
@@ -317,6 +339,12 @@ class HiFTGenerator(nn.Module):
         self.lrelu_slope = lrelu_slope
         self.audio_limit = audio_limit
 
+        # Chunked vocoding at inference, see `decode_chunked`. 0 vocodes the whole mel at once.
+        self.chunk_frames = chunk_frames
+        self.chunk_overlap_frames = chunk_overlap_frames
+        self.chunk_workers = chunk_workers
+        self.samples_per_frame = int(np.prod(upsample_rates) * istft_params["hop_len"])
+
         self.num_kernels = len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_rates)
         self.m_source = SourceModuleHnNSF(
@@ -376,23 +404,36 @@ class HiFTGenerator(nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
-        self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        # Non-persistent buffer, so it follows the module to its device without changing the state dict
+        stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        self.register_buffer("stft_window", stft_window, persistent=False)
         self.f0_predictor = f0_predictor
 
     def remove_weight_norm(self):
-        print('Removing weight norm...')
+        # The source branch (m_source, source_downs) has no weight norm
         for l in self.ups:
-            remove_weight_norm(l)
+            remove_parametrizations(l, "weight")
         for l in self.resblocks:
             l.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
-        remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
-        for l in self.source_downs:
-            remove_weight_norm(l)
+        remove_parametrizations(self.conv_pre, "weight")
+        remove_parametrizations(self.conv_post, "weight")
         for l in self.source_resblocks:
             l.remove_weight_norm()
 
+    def freeze_for_inference(self):
+        """
+        Bake the weight norms into plain conv weights and precompute the Snake activations' constants, which
+        otherwise get recomputed on every forward. The generator can no longer be trained afterwards.
+        """
+        self.eval()
+        self.remove_weight_norm()
+        if hasattr(self.f0_predictor, "remove_weight_norm"):
+            self.f0_predictor.remove_weight_norm()
+        for module in self.modules():
+            if isinstance(module, Snake):
+                module.freeze_for_inference()
+        self.requires_grad_(False)
+
     def _stft(self, x):
         spec = torch.stft(
             x,
@@ -443,6 +484,45 @@ class HiFTGenerator(nn.Module):
         x = torch.clamp(x, -self.audio_limit, self.audio_limit)
         return x
 
+    def decode_chunked(self, x: torch.Tensor, s: torch.Tensor) -> torch.Tensor:
+        """
+        `decode` over windows of `chunk_frames` mel frames, overlapping by `chunk_overlap_frames`, which are
+        cross-faded with the halves of a periodic hann window. The source excitation `s` is generated over the
+        whole mel beforehand and sliced along, so its phase carries across the windows. Each of the `chunk_workers`
+        threads only holds one window's audio-rate activations at a time, so peak memory no longer grows with the
+        length of the mel.
+        """
+        n_frames = x.size(2)
+        step = self.chunk_frames - self.chunk_overlap_frames
+        assert step > 0, "chunk_frames must be larger than chunk_overlap_frames"
+        starts = [0]
+        while starts[-1] + self.chunk_frames < n_frames:
+            starts.append(starts[-1] + step)
+
+        hop = self.samples_per_frame
+
+        def decode_window(start: int) -> torch.Tensor:
+            end = min(start + self.chunk_frames, n_frames)
+            # Inference mode is thread-local, so worker threads have to enter it themselves
+            with torch.inference_mode(torch.is_inference_mode_enabled()):
+                return self.decode(x=x[:, :, start:end], s=s[:, :, start * hop:end * hop])
+
+        if self.chunk_workers > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=self.chunk_workers) as pool:
+                wavs = list(pool.map(decode_window, starts))
+        else:
+            wavs = [decode_window(start) for start in starts]
+
+        overlap = self.chunk_overlap_frames * hop
+        window = torch.hann_window(2 * overlap, device=x.device, dtype=wavs[0].dtype)
+        output = wavs[0].new_zeros(x.size(0), n_frames * hop)
+        for start, wav in zip(starts, wavs):
+            begin = start * hop
+            if start > 0:
+                wav[:, :overlap] = wav[:, :overlap] * window[:overlap] + output[:, begin:begin + overlap] * window[overlap:]
+            output[:, begin:begin + wav.size(1)] = wav
+        return output
+
     def forward(
             self,
             batch: dict,
@@ -470,5 +550,8 @@ class HiFTGenerator(nn.Module):
         # use cache_source to avoid glitch
         if cache_source.shape[2] != 0:
             s[:, :, :cache_source.shape[2]] = cache_source
-        generated_speech = self.decode(x=speech_feat, s=s)
+        if 0 < self.chunk_frames < speech_feat.size(2):
+            generated_speech = self.decode_chunked(x=speech_feat, s=s)
+        else:
+            generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
@@ -2,6 +2,7 @@ from typing import Any, Dict, Optional
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from diffusers.models.attention import (
     GEGLU,
     GELU,
@@ -9,7 +10,7 @@ from diffusers.models.attention import (
     AdaLayerNormZero,
     ApproximateGELU,
 )
-from diffusers.models.attention_processor import Attention
+from diffusers.models.attention_processor import Attention, AttnProcessor
 from diffusers.models.lora import LoRACompatibleLinear
 from diffusers.utils.torch_utils import maybe_allow_in_graph
 
@@ -134,6 +135,46 @@ class FeedForward(nn.Module):
         return hidden_states
 
 
+class SDPAAttnProcessor:
+    """
+    diffusers' AttnProcessor2_0, cut down to the plain attention BasicTransformerBlock uses. The additive
+    (batch, 1 or time, time) mask is broadcast over the heads, rather than repeated for each one.
+    """
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        temb: Optional[torch.FloatTensor] = None,
+        *args,
+        **kwargs,
+    ) -> torch.FloatTensor:
+        batch_size = hidden_states.size(0)
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        head_dim = key.size(-1) // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        if attention_mask is not None:
+            attention_mask = attention_mask.unsqueeze(1)  # (batch, 1, 1 or time, time)
+
+        hidden_states = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+
+        hidden_states = attn.to_out[0](hidden_states)  # linear proj
+        hidden_states = attn.to_out[1](hidden_states)  # dropout
+        return hidden_states
+
+
 @maybe_allow_in_graph
 class BasicTransformerBlock(nn.Module):
     r"""
@@ -240,6 +281,13 @@ class BasicTransformerBlock(nn.Module):
         self._chunk_size = chunk_size
         self._chunk_dim = dim
 
+    def set_attention_backend(self, backend: str):
+        """Compute attention with explicit matmuls and softmax ("eager"), or F.scaled_dot_product_attention ("sdpa")"""
+        processor = SDPAAttnProcessor() if backend == "sdpa" else AttnProcessor()
+        for attn in (self.attn1, self.attn2):
+            if attn is not None:
+                attn.set_processor(processor)
+
     def forward(
         self,
         hidden_states: torch.FloatTensor,
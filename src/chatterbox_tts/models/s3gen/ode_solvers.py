@@ -0,0 +1,164 @@
+"""
+ODE solvers for the flow matching decoder.
+
+The CFM integrates dx/dt = v(x, t) from t = 0 (noise) to t = 1 (mel), where every evaluation of v is a full
+CFG-doubled ConditionalDecoder pass. Solvers are therefore compared by their number of function evaluations
+(NFE) rather than their number of steps; see benchmarks/bench_cfm_solvers.py.
+
+Every solver takes the velocity function, the initial noise and the time steps (from `make_t_span`), and
+returns the final sample. The adaptive solver only uses the first and last time step, and the spacing of the
+others as the initial step size.
+"""
+from typing import Callable
+import math
+
+import torch
+
+Velocity = Callable[[torch.Tensor, float], torch.Tensor]
+
+
+def make_t_span(n_timesteps: int, t_scheduler: str = "cosine", device=None, dtype=None) -> torch.Tensor:
+    """
+    Time steps from 0 to 1. `t_scheduler` is one of
+    - "linear": evenly spaced
+    - "cosine": 1 - cos(t * pi / 2), the CosyVoice default; small steps near the noise, large steps near the mel
+    - "sway:<s>": F5-TTS sway sampling, t + s * (cos(t * pi / 2) - 1 + t), with -1 <= s <= 1. s = -1 is cosine,
+      s = 0 is linear, and s > 0 moves the small steps towards the mel instead.
+    """
+    t_span = torch.linspace(0, 1, n_timesteps + 1, device=device, dtype=dtype)
+    if t_scheduler == "linear":
+        return t_span
+    if t_scheduler == "cosine":
+        return 1 - torch.cos(t_span * 0.5 * torch.pi)
+    if t_scheduler.startswith("sway:"):
+        s = float(t_scheduler[len("sway:"):])
+        if not -1 <= s <= 1:
+            # Outside this range the schedule is no longer monotonic
+            raise ValueError(f"Sway coefficient must be between -1 and 1, got {s}")
+        return t_span + s * (torch.cos(t_span * 0.5 * torch.pi) - 1 + t_span)
+    raise ValueError(f"Unknown t_scheduler: {t_scheduler}")
+
+
+def _steps(t_span: torch.Tensor) -> list[tuple[float, float]]:
+    # One host sync up front, instead of one per step
+    ts = t_span.tolist()
+    return list(zip(ts[:-1], ts[1:]))
+
+
+def solve_euler(velocity: Velocity, x: torch.Tensor, t_span: torch.Tensor) -> torch.Tensor:
+    """First order, 1 NFE per step"""
+    for t, t_next in _steps(t_span):
+        x = x + (t_next - t) * velocity(x, t)
+    return x
+
+
+def solve_midpoint(velocity: Velocity, x: torch.Tensor, t_span: torch.Tensor) -> torch.Tensor:
+    """Explicit midpoint, second order, 2 NFE per step"""
+    for t, t_next in _steps(t_span):
+        h = t_next - t
+        x = x + h * velocity(x + 0.5 * h * velocity(x, t), t + 0.5 * h)
+    return x
+
+
+def solve_heun(velocity: Velocity, x: torch.Tensor, t_span: torch.Tensor) -> torch.Tensor:
+    """Heun's method (explicit trapezoidal), second order, 2 NFE per step"""
+    for t, t_next in _steps(t_span):
+        h = t_next - t
+        v = velocity(x, t)
+        x = x + 0.5 * h * (v + velocity(x + h * v, t_next))
+    return x
+
+
+def solve_rk4(velocity: Velocity, x: torch.Tensor, t_span: torch.Tensor) -> torch.Tensor:
+    """Classic Runge-Kutta, fourth order, 4 NFE per step"""
+    for t, t_next in _steps(t_span):
+        h = t_next - t
+        k1 = velocity(x, t)
+        k2 = velocity(x + 0.5 * h * k1, t + 0.5 * h)
+        k3 = velocity(x + 0.5 * h * k2, t + 0.5 * h)
+        k4 = velocity(x + h * k3, t_next)
+        x = x + (h / 6) * (k1 + 2 * k2 + 2 * k3 + k4)
+    return x
+
+
+def solve_dpm_2m(velocity: Velocity, x: torch.Tensor, t_span: torch.Tensor) -> torch.Tensor:
+    """
+    DPM-Solver++(2M) (Lu et al., 2022), second order multistep, 1 NFE per step.
+
+    The flow path is x_t = (1 - t) * noise + t * mel (sigma_min is negligible), so alpha_t = t, sigma_t = 1 - t,
+    and the velocity gives the data prediction mel_hat = x + (1 - t) * v. Each step extrapolates mel_hat from the
+    last two steps, linearly in lambda = log(alpha / sigma). The first and last steps are first order; the last
+    one lands exactly on the data prediction.
+    """
+    def log_snr(t: float) -> float:
+        return -math.inf if t <= 0 else math.inf if t >= 1 else math.log(t / (1 - t))
+
+    previous = None  # (lambda, data prediction) of the previous step
+    for t, t_next in _steps(t_span):
+        data = x + (1 - t) * velocity(x, t)
+        if t_next >= 1:
+            x = data
+            continue
+
+        lam, lam_next = log_snr(t), log_snr(t_next)
+        if previous is None or not math.isfinite(previous[0]) or not math.isfinite(lam):
+            d = data
+        else:
+            r = (lam - previous[0]) / (lam_next - lam)
+            d = (1 + 1 / (2 * r)) * data - (1 / (2 * r)) * previous[1]
+
+        # exp(-h) = (sigma_next * alpha) / (alpha_next * sigma), which is 0 when starting from t = 0
+        exp_neg_h = ((1 - t_next) * t) / (t_next * (1 - t))
+        x = ((1 - t_next) / (1 - t)) * x + t_next * (1 - exp_neg_h) * d
+        previous = (lam, data)
+    return x
+
+
+def solve_adaptive(
+    velocity: Velocity,
+    x: torch.Tensor,
+    t_span: torch.Tensor,
+    rtol: float = 0.05,
+    atol: float = 0.05,
+    max_nfe: int = 64,
+) -> torch.Tensor:
+    """
+    Adaptive Bogacki-Shampine 3(2), 3 NFE per accepted step (the last evaluation is reused by the next step).
+    Starts with the first step of `t_span`, and adjusts the step size to keep the RMS of the local error
+    estimate below atol + rtol * |x|. Finishes in one step when another one would go over `max_nfe`.
+    """
+    ts = t_span.tolist()
+    t, t_end = ts[0], ts[-1]
+    h = ts[1] - ts[0]
+    nfe = 1
+    k1 = velocity(x, t)
+    while t < t_end:
+        h = min(h, t_end - t)
+        # Out of budget: the rest of the span goes in one step, which is accepted whatever its error
+        forced = nfe + 6 > max_nfe
+        if forced:
+            h = t_end - t
+
+        k2 = velocity(x + 0.5 * h * k1, t + 0.5 * h)
+        k3 = velocity(x + 0.75 * h * k2, t + 0.75 * h)
+        x_next = x + h * (2 / 9 * k1 + 1 / 3 * k2 + 4 / 9 * k3)
+        k4 = velocity(x_next, t + h)
+        nfe += 3
+
+        error = h * (-5 / 72 * k1 + 1 / 12 * k2 + 1 / 9 * k3 - 1 / 8 * k4)
+        scale = atol + rtol * torch.maximum(x.abs(), x_next.abs())
+        error_norm = (error / scale).pow(2).mean().sqrt().item()
+        if error_norm <= 1 or forced:
+            t, x, k1 = t + h, x_next, k4
+        h = h * min(5.0, max(0.2, 0.9 * error_norm ** (-1 / 3))) if error_norm > 0 else h * 5
+    return x
+
+
+SOLVERS: dict[str, Callable[..., torch.Tensor]] = {
+    "euler": solve_euler,
+    "midpoint": solve_midpoint,
+    "heun": solve_heun,
+    "rk4": solve_rk4,
+    "dpm_2m": solve_dpm_2m,
+    "adaptive": solve_adaptive,
+}
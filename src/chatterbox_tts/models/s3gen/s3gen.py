@@ -18,10 +18,11 @@ import numpy as np
 import torch
 import torchaudio as ta
 from functools import lru_cache
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 from omegaconf import DictConfig
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
+from ..s3tokenizer.s3tokenizer import group_by_length
 from .const import S3GEN_SR
 from .flow import CausalMaskedDiffWithXvec
 from .xvector import CAMPPlus
@@ -31,6 +32,8 @@ from .hifigan import HiFTGenerator
 from .transformer.upsample_encoder import UpsampleConformerEncoder
 from .flow_matching import CausalConditionalCFM
 from .decoder import ConditionalDecoder
+from .transformer.attention import MultiHeadedAttention
+from .matcha.transformer import BasicTransformerBlock
 
 
 def drop_invalid_tokens(x):
@@ -38,6 +41,14 @@ def drop_invalid_tokens(x):
     return x[x < SPEECH_VOCAB_SIZE]
 
 
+def fade_in_out(fade_in_wav: torch.Tensor, fade_out_wav: torch.Tensor, window: torch.Tensor) -> torch.Tensor:
+    """Cross-fade the start of `fade_in_wav` with the end of `fade_out_wav`, over half of `window` each"""
+    overlap = window.shape[0] // 2
+    fade_in_wav = fade_in_wav.clone()
+    fade_in_wav[..., :overlap] = fade_in_wav[..., :overlap] * window[:overlap] + fade_out_wav[..., -overlap:] * window[overlap:]
+    return fade_in_wav
+
+
 # TODO: global resampler cache
 @lru_cache(100)
 def get_resampler(src_sr, dst_sr, device):
@@ -50,7 +61,9 @@ class S3Token2Mel(torch.nn.Module):
 
     TODO: make these modules configurable?
     """
-    def __init__(self, use_fp16: bool = False):
+    def __init__(self, use_fp16: bool = False, solver: str = "euler", t_scheduler: str = "cosine", deep_cache_interval: int = 1,
+                 cfg_interval: tuple[float, float] = (0.0, 1.0), attention_backend: str = "sdpa",
+                 autocast_dtype: Optional[torch.dtype] = None):
         super().__init__()
         self.tokenizer = S3Tokenizer("speech_tokenizer_v2_25hz")
         self.mel_extractor = mel_spectrogram # TODO: make it a torch module?
@@ -87,8 +100,10 @@ class S3Token2Mel(torch.nn.Module):
         )
         cfm_params = DictConfig({
             "sigma_min": 1e-06,
-            "solver": 'euler',
-            "t_scheduler": 'cosine',
+            "solver": solver,
+            "t_scheduler": t_scheduler,
+            "deep_cache_interval": deep_cache_interval,
+            "cfg_interval": list(cfg_interval),
             "training_cfg_rate": 0.2,
             "inference_cfg_rate": 0.7,
             "reg_loss_type": 'l1',
@@ -106,6 +121,35 @@ class S3Token2Mel(torch.nn.Module):
         )
 
         self.resamplers = {}
+        self.set_attention_backend(attention_backend)
+
+        # The flow runs under autocast to this dtype if set (bf16 on CPU, say), its output mels are float32
+        self.autocast_dtype = autocast_dtype
+
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None)
+
+    def set_attention_backend(self, backend: str):
+        """
+        Compute the conformer encoder's and CFM decoder's attention with explicit matmuls and softmax ("eager"), or
+        with fused F.scaled_dot_product_attention kernels ("sdpa"), which never materialise the attention weights.
+        """
+        if backend not in ("eager", "sdpa"):
+            raise ValueError(f"Unknown attention backend: {backend}")
+        for module in self.flow.modules():
+            if isinstance(module, MultiHeadedAttention):
+                module.attention_backend = backend
+            elif isinstance(module, BasicTransformerBlock):
+                module.set_attention_backend(backend)
+
+    def freeze_for_inference(self):
+        """
+        One-off graph simplifications after the weights are loaded: BatchNorms folded into the speaker encoder's
+        convs, and gradients off everywhere. See benchmarks/bench_freeze.py.
+        """
+        self.eval()
+        self.speaker_encoder.freeze_for_inference()
+        self.requires_grad_(False)
 
     @property
     def device(self):
@@ -169,6 +213,60 @@ class S3Token2Mel(torch.nn.Module):
             embedding=ref_x_vector,
         )
 
+    def embed_ref_batch(
+        self,
+        ref_wavs_24: list[torch.Tensor],
+        ref_wavs_16: list[torch.Tensor],
+        device="auto",
+    ) -> list[dict]:
+        """
+        Batched `embed_ref` for many reference clips, already resampled to 24 kHz and 16 kHz.
+        The tokenizer runs as one padded batch with lengths. The mel and x-vector front ends aren't
+        length masked, so they run batched over clips of identical length instead.
+        """
+        device = self.device if device == "auto" else device
+        ref_wavs_24 = [torch.as_tensor(wav).float().flatten().to(device) for wav in ref_wavs_24]
+        ref_wavs_16 = [torch.as_tensor(wav).float().flatten().to(device) for wav in ref_wavs_16]
+
+        ref_mels_24 = [None] * len(ref_wavs_24)
+        for idxs in group_by_length(ref_wavs_24):
+            mels = self.mel_extractor(torch.stack([ref_wavs_24[i] for i in idxs])).transpose(1, 2)
+            for i, mel in zip(idxs, mels):
+                ref_mels_24[i] = mel.unsqueeze(0)
+
+        # Speaker embedding
+        ref_x_vectors = [None] * len(ref_wavs_16)
+        for idxs in group_by_length(ref_wavs_16):
+            x_vectors = self.speaker_encoder.inference(torch.stack([ref_wavs_16[i] for i in idxs]))
+            for i, x_vector in zip(idxs, x_vectors):
+                ref_x_vectors[i] = x_vector.unsqueeze(0)
+
+        # Tokenize 16khz references
+        ref_speech_tokens, ref_speech_token_lens = self.tokenizer(ref_wavs_16)
+
+        ref_dicts = []
+        for i in range(len(ref_wavs_24)):
+            speech_tokens = ref_speech_tokens[i:i + 1, :ref_speech_token_lens[i]]
+            speech_token_lens = ref_speech_token_lens[i:i + 1]
+
+            # Make sure mel_len = 2 * stoken_len (happens when the input is not padded to multiple of 40ms)
+            if ref_mels_24[i].shape[1] != 2 * speech_tokens.shape[1]:
+                logging.warning(
+                    "Reference mel length is not equal to 2 * reference token length.\n"
+                )
+                speech_tokens = speech_tokens[:, :ref_mels_24[i].shape[1] // 2]
+                speech_token_lens = speech_token_lens.clone()
+                speech_token_lens[0] = speech_tokens.shape[1]
+
+            ref_dicts.append(dict(
+                prompt_token=speech_tokens.to(device),
+                prompt_token_len=speech_token_lens,
+                prompt_feat=ref_mels_24[i],
+                prompt_feat_len=None,
+                embedding=ref_x_vectors[i],
+            ))
+        return ref_dicts
+
     def forward(
         self,
         speech_tokens: torch.LongTensor,
@@ -214,14 +312,15 @@ class S3Token2Mel(torch.nn.Module):
         # assert speech_tokens.shape[0] == 1, "only batch size of one allowed for now"
         speech_token_lens = torch.LongTensor([speech_tokens.size(1)]).to(self.device)
 
-        output_mels, _ = self.flow.inference(
-            token=speech_tokens,
-            token_len=speech_token_lens,
-            finalize=finalize,
-            n_timesteps=n_timesteps,
-            **ref_dict,
-        )
-        return output_mels
+        with self.autocast():
+            output_mels, _ = self.flow.inference(
+                token=speech_tokens,
+                token_len=speech_token_lens,
+                finalize=finalize,
+                n_timesteps=n_timesteps,
+                **ref_dict,
+            )
+        return output_mels.float()
 
 
 class S3Token2Wav(S3Token2Mel):
@@ -231,8 +330,14 @@ class S3Token2Wav(S3Token2Mel):
     TODO: make these modules configurable?
     """
 
-    def __init__(self, use_fp16: bool = False):
-        super().__init__(use_fp16=use_fp16)
+    def __init__(self, use_fp16: bool = False, solver: str = "euler", t_scheduler: str = "cosine", deep_cache_interval: int = 1,
+                 cfg_interval: tuple[float, float] = (0.0, 1.0), attention_backend: str = "sdpa",
+                 hift_chunk_frames: int = 0, hift_chunk_workers: int = 1, autocast_dtype: Optional[torch.dtype] = None):
+        super().__init__(
+            use_fp16=use_fp16, solver=solver, t_scheduler=t_scheduler,
+            deep_cache_interval=deep_cache_interval, cfg_interval=cfg_interval, attention_backend=attention_backend,
+            autocast_dtype=autocast_dtype,
+        )
 
         f0_predictor = ConvRNNF0Predictor()
         self.mel2wav = HiFTGenerator(
@@ -242,6 +347,8 @@ class S3Token2Wav(S3Token2Mel):
             source_resblock_kernel_sizes=[7, 7, 11],
             source_resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
             f0_predictor=f0_predictor,
+            chunk_frames=hift_chunk_frames,
+            chunk_workers=hift_chunk_workers,
         )
 
         # silence out a few ms and fade audio in to reduce artifacts
@@ -250,6 +357,22 @@ class S3Token2Wav(S3Token2Mel):
         trim_fade[n_trim:] = (torch.cos(torch.linspace(torch.pi, 0, n_trim)) + 1) / 2
         self.register_buffer("trim_fade", trim_fade, persistent=False) # (buffers get automatic device casting)
 
+        # Streaming (see `inference_stream`): HiFT re-renders the last `mel_cache_len` mel frames of the previous
+        # chunk, reusing its source excitation, and the overlapping audio is cross-faded. CosyVoice uses a hamming
+        # window; a periodic hann window's halves sum to exactly 1, so the overlap keeps its level.
+        self.mel_cache_len = 8
+        self.source_cache_len = self.mel_cache_len * 480  # 480 samples per mel frame at 24 kHz
+        self.register_buffer("speech_window", torch.hann_window(2 * self.source_cache_len), persistent=False)
+
+    def freeze_for_inference(self):
+        """
+        One-off graph simplifications after the weights are loaded: BatchNorms folded into the speaker encoder's
+        convs, weight norm baked into HiFT's and the F0 predictor's convs, Snake constants precomputed, and
+        gradients off everywhere. See benchmarks/bench_freeze.py.
+        """
+        super().freeze_for_inference()
+        self.mel2wav.freeze_for_inference()
+
     def forward(
         self,
         speech_tokens,
@@ -315,3 +438,139 @@ class S3Token2Wav(S3Token2Mel):
             output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        speech_tokens: list[torch.Tensor],
+        ref_dicts: list[dict],
+        n_timesteps: int = 10,
+        max_batch_size: int = 16,
+        max_batch_tokens: int = 4096,
+    ) -> list[torch.Tensor]:
+        """
+        Batched `inference` over many utterances, each with its own speech tokens and reference.
+        Utterances are sorted by length (prompt included) and split into buckets of up to `max_batch_size`
+        utterances and `max_batch_tokens` padded tokens, so the flow and HiFT run once per bucket with little
+        padding. Returns the [1, T] waveforms, in order.
+
+        The flow is masked throughout, so each mel matches what `inference` would render. HiFT's convolutions
+        aren't causal, so only the last few milliseconds of a shorter utterance can see its padding.
+        """
+        speech_tokens = [t.to(self.device).view(-1) for t in speech_tokens]
+        lengths = [len(t) + ref_dict["prompt_token"].shape[-1] for t, ref_dict in zip(speech_tokens, ref_dicts)]
+
+        buckets = [[]]
+        for i in sorted(range(len(speech_tokens)), key=lambda i: lengths[i]):
+            # Sorted, so the utterance being added is the longest in the bucket
+            if buckets[-1] and (len(buckets[-1]) >= max_batch_size or (len(buckets[-1]) + 1) * lengths[i] > max_batch_tokens):
+                buckets.append([])
+            buckets[-1].append(i)
+
+        output_wavs = [None] * len(speech_tokens)
+        for bucket in buckets:
+            wavs = self._inference_bucket([speech_tokens[i] for i in bucket], [ref_dicts[i] for i in bucket], n_timesteps)
+            for i, wav in zip(bucket, wavs):
+                output_wavs[i] = wav
+        return output_wavs
+
+    def _inference_bucket(self, speech_tokens: list[torch.Tensor], ref_dicts: list[dict], n_timesteps: int) -> list[torch.Tensor]:
+        def pad(tensors: list[torch.Tensor]) -> torch.Tensor:
+            return torch.nn.utils.rnn.pad_sequence(tensors, batch_first=True)
+
+        def lengths(tensors: list[torch.Tensor]) -> torch.Tensor:
+            return torch.tensor([len(t) for t in tensors], device=self.device)
+
+        # type/device casting (all values will be numpy if it's from a prod API call)
+        ref_dicts = [
+            {k: torch.as_tensor(v).to(self.device) for k, v in ref_dict.items() if v is not None}
+            for ref_dict in ref_dicts
+        ]
+        prompt_tokens = [ref_dict["prompt_token"].view(-1) for ref_dict in ref_dicts]
+        prompt_feats = [ref_dict["prompt_feat"][0] for ref_dict in ref_dicts]
+
+        with self.autocast():
+            output_mels, output_mel_lens = self.flow.inference(
+                token=pad(speech_tokens),
+                token_len=lengths(speech_tokens),
+                prompt_token=pad(prompt_tokens),
+                prompt_token_len=lengths(prompt_tokens),
+                prompt_feat=pad(prompt_feats),
+                prompt_feat_len=lengths(prompt_feats),
+                embedding=torch.cat([ref_dict["embedding"] for ref_dict in ref_dicts], dim=0),
+                finalize=True,
+                n_timesteps=n_timesteps,
+            )
+        output_wavs, _ = self.hift_inference(output_mels.float())
+
+        wavs = []
+        samples_per_frame = output_wavs.shape[1] // output_mels.shape[2]
+        for wav, mel_len in zip(output_wavs, output_mel_lens.tolist()):
+            wav = wav[None, :mel_len * samples_per_frame].clone()
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            wav[:, :len(self.trim_fade)] *= self.trim_fade
+            wavs.append(wav)
+        return wavs
+
+    @torch.inference_mode()
+    def inference_stream(
+        self,
+        speech_tokens: Iterable[torch.Tensor],
+        ref_dict: dict,
+        n_timesteps: int = 10,
+        token_hop_len: int = 25,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Streaming version of `inference`. Consumes speech tokens while they are being generated (an iterable of
+        tensors holding the newly generated tokens), and yields a [1, T] waveform chunk every `token_hop_len` tokens,
+        as soon as the `pre_lookahead_len` tokens after them are available too. Concatenated, the chunks make up
+        the whole utterance, with the last one yielded once `speech_tokens` is exhausted.
+
+        Like CosyVoice2's streaming, the flow runs over all of the tokens so far with `finalize=False`, and only the
+        mel frames of the new tokens are kept. The flow therefore costs O(n^2) over an utterance, but the prompt
+        and earlier tokens stay in context, and the fixed noise of CausalConditionalCFM keeps chunks consistent.
+        HiFT re-renders the last `mel_cache_len` mel frames of the previous chunk with its `cache_source`, and
+        the overlap is cross-faded, so there are no clicks at the chunk boundaries.
+        """
+        token_mel_ratio = self.flow.token_mel_ratio
+        pre_lookahead_len = self.flow.pre_lookahead_len
+
+        tokens = torch.zeros(1, 0, dtype=torch.long, device=self.device)
+        token_offset = 0
+        hift_cache = None  # (mel, source, speech) held back from the previous chunk
+
+        def render(finalize: bool) -> torch.Tensor:
+            nonlocal hift_cache
+            end = tokens.shape[1] if finalize else token_offset + token_hop_len + pre_lookahead_len
+            output_mels = self.flow_inference(tokens[:, :end], ref_dict=ref_dict, finalize=finalize, n_timesteps=n_timesteps)
+            output_mels = output_mels[:, :, token_offset * token_mel_ratio:]
+
+            if hift_cache is None:
+                output_wavs, output_sources = self.hift_inference(output_mels)
+                # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+                output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
+            else:
+                cache_mels, cache_source, cache_wavs = hift_cache
+                output_mels = torch.cat([cache_mels, output_mels], dim=2)
+                output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
+                output_wavs = fade_in_out(output_wavs, cache_wavs, self.speech_window)
+
+            if finalize:
+                return output_wavs
+
+            # Hold back the tail, it gets re-rendered and faded into the next chunk
+            hift_cache = (
+                output_mels[:, :, -self.mel_cache_len:],
+                output_sources[:, :, -self.source_cache_len:],
+                output_wavs[:, -self.source_cache_len:],
+            )
+            return output_wavs[:, :-self.source_cache_len]
+
+        for new_tokens in speech_tokens:
+            tokens = torch.cat([tokens, new_tokens.to(self.device).view(1, -1)], dim=1)
+            while tokens.shape[1] - token_offset >= token_hop_len + pre_lookahead_len:
+                yield render(finalize=False)
+                token_offset += token_hop_len
+
+        if tokens.shape[1] > 0:
+            yield render(finalize=True)
@@ -17,9 +17,10 @@
 """Multi-Head Attention layer definition."""
 
 import math
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 
@@ -49,6 +50,8 @@ class MultiHeadedAttention(nn.Module):
         self.linear_v = nn.Linear(n_feat, n_feat)
         self.linear_out = nn.Linear(n_feat, n_feat)
         self.dropout = nn.Dropout(p=dropout_rate)
+        # "eager" computes attention with explicit matmuls and softmax, "sdpa" with F.scaled_dot_product_attention
+        self.attention_backend = "eager"
 
     def forward_qkv(
         self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor
@@ -126,6 +129,44 @@ class MultiHeadedAttention(nn.Module):
 
         return self.linear_out(x)  # (batch, time1, d_model)
 
+    def forward_attention_sdpa(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+        bias: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """`forward_attention` through F.scaled_dot_product_attention, without materialising the softmax.
+
+        Args:
+            query (torch.Tensor): Transformed query, size (#batch, n_head, time1, d_k).
+            key (torch.Tensor): Transformed key, size (#batch, n_head, time2, d_k).
+            value (torch.Tensor): Transformed value, size (#batch, n_head, time2, d_k).
+            mask (torch.Tensor): Mask, size (#batch, 1, time2) or
+                (#batch, time1, time2), (0, 0, 0) means fake mask.
+            bias (torch.Tensor, optional): Added to the scaled scores, size
+                (#batch, n_head, time1, time2).
+
+        Returns:
+            torch.Tensor: Transformed value (#batch, time1, d_model).
+
+        """
+        n_batch = value.size(0)
+        if mask.size(2) > 0:  # time2 > 0
+            mask = mask.unsqueeze(1).eq(0)[:, :, :, :key.size(2)]  # (batch, 1, *, time2)
+            # A finite minimum rather than -inf, so fully masked rows stay finite, like the zeros of the eager path
+            if bias is None:
+                bias = torch.zeros(mask.shape, dtype=query.dtype, device=query.device)
+            bias = bias.masked_fill(mask, torch.finfo(query.dtype).min)
+
+        x = F.scaled_dot_product_attention(
+            query, key, value, attn_mask=bias,
+            dropout_p=self.dropout.p if self.training else 0.0,
+        )  # (batch, head, time1, d_k)
+        x = x.transpose(1, 2).contiguous().view(n_batch, -1, self.h * self.d_k)  # (batch, time1, d_model)
+        return self.linear_out(x)
+
     def forward(
         self,
         query: torch.Tensor,
@@ -193,6 +234,9 @@ class MultiHeadedAttention(nn.Module):
         #   non-trivial to calculate `next_cache_start` here.
         new_cache = torch.cat((k, v), dim=-1)
 
+        if self.attention_backend == "sdpa":
+            return self.forward_attention_sdpa(q, k, v, mask), new_cache
+
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
 
@@ -311,6 +355,14 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # (batch, head, time1, d_k)
         q_with_bias_v = (q + self.pos_bias_v.to(q.device)).transpose(1, 2)
 
+        if self.attention_backend == "sdpa":
+            # Only the position term is materialised, and goes in as a bias on top of the fused content term
+            matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
+            if matrix_bd.size(-1) != k.size(2):
+                matrix_bd = self.rel_shift(matrix_bd)
+            bias = matrix_bd / math.sqrt(self.d_k)
+            return self.forward_attention_sdpa(q_with_bias_u, k, v, mask, bias), new_cache
+
         # compute attention score
         # first compute matrix a and matrix c
         # as described in https://arxiv.org/abs/1901.02860 Section 3.3
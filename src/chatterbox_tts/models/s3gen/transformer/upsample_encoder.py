@@ -277,6 +277,9 @@ class UpsampleConformerEncoder(torch.nn.Module):
                                               self.static_chunk_size,
                                               num_decoding_left_chunks)
         # lookahead + conformer encoder
+        # Zero the padding first, so the lookahead at the end of a shorter sequence in a batch sees the same
+        # zeros as it would without padding
+        xs = xs * mask_pad.transpose(1, 2)
         xs = self.pre_lookahead_layer(xs)
         xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
@@ -9,6 +9,7 @@ from collections import OrderedDict
 import torch
 import torch.nn.functional as F
 import torch.utils.checkpoint as cp
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import torchaudio.compliance.kaldi as Kaldi
 
 
@@ -143,6 +144,18 @@ def get_nonlinear(config_str, channels):
     return nonlinear
 
 
+def fold_batchnorm(conv: torch.nn.Module, nonlinear: torch.nn.Sequential) -> torch.nn.Module:
+    """
+    Fold the BatchNorm at the start of `nonlinear` (from `get_nonlinear`) into the preceding `conv`, and drop it
+    from `nonlinear`. Returns the fused conv, or `conv` unchanged if `nonlinear` does not start with a BatchNorm.
+    """
+    if len(nonlinear) == 0 or not isinstance(nonlinear[0], torch.nn.BatchNorm1d):
+        return conv
+    conv = fuse_conv_bn_eval(conv, nonlinear[0])
+    nonlinear[0] = torch.nn.Identity()
+    return conv
+
+
 def statistics_pooling(x, dim=-1, keepdim=False, unbiased=True, eps=1e-2):
     mean = x.mean(dim=dim)
     std = x.std(dim=dim, unbiased=unbiased)
@@ -414,6 +427,32 @@ class CAMPPlus(torch.nn.Module):
                 if m.bias is not None:
                     torch.nn.init.zeros_(m.bias)
 
+    @torch.no_grad()
+    def freeze_for_inference(self):
+        """
+        Fold every BatchNorm that directly follows a conv into that conv's weights and bias. The BatchNorms in front
+        of a ReLU and a conv (the pre-activations of the dense and transit layers) stay as they are.
+        """
+        self.eval()
+        for module in list(self.modules()):
+            if isinstance(module, (BasicResBlock, FCM)):
+                module.conv1 = fuse_conv_bn_eval(module.conv1, module.bn1)
+                module.bn1 = torch.nn.Identity()
+                module.conv2 = fuse_conv_bn_eval(module.conv2, module.bn2)
+                module.bn2 = torch.nn.Identity()
+                if isinstance(module, BasicResBlock) and len(module.shortcut) == 2:
+                    module.shortcut = torch.nn.Sequential(fuse_conv_bn_eval(module.shortcut[0], module.shortcut[1]))
+            elif isinstance(module, (TDNNLayer, DenseLayer)):
+                module.linear = fold_batchnorm(module.linear, module.nonlinear)
+            elif isinstance(module, CAMDenseTDNNLayer):
+                module.linear1 = fold_batchnorm(module.linear1, module.nonlinear2)
+
+        # The output BatchNorm follows the conv of the last transit layer
+        transits = [module for name, module in self.xvector.named_children() if name.startswith("transit")]
+        if transits and hasattr(self.xvector, "out_nonlinear"):
+            transits[-1].linear = fold_batchnorm(transits[-1].linear, self.xvector.out_nonlinear)
+        self.requires_grad_(False)
+
     def forward(self, x):
         x = x.permute(0, 2, 1)  # (B,T,F) => (B,F,T)
         x = self.head(x)
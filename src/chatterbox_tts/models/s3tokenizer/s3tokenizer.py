@@ -19,6 +19,18 @@ S3_TOKEN_RATE = 25
 SPEECH_VOCAB_SIZE = 6561
 
 
+def group_by_length(seqs) -> List[List[int]]:
+    """
+    Group the indices of `seqs` by their length along the last dim.
+    Used to batch front ends that aren't length masked (STFT edge padding, per-clip normalisation, pooling),
+    so every batch runs on unpadded inputs and gives exactly the same result as one-by-one processing.
+    """
+    groups = {}
+    for i, seq in enumerate(seqs):
+        groups.setdefault(seq.shape[-1], []).append(i)
+    return list(groups.values())
+
+
 class S3Tokenizer(S3TokenizerV2):
     """
     s3tokenizer.S3TokenizerV2 with the following changes:
@@ -105,13 +117,15 @@ class S3Tokenizer(S3TokenizerV2):
         NOTE: please pad the waveform if longer sequence is needed.
         """
         processed_wavs = self._prepare_audio(wavs)
-        mels, mel_lens = [], []
-        for wav in processed_wavs:
-            wav = wav.to(self.device)
-            mel = self.log_mel_spectrogram(wav)  # [B=1, F, T]
+        mels = [None] * len(processed_wavs)
+        # Wavs of the same length share one batched STFT
+        for idxs in group_by_length(processed_wavs):
+            batch = torch.cat([processed_wavs[i] for i in idxs]).to(self.device)
+            batch_mels = self.log_mel_spectrogram(batch)  # [B, F, T]
             if max_len is not None:
-                mel = mel[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
-            mels.append(mel.squeeze(0))
+                batch_mels = batch_mels[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
+            for i, mel in zip(idxs, batch_mels):
+                mels[i] = mel
 
         mels, mel_lens = padding(mels)
         if accelerator is None:
@@ -163,6 +177,7 @@ class S3Tokenizer(S3TokenizerV2):
         mel_spec = self._mel_filters.to(self.device) @ magnitudes
 
         log_spec = torch.clamp(mel_spec, min=1e-10).log10()
-        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        # Dynamic range is limited per clip, so that batched clips don't affect each other
+        log_spec = torch.maximum(log_spec, log_spec.amax(dim=(-2, -1), keepdim=True) - 8.0)
         log_spec = (log_spec + 4.0) / 4.0
         return log_spec
@@ -1,6 +1,12 @@
-from .t3 import T3VllmModel, SPEECH_TOKEN_OFFSET
-from vllm import ModelRegistry
-from vllm.transformers_utils.tokenizer_base import TokenizerRegistry
+try:
+    from vllm import ModelRegistry
+    from vllm.transformers_utils.tokenizer_base import TokenizerRegistry
+except ImportError:
+    # Only T3VllmEngine needs vLLM, the torch and mock engines (see engine.py) run without it
+    ModelRegistry = None
 
-ModelRegistry.register_model("ChatterboxT3", T3VllmModel)
-TokenizerRegistry.register("EnTokenizer", "chatterbox_tts.models.t3.entokenizer", "EnTokenizer")
+if ModelRegistry is not None:
+    from .t3 import T3VllmModel, PREFILL_TOKEN_OFFSET
+
+    ModelRegistry.register_model("ChatterboxT3", T3VllmModel)
+    TokenizerRegistry.register("EnTokenizer", "chatterbox_tts.models.t3.entokenizer", "EnTokenizer")
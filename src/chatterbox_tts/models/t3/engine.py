@@ -0,0 +1,264 @@
+"""
+The T3 engines ChatterboxTTS decodes speech tokens with.
+
+`T3Engine` is the interface: requests are submitted with their text and conditionals embedding, and the engine is
+stepped (directly or through `stream`) until they finish, with at most `capacity` sequences decoding at a time.
+- `T3VllmEngine` runs T3VllmModel in vLLM, on CUDA.
+- `T3TorchEngine` (t3_torch.py) runs an eager PyTorch port of T3, e.g. on CPU.
+- `T3MockEngine` runs no model at all. It emits deterministic tokens at a fixed rate, to load test the scheduler,
+  the server and S3Gen without a GPU.
+
+vLLM is imported lazily, so the torch and mock engines work without it.
+"""
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional
+import time
+import zlib
+
+import torch
+
+from .modules.input_layout import CONDITIONING_SIZE
+from .modules.t3_config import T3Config
+
+
+# vllm.SamplingParams for T3VllmEngine, T3SamplingParams for the other engines
+SamplingParams = Any
+
+
+@dataclass
+class T3SamplingParams:
+    """The fields of vllm.SamplingParams that ChatterboxTTS uses, with vLLM's defaults"""
+    n: int = 1
+    temperature: float = 1.0
+    top_p: float = 1.0
+    top_k: int = 0  # 0 or -1 disables it
+    min_p: float = 0.0
+    seed: Optional[int] = None
+    presence_penalty: float = 0.0
+    frequency_penalty: float = 0.0
+    repetition_penalty: float = 1.0
+    max_tokens: Optional[int] = 16
+    min_tokens: int = 0
+    stop_token_ids: list[int] = field(default_factory=list)
+
+
+@dataclass
+class T3CompletionOutput:
+    token_ids: list[int]
+
+
+@dataclass
+class T3RequestOutput:
+    """The fields of vLLM's RequestOutput that ChatterboxTTS reads"""
+    request_id: str
+    outputs: list[T3CompletionOutput]
+    finished: bool
+
+
+class T3Engine(ABC):
+    # Set by engines whose tokens aren't samples of T3, so the token cache keeps them apart, see SpeechCache.token_key
+    cache_tag: Optional[str] = None
+    # Classifier-free guidance weight T3 samples with, part of the token cache key
+    cfg_scale: float = 0.5
+
+    @property
+    @abstractmethod
+    def capacity(self) -> int:
+        """Maximum number of sequences decoded at once. Further requests wait for a free slot."""
+
+    @abstractmethod
+    def make_sampling_params(self, *args, **kwargs) -> SamplingParams:
+        """Sampling params in the form this engine takes, from the arguments of vllm.SamplingParams"""
+
+    @abstractmethod
+    def submit(self, request_id: str, prompt: str, cond_emb: torch.Tensor, sampling_params: SamplingParams):
+        """Queue a request. `prompt` is the normalized text, with its [START] and [STOP] tokens."""
+
+    @abstractmethod
+    def step(self) -> list[T3RequestOutput]:
+        """Run one decoding step, returning the outputs of the requests that progressed, with all their tokens so far"""
+
+    @abstractmethod
+    def abort(self, request_ids: list[str]):
+        ...
+
+    @abstractmethod
+    def has_unfinished_requests(self) -> bool:
+        ...
+
+    def stream(self, request_ids: Iterable[str]) -> Iterator[T3RequestOutput]:
+        """
+        Step the engine until the given requests finish, yielding each of their outputs. Outputs of other requests
+        are dropped, so only one caller can drive the engine at a time. Requests still unfinished when the caller
+        stops iterating are aborted.
+        """
+        pending = set(request_ids)
+        try:
+            while pending:
+                for request_output in self.step():
+                    if request_output.request_id not in pending:
+                        continue
+                    if request_output.finished:
+                        pending.discard(request_output.request_id)
+                    yield request_output
+        finally:
+            # The caller went away mid-batch; don't leave its requests decoding in the engine
+            if pending:
+                self.abort(list(pending))
+
+    def shutdown(self):
+        pass
+
+
+class T3VllmEngine(T3Engine):
+    """T3VllmModel served by a vLLM `LLM`, driven through its LLMEngine"""
+    def __init__(self, llm, cfg_scale: float = 0.5):
+        self.llm = llm
+        self.cfg_scale = cfg_scale
+
+    @classmethod
+    def from_model_dir(cls, model_dir: str | Path, max_model_len: int, max_batch_size: int, cfg_scale: float,
+                       compile: bool = False, **kwargs) -> 'T3VllmEngine':
+        """`model_dir` holds the vLLM config of T3 and its weights, see ChatterboxTTS.from_pretrained"""
+        from vllm import LLM
+
+        total_gpu_memory = torch.cuda.get_device_properties(0).total_memory
+        unused_gpu_memory = total_gpu_memory - torch.cuda.memory_allocated()
+
+        # Heuristic: rough calculation for what percentage of GPU memory to give to vLLM.
+        # Tune this until the 'Maximum concurrency for ___ tokens per request: ___x' is just over 1.
+        # This rough heuristic gives 1.55GB for the model weights plus 128KB per token.
+        vllm_memory_needed = (1.55*1024*1024*1024) + (max_batch_size * max_model_len * 1024 * 128)
+        vllm_memory_percent = vllm_memory_needed / unused_gpu_memory
+
+        print(f"Giving vLLM {vllm_memory_percent * 100:.2f}% of GPU memory ({vllm_memory_needed / 1024**2:.2f} MB)")
+
+        base_vllm_kwargs = {
+            "model": str(model_dir),
+            "task": "generate",
+            "tokenizer": "EnTokenizer",
+            "tokenizer_mode": "custom",
+            "gpu_memory_utilization": vllm_memory_percent,
+            "enforce_eager": not compile,
+            "max_model_len": max_model_len,
+
+            # Prompts in the same voice share their conditioning prefix, see T3MultiModalProcessor.apply
+            "enable_prefix_caching": True,
+
+            # The hidden size in t3-model/config.json is doubled to carry the CFG uncond half, see T3VllmModel
+            "hf_overrides": {
+                "cfg_scale": cfg_scale,
+                "hidden_size": T3Config.n_channels * (2 if cfg_scale != 0 else 1),
+            },
+        }
+
+        return cls(LLM(**{**base_vllm_kwargs, **kwargs}), cfg_scale=cfg_scale)
+
+    @property
+    def capacity(self) -> int:
+        return self.llm.llm_engine.vllm_config.scheduler_config.max_num_seqs
+
+    def make_sampling_params(self, *args, **kwargs) -> SamplingParams:
+        from vllm import SamplingParams as VllmSamplingParams
+        return VllmSamplingParams(*args, **kwargs)
+
+    def submit(self, request_id: str, prompt: str, cond_emb: torch.Tensor, sampling_params: SamplingParams):
+        self.llm.llm_engine.add_request(
+            request_id,
+            {
+                "prompt": prompt,
+                "multi_modal_data": {
+                    "conditionals": [cond_emb],
+                },
+            },
+            sampling_params,
+        )
+
+    def step(self) -> list[T3RequestOutput]:
+        return self.llm.llm_engine.step()
+
+    def abort(self, request_ids: list[str]):
+        self.llm.llm_engine.abort_request(request_ids)
+
+    def has_unfinished_requests(self) -> bool:
+        return self.llm.llm_engine.has_unfinished_requests()
+
+    def shutdown(self):
+        del self.llm
+
+
+@dataclass
+class T3MockSequence:
+    request_id: str
+    token_ids: list[int]  # The whole output, drawn on submission
+    num_emitted: int = 0
+
+
+class T3MockEngine(T3Engine):
+    """
+    Stands in for T3 without any weights. Each request's output is pseudo-random speech tokens seeded by its text
+    and sampling seed, about `tokens_per_char` per character of text, ending in a stop token unless `max_tokens` or
+    `max_model_len` cut it short.
+    Every step takes 1 / `tokens_per_second` and emits one token for each running sequence, like a GPU decoder
+    whose step time barely depends on the batch size. Up to `max_batch_size` sequences run at once.
+    """
+    cache_tag = "mock"
+
+    def __init__(self, max_model_len: int = 1000, max_batch_size: int = 10, tokens_per_second: float = 50.0,
+                 # S3Gen renders 25 speech tokens per second of audio, and speech runs at ~15 characters per second
+                 tokens_per_char: float = 1.7):
+        self.max_model_len = max_model_len
+        self.max_batch_size = max_batch_size
+        self.tokens_per_second = tokens_per_second
+        self.tokens_per_char = tokens_per_char
+        self.waiting: list[T3MockSequence] = []
+        self.running: list[T3MockSequence] = []
+        print(f"[T3] Mock backend, {tokens_per_second:.1f} tokens/s per sequence")
+
+    @property
+    def capacity(self) -> int:
+        return self.max_batch_size
+
+    def make_sampling_params(self, *args, **kwargs) -> T3SamplingParams:
+        return T3SamplingParams(*args, **kwargs)
+
+    def submit(self, request_id: str, prompt: str, cond_emb: torch.Tensor, sampling_params: T3SamplingParams):
+        if sampling_params.n != 1:
+            raise ValueError("The mock T3 backend only supports n=1")
+
+        generator = torch.Generator().manual_seed(zlib.crc32(f"{sampling_params.seed}:{prompt}".encode()))
+        num_tokens = max(1, round(len(prompt) * self.tokens_per_char))
+        token_ids = torch.randint(0, T3Config.start_speech_token, (num_tokens,), generator=generator).tolist()
+        token_ids += sampling_params.stop_token_ids[:1]
+
+        # Same estimate of the prompt length as BatchScheduler's
+        max_tokens = self.max_model_len - CONDITIONING_SIZE - len(prompt)
+        if sampling_params.max_tokens is not None:
+            max_tokens = min(max_tokens, sampling_params.max_tokens)
+        self.waiting.append(T3MockSequence(request_id, token_ids[:max(1, max_tokens)]))
+
+    def step(self) -> list[T3RequestOutput]:
+        if not self.has_unfinished_requests():
+            return []
+        time.sleep(1 / self.tokens_per_second)
+
+        while self.waiting and len(self.running) < self.max_batch_size:
+            self.running.append(self.waiting.pop(0))
+
+        outputs = []
+        for seq in self.running:
+            seq.num_emitted += 1
+            finished = seq.num_emitted == len(seq.token_ids)
+            outputs.append(T3RequestOutput(seq.request_id, [T3CompletionOutput(seq.token_ids[:seq.num_emitted])], finished))
+        self.running = [seq for seq in self.running if seq.num_emitted < len(seq.token_ids)]
+        return outputs
+
+    def abort(self, request_ids: list[str]):
+        request_ids = set(request_ids)
+        self.waiting = [seq for seq in self.waiting if seq.request_id not in request_ids]
+        self.running = [seq for seq in self.running if seq.request_id not in request_ids]
+
+    def has_unfinished_requests(self) -> bool:
+        return bool(self.waiting or self.running)
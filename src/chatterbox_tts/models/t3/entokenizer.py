@@ -6,6 +6,8 @@ import torch
 from tokenizers import Tokenizer
 from transformers import PreTrainedTokenizer
 
+from .modules.t3_config import T3Config
+
 
 # Special tokens
 SOT = "[START]"
@@ -127,4 +129,6 @@ class EnTokenizer(PreTrainedTokenizer):
 
     @property
     def max_token_id(self) -> int:
-        return max(self.tokenizer.get_vocab().values())
\ No newline at end of file
+        # vLLM validates prompt ids against this. T3 shifts them into a reserved range of the speech vocabulary,
+        # see chatterbox_tts.models.t3.modules.input_layout.
+        return max(max(self.tokenizer.get_vocab().values()), T3Config.speech_tokens_dict_size - 1)
\ No newline at end of file
@@ -0,0 +1,107 @@
+from typing import Callable, Sequence
+
+import torch
+
+from .t3_config import T3Config
+
+
+# HACK: We need to be able to distinguish between the prefill tokens and the decode tokens in vLLM's mixed batches.
+# The sampler only sees the speech vocabulary, so decode tokens are plain speech token ids. Instead, the prompt
+# token ids are shifted (only within vLLM) into a reserved range at the top of the speech vocabulary, which holds
+# no real speech tokens and is masked out of the logits. This way, any token >= PREFILL_TOKEN_OFFSET is a prefill
+# token, and any token < PREFILL_TOKEN_OFFSET is a decode token.
+# No effect on the hidden states or the actual Llama model itself.
+PREFILL_TOKEN_OFFSET = T3Config.speech_tokens_dict_size - T3Config.text_tokens_dict_size  # 7490
+
+PREFILL_COND_START_TOKEN = PREFILL_TOKEN_OFFSET + 695  # [PLACEHOLDER55]; Marks the first token of the conditionals
+PREFILL_COND_END_TOKEN = PREFILL_TOKEN_OFFSET + 696  # [PLACEHOLDER56]; Marks the last token of the conditionals
+PREFILL_END_TOKEN = PREFILL_TOKEN_OFFSET + 697  # [PLACEHOLDER57]; Marks the end of the prefill block. This corresponds to the start of speech token.
+PREFILL_COND_TOKEN = PREFILL_TOKEN_OFFSET + 698  # [PLACEHOLDER58]; Every conditionals token between the first and the last
+
+CONDITIONING_SIZE = 34 # 1 for speaker_emb, 0 for clap_emb, 32 for cond_prompt_speech_emb, 1 for emotion_adv
+
+
+def segment_input_ids(input_ids: torch.Tensor) -> dict[str, torch.Tensor]:
+    """
+    vLLM combines the prefill and decode tokens of every running sequence into a single input tensor.
+    Classify each token by the part of the <| cond | text | speech |> layout it belongs to.
+
+    Because of the PREFILL_TOKEN_OFFSET, prefill tokens are always >= PREFILL_TOKEN_OFFSET and decode tokens
+    are always < PREFILL_TOKEN_OFFSET. Every conditioning token has a reserved id of its own
+    (PREFILL_COND_START_TOKEN, PREFILL_COND_TOKEN, PREFILL_COND_END_TOKEN), and the start of speech is
+    PREFILL_END_TOKEN, so each token is classified by its id alone. This holds wherever vLLM splits a prompt
+    across steps, and wherever prefix caching resumes it partway through the conditioning.
+
+    Everything is computed with elementwise ops and scans, so there are no host syncs.
+    Returns boolean masks `conditioning`, `text`, `start_of_speech` and `decode`, plus `mm_index`,
+    the row of the concatenated multimodal embeddings that each prefill token consumes.
+    """
+    is_prefill = input_ids >= PREFILL_TOKEN_OFFSET
+    is_prefill_end = input_ids == PREFILL_END_TOKEN
+    conditioning = (
+        (input_ids == PREFILL_COND_START_TOKEN) | (input_ids == PREFILL_COND_TOKEN) | (input_ids == PREFILL_COND_END_TOKEN)
+    )
+
+    return {
+        "conditioning": conditioning,
+        "text": is_prefill & ~is_prefill_end & ~conditioning,
+        "start_of_speech": is_prefill_end,
+        "decode": ~is_prefill,
+        "mm_index": torch.cumsum(is_prefill.long(), dim=0) - 1,
+    }
+
+
+def build_input_embeddings(
+    input_ids: torch.Tensor,
+    multimodal_embeddings: Sequence[torch.Tensor],
+    speech_emb: Callable[[torch.Tensor], torch.Tensor],
+    text_emb: Callable[[torch.Tensor], torch.Tensor],
+    text_pos_emb: torch.Tensor,
+    speech_pos_emb: torch.Tensor,
+    start_speech_token: int,
+    cfg: bool = True,
+) -> torch.Tensor:
+    """
+    Build the [N, 2 * dim] input embeddings for a mixed prefill/decode step: cond embeddings in the first
+    half and uncond (no text) embeddings in the second, which the forward pass splits for CFG.
+    With `cfg=False` only the [N, dim] cond embeddings are built.
+
+    - conditioning rows come straight from the multimodal embeddings
+    - text rows are text_emb(token - PREFILL_TOKEN_OFFSET) + text_pos_emb. The position is recovered from the triangular matrix of 1s
+      that T3MultiModalProcessor injects in the multimodal embeddings. Uncond zeroes the text.
+    - the start of speech row is speech_emb(start_speech_token) + speech_pos_emb[0]
+    - decode rows are speech_emb(token)
+
+    `text_pos_emb` and `speech_pos_emb` are the precomputed [max_len, dim] position tables.
+    """
+    if not multimodal_embeddings:
+        # There's no multimodal embeddings, so we're decoding
+        embeds = speech_emb(input_ids)
+        return torch.cat([embeds, embeds], dim=1) if cfg else embeds
+
+    segments = segment_input_ids(input_ids)
+    is_cond, is_text, is_sos = segments["conditioning"], segments["text"], segments["start_of_speech"]
+
+    speech_ids = torch.where(segments["decode"], input_ids, start_speech_token)
+    speech_embeds = speech_emb(speech_ids)
+    # Only the start of speech token gets a speech position embedding
+    speech_embeds = torch.addcmul(speech_embeds, is_sos[:, None].to(speech_embeds.dtype), speech_pos_emb[0])
+
+    # Every prefill token consumes the next row of the concatenated multimodal embeddings
+    mm = torch.cat(list(multimodal_embeddings), dim=0)
+    mm_rows = mm.index_select(0, segments["mm_index"].clamp(0, max(len(mm) - 1, 0)))
+
+    # Count the 1s (minus 1) in the triangular rows. Summed in fp32 so positions stay exact.
+    text_pos = (mm_rows.float().sum(dim=1) - 1).clamp(0, len(text_pos_emb) - 1).long()
+    text_embeds = text_emb(torch.where(is_text, input_ids - PREFILL_TOKEN_OFFSET, 0)) + text_pos_emb.index_select(0, text_pos)
+
+    speech_or_cond = torch.where(is_cond[:, None], mm_rows.to(speech_embeds.dtype), speech_embeds)
+    if not cfg:
+        return torch.where(is_text[:, None], text_embeds, speech_or_cond)
+
+    # Write both halves straight into one giant tensor, which will be split in the forward pass
+    dim = speech_embeds.shape[1]
+    out = speech_embeds.new_empty(len(input_ids), 2 * dim)
+    torch.where(is_text[:, None], text_embeds, speech_or_cond, out=out[:, :dim])
+    torch.mul(speech_or_cond, ~is_text[:, None], out=out[:, dim:])
+    return out
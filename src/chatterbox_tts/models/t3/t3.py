@@ -3,7 +3,6 @@ import os
 
 import torch
 import torch.nn as nn
-import random
 from transformers.feature_extraction_utils import BatchFeature
 
 from vllm.config import VllmConfig, ModelConfig
@@ -30,28 +29,28 @@ from vllm.multimodal.processing import (
 from vllm.multimodal.profiling import BaseDummyInputsBuilder
 from vllm.sequence import IntermediateTensors
 
+from chatterbox_tts.cache import tensor_fingerprint
 from chatterbox_tts.models.t3.modules.learned_pos_emb import LearnedPositionEmbeddings
 from chatterbox_tts.models.t3.modules.t3_config import T3Config
 from .modules.cond_enc import T3Cond, T3CondEnc
+from .modules.input_layout import (
+    PREFILL_COND_START_TOKEN,
+    PREFILL_COND_TOKEN,
+    PREFILL_COND_END_TOKEN,
+    PREFILL_END_TOKEN,
+    CONDITIONING_SIZE,
+    PREFILL_TOKEN_OFFSET,
+    build_input_embeddings,
+)
 
 
-PREFILL_COND_START_TOKEN = 695  # [PLACEHOLDER55]; Marks the first token of the conditionals
-PREFILL_COND_END_TOKEN = 696  # [PLACEHOLDER56]; Marks the last token of the conditionals
-PREFILL_END_TOKEN = 697  # [PLACEHOLDER57]; Marks the end of the prefill block. This corresponds to the start of speech token.
-
-CONDITIONING_SIZE = 34 # 1 for speaker_emb, 0 for clap_emb, 32 for cond_prompt_speech_emb, 1 for emotion_adv
-
-# HACK: We need to be able to distinguish between the prefill tokens and the decode tokens.
-# We'll do this by offsetting the speech tokens (only within vLLM) so they don't overlap with the
-# normal speech tokens. This way, any token < SPEECH_TOKEN_OFFSET is a prefill token, and any token
-# >= SPEECH_TOKEN_OFFSET is a decode token. This will only affect the logits and the encoding logic.
-# No effect on the hidden states or the actual Llama model itself.
-SPEECH_TOKEN_OFFSET = 1000
+# Number of mixed prefill/decode steps to record when CHATTERBOX_RECORD_LAYOUTS is set (see benchmarks/)
+MAX_RECORDED_LAYOUTS = 500
 
 
 class T3ProcessingInfo(BaseProcessingInfo):
     def get_supported_mm_limits(self) -> Mapping[str, Optional[int]]:
-        return {"conditionals": 1}
+        return {"conditionals": 1, "text_positions": 1}
 
 
 class T3MultiModalDummyInputsBuilder(BaseDummyInputsBuilder):
@@ -91,6 +90,15 @@ class ConditionalsEmbeddingItems(ModalityDataItems[torch.Tensor, torch.Tensor]):
         return {"conditionals": self.data}
 
 
+def hash_conditionals(conditionals: torch.Tensor) -> str:
+    """
+    Content hash of a conditional embedding, used as its multimodal hash so vLLM can reuse the KV of the
+    conditioning prefix across prompts. The exaggeration lives in the last (emotion_adv) row, so the
+    same voice at different exaggerations hashes differently.
+    """
+    return "conditionals:" + tensor_fingerprint(conditionals)
+
+
 def create_triangular_matrix(m, n):
     # Create row indices and column indices
     row_indices = torch.arange(m).unsqueeze(1)  # Shape: (m, 1)
@@ -186,14 +194,16 @@ class T3MultiModalProcessor(BaseMultiModalProcessor[T3ProcessingInfo]):
         # For prompt IDs, we're going to replace the input tokens that match the conditionals with a
         # sequence of tokens that won't normally appear in the text prompt. This will help us unbatch
         # batched inputs.
+        #
+        # All prompt ids are shifted by PREFILL_TOKEN_OFFSET, so they can't be confused with speech tokens.
         final_prompt_ids = [
             # Conditionals (totaling CONDITIONING_SIZE tokens)
             PREFILL_COND_START_TOKEN,
-            *([prompt_ids[0]] * (CONDITIONING_SIZE-2)),
+            *([PREFILL_COND_TOKEN] * (CONDITIONING_SIZE-2)),
             PREFILL_COND_END_TOKEN,
 
             # Text prompt,
-            *prompt_ids,
+            *(i + PREFILL_TOKEN_OFFSET for i in prompt_ids),
 
             # Start of speech token / End of prefill block
             PREFILL_END_TOKEN,
@@ -201,34 +211,32 @@ class T3MultiModalProcessor(BaseMultiModalProcessor[T3ProcessingInfo]):
 
         # HACK: Because vLLM can split the prefill across multiple batches, we need some way to
         # remember the offset of each text token.
-        # We'll do this by extending the 32x1024 embedding to <len(final_prompt_ids)>x1024, filling in
-        # the first 32x1024 with the original conditionals, and the rest with a triangular matrix of 1s
-        # which will encode the offset of each text token.
+        # We'll do this by injecting a <len(prompt_ids)+1>x1024 embedding over the text and start of speech tokens,
+        # filled with a triangular matrix of 1s which will encode the offset of each text token.
+        #
+        # This is a separate "text_positions" item rather than part of the conditionals, so the conditionals
+        # item only covers the CONDITIONING_SIZE voice tokens. vLLM salts the prefix cache hash of every block
+        # with the hashes of the items it overlaps, so the conditioning blocks of prompts in the same voice hash
+        # the same regardless of the text, and are only prefilled once.
         conditionals = mm_data.get("conditionals", None)
         assert conditionals is not None and len(conditionals) > 0, "Conditionals are required for prefill"
         assert len(conditionals) == 1, "Only one conditional embedding is supported for prefill"
         assert conditionals[0].shape[0] == CONDITIONING_SIZE, "Conditionals must be CONDITIONING_SIZE tokens long"
 
-        new_conditionals = torch.cat([
-            # First CONDITIONING_SIZE embeddings are the original conditionals
-            conditionals[0],
-
+        text_positions = torch.cat([
             # The positions of the text ids are a triangular matrix of 1s
             create_triangular_matrix(len(prompt_ids), conditionals[0].shape[1]).to(conditionals[0].device),
 
             # The start of speech token is a vector of 0s,
             torch.zeros(1, conditionals[0].shape[1]).to(conditionals[0].device),
         ], dim=0)
-        assert len(new_conditionals) == len(final_prompt_ids), "Number of new conditionals does not match number of prompt ids"
+        assert CONDITIONING_SIZE + len(text_positions) == len(final_prompt_ids), "Number of embeddings does not match number of prompt ids"
 
         new_mm_kwargs = MultiModalKwargs.from_items([
             MultiModalKwargsItem.from_elems(
-                MultiModalBatchedField().build_elems(
-                    modality="conditionals",
-                    key="conditionals",
-                    data=[new_conditionals],
-                )
+                MultiModalBatchedField().build_elems(modality=modality, key=modality, data=[data])
             )
+            for modality, data in [("conditionals", conditionals[0]), ("text_positions", text_positions)]
         ])
 
         return MultiModalInputs(
@@ -237,14 +245,16 @@ class T3MultiModalProcessor(BaseMultiModalProcessor[T3ProcessingInfo]):
             prompt_token_ids=final_prompt_ids,
             mm_kwargs=new_mm_kwargs,
             mm_hashes={
-                # Assign a random hash for now, because we're not actually hashing the multimodal data.
-                "conditionals": [str(random.random())],
+                # Hashes also key vLLM's multimodal input cache, so they must cover the whole item.
+                # The text positions only depend on the number of text tokens.
+                "conditionals": [hash_conditionals(conditionals[0])],
+                "text_positions": [f"text_positions:{len(text_positions)}:{text_positions.shape[1]}"],
             },
             mm_placeholders={
-                # "conditionals": [PlaceholderRange(offset=0, length=CONDITIONING_SIZE, is_embed=None)]
-                # HACK: Tell vLLM that the conditionals modify the entire prompt. This will cause our hacked embeddings
-                #       to be injected into the entire prompt, rather than just the conditioning portion.
-                "conditionals": [PlaceholderRange(offset=0, length=len(final_prompt_ids), is_embed=None)]
+                "conditionals": [PlaceholderRange(offset=0, length=CONDITIONING_SIZE, is_embed=None)],
+                # HACK: Tell vLLM that the text positions modify the rest of the prompt. This will cause our hacked embeddings
+                #       to be injected into the text and start of speech tokens too, right after the conditionals.
+                "text_positions": [PlaceholderRange(offset=CONDITIONING_SIZE, length=len(text_positions), is_embed=None)],
             },
         )
 
@@ -260,7 +270,14 @@ class T3VllmModel(nn.Module, VllmModelForTextGeneration, SupportsMultiModal):
         # HACK: We changed the hidden size to 2048 to trick VLLM into thinking that the model has a hidden size of 2048.
         #       This is needed to accomodate the extra data for the CFG uncond prompt.
         #       We need to change it back to 1024 for loading the actual llama model.
+        #       If the hidden size is overridden to 1024 (see ChatterboxTTS.from_local), CFG is disabled and
+        #       only the conditional half is run.
+        self.use_cfg = vllm_config.model_config.hf_config.hidden_size == 2 * T3Config.n_channels
         vllm_config.model_config.hf_config.hidden_size = 1024
+
+        # HACK: Likewise, the vocab size is set to the speech vocabulary so vLLM pads the prompt ids it hands to the
+        #       sampler penalties with an id past the end of the logits. The Llama backbone only has 8 (unused) token embeddings.
+        vllm_config.model_config.hf_config.vocab_size = 8
         self.vllm_config = vllm_config
         self.cfg: ModelConfig = vllm_config.model_config
 
@@ -291,8 +308,20 @@ class T3VllmModel(nn.Module, VllmModelForTextGeneration, SupportsMultiModal):
         )
         self.logits_processor = LogitsProcessor(self.t3conf.speech_tokens_dict_size)
 
-        self.cfg_scale = float(os.environ.get("CHATTERBOX_CFG_SCALE", "0.5"))
-        print("Applying CFG scale:", self.cfg_scale)
+        # The CFG scale is set per engine through `hf_overrides`, falling back to the environment
+        self.cfg_scale = float(getattr(vllm_config.model_config.hf_config, "cfg_scale", os.environ.get("CHATTERBOX_CFG_SCALE", "0.5")))
+        print("Applying CFG scale:", self.cfg_scale if self.use_cfg else "disabled")
+
+        # Rows of the current prefill step that need an unconditional hidden state, see `forward`.
+        # Only used when running eagerly, since the number of rows varies from step to step.
+        self.uncond_rows: Optional[torch.Tensor] = None
+        self.share_cond_prefix = self.use_cfg and vllm_config.model_config.enforce_eager
+
+        # Debugging aid: dump the input layouts of mixed prefill/decode steps, to replay them in benchmarks/
+        self.layout_record_dir = os.environ.get("CHATTERBOX_RECORD_LAYOUTS")
+        self.recorded_layouts = 0
+        if self.layout_record_dir is not None:
+            os.makedirs(self.layout_record_dir, exist_ok=True)
 
 
     def load_weights(self, weights: Iterable[tuple[str, torch.Tensor]]) -> set[str]:
@@ -331,92 +360,10 @@ class T3VllmModel(nn.Module, VllmModelForTextGeneration, SupportsMultiModal):
 
 
     def get_multimodal_embeddings(self, **kwargs: object) -> Optional[MultiModalEmbeddings]:
-        conditionals: Optional[list[list[T3Cond]]] = kwargs.get("conditionals", [])
-        return [batch[0] for batch in conditionals]
-
-
-    def split_prefill_decode(
-        self,
-        input_ids: torch.Tensor,
-        multimodal_embeddings: list[MultiModalEmbeddings],
-    ) -> list[torch.Tensor, Optional[MultiModalEmbeddings]]:
-        """
-        vLLM combines the prefill and decode into a single input tensor. We need to split them back
-        out, and match the decode parts with the corresponding multimodal embeddings.
-
-        Because of the SPEECH_TOKEN_OFFSET, the prefill tokens will always be <SPEECH_TOKEN_OFFSET and
-        and the decode tokens will always be >= SPEECH_TOKEN_OFFSET.
-
-        Furthermore, the prefill always starts with PREFILL_COND_START_TOKEN, and
-        ends with PREFILL_END_TOKEN. However, vLLM can split the prefill across multiple batches,
-        so we won't always have the complete prefill block in a single batch - we might only have the
-        beginning or the end of a block.
-
-        We can see back-to-back prefill blocks, so we can't just look for continuous sequences of
-        prefill tokens. This nuance is not relevant for decode tokens as their position does not matter.
-
-        Returns a list of tuples, where the first element is the input IDs for the block,
-        and the second element is the associated multimodal embedding if the block is a decode part.
-        If the block is a prefill part, the second element is None.
-        """
-
-        if len(input_ids) == 0:
-            return []
-        
-        remaining_multimodal_embeddings = torch.cat(multimodal_embeddings, dim=0)
-
-        # with open("/ram/input_ids.txt", "w") as f:
-        #     f.write(str(input_ids.tolist()))
-        # with open("/ram/multimodal_embeddings.txt", "w") as f:
-        #     f.write(str([i.tolist() for i in (multimodal_embeddings or [])]))
-
-        in_prefill_block = input_ids[0] < SPEECH_TOKEN_OFFSET
-
-        output = []
-
-        # Keep a buffer of current tokens
-        buffer = []
-
-        # Iterate through the element and if we hit block header, set the block state to true
-        # Else if we hit the block footer, set block state to false
-        # Every time we swtich between block states, add the current buffer to the output if not empty
-        # If we we switch out of block mode, add the multimodal embedding
-        for input_id in input_ids:
-            # Check if we've swapped between prefill and decode blocks, or if we've just hit the start of a new prefill block
-            if (in_prefill_block != (input_id < SPEECH_TOKEN_OFFSET)) or (input_id == PREFILL_COND_START_TOKEN):
-                if buffer:
-                    if in_prefill_block:
-                        # assert len(remaining_multimodal_embeddings) >= len(buffer), "Not enough remaining multimodal embeddings"
-                        mme, remaining_multimodal_embeddings = remaining_multimodal_embeddings\
-                            .split([len(buffer), len(remaining_multimodal_embeddings) - len(buffer)], dim=0)
-                        output.append((torch.tensor(buffer).to(input_ids.device), mme))
-                    else:
-                        output.append((torch.tensor(buffer).to(input_ids.device), None))
-
-                buffer = []
-                in_prefill_block = (input_id < SPEECH_TOKEN_OFFSET)
-
-            # Add new token to buffer
-            buffer.append(input_id)
-
-        # Add any elements left in the buffer
-        if buffer:
-            if in_prefill_block:
-                # assert len(remaining_multimodal_embeddings) >= len(buffer), "Not enough remaining multimodal embeddings"
-                mme, remaining_multimodal_embeddings = remaining_multimodal_embeddings\
-                    .split([len(buffer), len(remaining_multimodal_embeddings) - len(buffer)], dim=0)
-                output.append((torch.tensor(buffer).to(input_ids.device), mme))
-            else:
-                output.append((torch.tensor(buffer).to(input_ids.device), None))
-
-        # if len(remaining_multimodal_embeddings) > 0:
-        #     print("t3/split_prefill_decode/input_ids", input_ids)
-        #     print("t3/split_prefill_decode/remaining_multimodal_embeddings", remaining_multimodal_embeddings.shape)
-        #     print("t3/split_prefill_decode/multimodal_embeddings", [i.shape for i in (multimodal_embeddings or [])])
-        # assert len(remaining_multimodal_embeddings) == 0, "Number of multimodal embeddings does not match number of prefill blocks"
-
-        # assert sum(len(i[0]) for i in output) == len(input_ids), "Number of output elements does not match number of input elements"
-        return output
+        # vLLM runs one modality at a time. Either way the item is passed through as is,
+        # and the conditionals / text positions rows of each prompt end up back to back in get_input_embeddings.
+        items: Optional[list[torch.Tensor]] = kwargs.get("conditionals", kwargs.get("text_positions", []))
+        return [batch[0] for batch in items]
 
 
     def get_input_embeddings(
@@ -424,179 +371,50 @@ class T3VllmModel(nn.Module, VllmModelForTextGeneration, SupportsMultiModal):
         input_ids: torch.Tensor,
         multimodal_embeddings: Optional[MultiModalEmbeddings] = None,
     ) -> torch.Tensor:
-        if multimodal_embeddings is None or len(multimodal_embeddings) == 0:
-            # There's no multimodal embeddings, so we're decoding.
-            # Remember to undo the offset we applied to the speech tokens.
-            embeds = self.speech_emb(input_ids - SPEECH_TOKEN_OFFSET)
-
-            out = torch.cat([embeds, embeds], dim=1)
-
-            # if len(out) != len(input_ids):
-            #     print("t3/get_input_embeddings/out", out.shape, out.dtype)
-            #     print("t3/get_input_embeddings/input_ids", input_ids.shape, input_ids.dtype)
-            # assert len(out) == len(input_ids), "Number of output elements does not match number of input elements"
-            return out
-        else:
-            # print("t3/get_input_embeddings/multimodal_embeddings", len(multimodal_embeddings))
-            # print("t3/get_input_embeddings/input_ids", input_ids.shape, input_ids.dtype, input_ids)
-            # print("t3/get_input_embeddings/multimodal_embeddings", [i.shape for i in (multimodal_embeddings or [])])
-
-            out = []
-            for ids, multimodal_embedding in self.split_prefill_decode(input_ids, multimodal_embeddings):
-                # print("t3/get_input_embeddings/ids", ids.shape, ids.dtype, ids)
-                # print("t3/get_input_embeddings/multimodal_embedding", multimodal_embedding.shape if multimodal_embedding is not None else None)
-
-                if multimodal_embedding is None:
-                    # There's no multimodal embeddings, so we're decoding.
-                    # Remember to undo the offset we applied to the speech tokens.
-                    embeds = self.speech_emb(ids - SPEECH_TOKEN_OFFSET)
-                    final_embeds = torch.cat([embeds, embeds], dim=1)
-                    # assert len(final_embeds) == len(ids), "Number of output elements does not match number of input elements"
-                    
-                    out.append(final_embeds)
-                    continue
-
-                # We're in the prefill stage, and need to wrangle the multimodal embeddings into the right format.
-                # Embeddings are in the format of <| cond | text | speech |>
-                #
-                # However, due to vLLM batching, we may only get the first half or the last half of the prefill block.
-                #
-                # We're going to assume that the prefill block only span at most two batches - i.e. we'll always have
-                # at least the start token or the end token. More is theorically possible, but not an edge case I'm going
-                # to handle here.
-                #
-                # Note that we may have as little as a single token from the block.
-
-                # To ease the implementation logic, we're going to implement each case separately.
-
-                if ids[0] == PREFILL_COND_START_TOKEN and ids[-1] == PREFILL_END_TOKEN:
-                    # We have the full prefill block.
-
-                    # The first 34 tokens are the cond portion. The remainder, except for the last token are the text
-                    # portion. The last token is a placeholder for the start of speech token.
-                    text_ids = ids[CONDITIONING_SIZE:-1]
-                    text_emb = self.text_emb(text_ids) + self.precomputed_text_pos_emb[0:len(text_ids)]
-
-                    start_of_speech_token = torch.tensor([self.t3conf.start_speech_token]).to(ids.device)
-                    start_of_speech_emb = self.speech_emb(start_of_speech_token.unsqueeze(0))[0] + self.precomputed_speech_pos_emb[0:1]
-
-                    # Generate version with both text and no-text embeddings for CFG
-                    conditioning_emb = multimodal_embedding[0:CONDITIONING_SIZE]
-                    cond_embeds = torch.cat([conditioning_emb, text_emb, start_of_speech_emb], dim=0)
-                    uncond_embeds = torch.cat([conditioning_emb, torch.zeros_like(text_emb), start_of_speech_emb], dim=0)
-
-                    # Concatenate into one giant tensor, which will be split in the forward pass
-                    final_embeds = torch.cat([cond_embeds, uncond_embeds], dim=1)
-                    # assert len(final_embeds) == len(ids), "Number of output elements does not match number of input elements"
-                    out.append(final_embeds)
-                elif ids[0] == PREFILL_COND_START_TOKEN:
-                    # We have the start of the prefill block.
-                    # The only thing we an assume here is that we don't have the end token, so we can skip the start of speech token.
-                    # print("t3/get_input_embeddings/start of prefill block")
-
-                    # The first 34 tokens are the cond portion. The remainder are the text portion.
-                    # This logic should correctly handle:
-                    #  - We don't have any text tokens in this batch
-                    #  - We only have part of the conditioning tokens in this batch
-                    text_ids = ids[CONDITIONING_SIZE:]
-                    text_emb = self.text_emb(text_ids) + self.precomputed_text_pos_emb[0:len(text_ids)]
-
-                    # Generate version with both text and no-text embeddings for CFG
-                    conditioning_emb = multimodal_embedding[0:min(CONDITIONING_SIZE, len(multimodal_embedding))]
-                    cond_embeds = torch.cat([conditioning_emb, text_emb], dim=0)
-                    uncond_embeds = torch.cat([conditioning_emb, torch.zeros_like(text_emb)], dim=0)
-
-                    # Concatenate into one giant tensor, which will be split in the forward pass
-                    final_embeds = torch.cat([cond_embeds, uncond_embeds], dim=1)
-                    assert len(final_embeds) == len(ids), "Number of output elements does not match number of input elements"
-                    out.append(final_embeds)
-                elif ids[-1] == PREFILL_END_TOKEN:
-                    # We have the end of the prefill block.
-                    # The only thing we an assume here is that we have the start of speech token,
-                    # and that our conditioning embeddings will at minimum be truncated. We can't
-                    # assume anything about the text portion.
-
-                    # Check if the end-of-conditioning token is present. If it is, we can assume that
-                    # we have the full text block. If it's not, we can assume that there's no conditioning
-                    # portion.
-                    indices = torch.where(ids == PREFILL_COND_END_TOKEN)[0]
-                    if len(indices) > 0:
-                        # print("t3/get_input_embeddings/end of prefill block, has conditioning")
-                        
-                        # We have the full text input, and it's from indices[0]+1 to the end of the input.
-                        # (indices[0] is the end of the conditioning)
-                        text_ids = ids[indices[0]+1:-1]
-                        text_emb = self.text_emb(text_ids) + self.precomputed_text_pos_emb[0:len(text_ids)]
-                        
-                        start_of_speech_token = torch.tensor([self.t3conf.start_speech_token]).to(ids.device)
-                        start_of_speech_emb = self.speech_emb(start_of_speech_token.unsqueeze(0))[0] + self.precomputed_speech_pos_emb[0:1]
-
-                        conditioning_emb = multimodal_embedding[:indices[0]+1]
-                        
-                        cond_embeds = torch.cat([conditioning_emb, text_emb, start_of_speech_emb], dim=0)
-                        uncond_embeds = torch.cat([conditioning_emb, torch.zeros_like(text_emb), start_of_speech_emb], dim=0)
-
-                        final_embeds = torch.cat([cond_embeds, uncond_embeds], dim=1)
-                        # assert len(final_embeds) == len(ids), "Number of output elements does not match number of input elements"
-                        out.append(final_embeds)
-                    else:
-                        # We don't have the conditioning portion, and we may only have part of the text portion.
-                        # print("t3/get_input_embeddings/end of prefill block, no conditioning")
-
-                        # Everything except the last token is the text portion.
-                        text_ids = ids[:-1]
-                        
-                        # Extract the position IDs for the text portion by counting the number of 1s (minus 1) in the multimodal embedding
-                        # that was injected via our hack above.
-                        text_pos = torch.sum(multimodal_embedding[0:len(text_ids)], dim=1) - 1
-
-                        text_emb = self.text_emb(text_ids) + self.precomputed_text_pos_emb[text_pos.tolist()]
-
-                        start_of_speech_token = torch.tensor([self.t3conf.start_speech_token]).to(ids.device)
-                        start_of_speech_emb = self.speech_emb(start_of_speech_token.unsqueeze(0))[0]  + self.precomputed_speech_pos_emb[0:1]
-                        
-                        cond_embeds = torch.cat([text_emb, start_of_speech_emb], dim=0)
-                        uncond_embeds = torch.cat([torch.zeros_like(text_emb), start_of_speech_emb], dim=0)
-                        final_embeds = torch.cat([cond_embeds, uncond_embeds], dim=1)
-                        assert len(final_embeds) == len(ids), "Number of output elements does not match number of input elements"
-                        out.append(final_embeds)
-
-                else:
-                    # Something else - we don't know what to do with this.
-                    print("t3/get_input_embeddings/ERROR: prefill block contains neither start nor end. Please report this issue.")
-                    print("t3/get_input_embeddings/ids", ids.shape, ids.dtype, ids)
-                    print("t3/get_input_embeddings/multimodal_embedding", multimodal_embedding.shape if multimodal_embedding is not None else None)
-                    raise ValueError(f"Unknown prefill block: {ids}")
-
-            output = torch.cat(out, dim=0)
-
-            # if len(output) != len(input_ids):
-            #     print("t3/get_input_embeddings/output", output.shape, output.dtype)
-            #     print("t3/get_input_embeddings/input_ids", input_ids.shape, input_ids.dtype)
-            #     print("t3/get_input_embeddings/multimodal_embeddings", len(multimodal_embeddings))
-            return output
+        # vLLM mixes the prefill and decode tokens of all running sequences in one step. They are segmented
+        # and assembled with tensor ops only (see input_layout.py), since this runs on every step.
+        if self.layout_record_dir is not None and multimodal_embeddings and self.recorded_layouts < MAX_RECORDED_LAYOUTS:
+            torch.save(
+                {"input_ids": input_ids.cpu(), "multimodal_embeddings": [i.cpu() for i in multimodal_embeddings]},
+                os.path.join(self.layout_record_dir, f"layout_{self.recorded_layouts:04d}.pt"),
+            )
+            self.recorded_layouts += 1
+
+        if self.share_cond_prefix and multimodal_embeddings:
+            # Only decode and start of speech rows are ever sampled from
+            self.uncond_rows = (input_ids < PREFILL_TOKEN_OFFSET) | (input_ids == PREFILL_END_TOKEN)
+
+        return build_input_embeddings(
+            input_ids,
+            multimodal_embeddings or [],
+            speech_emb=self.speech_emb,
+            text_emb=self.text_emb,
+            text_pos_emb=self.precomputed_text_pos_emb,
+            speech_pos_emb=self.precomputed_speech_pos_emb,
+            start_speech_token=self.t3conf.start_speech_token,
+            cfg=self.use_cfg,
+        )
 
 
     def compute_logits(self, hidden_states: torch.Tensor, sampling_metadata: SamplingMetadata) -> torch.Tensor:
         # print("t3/compute_logits/hidden_states", hidden_states.shape, hidden_states.dtype)
         # print("t3/compute_logits/sampling_metadata", sampling_metadata)
 
-        # Split the hidden state vector into the three parts
-        cond_hidden_states, uncond_hidden_states = hidden_states.split([self.dim, self.dim], dim=1)
-        # print("t3/compute_logits/normal_hidden_states", normal_hidden_states.shape, normal_hidden_states.dtype)
-        # print("t3/compute_logits/cfg_hidden_states", cfg_hidden_states.shape, cfg_hidden_states.dtype)
+        if self.use_cfg:
+            # Split the hidden state vector into the cond and uncond parts
+            cond_hidden_states, uncond_hidden_states = hidden_states.split([self.dim, self.dim], dim=1)
 
-        cond_logits = self.logits_processor(self.speech_head, cond_hidden_states, sampling_metadata)
-        uncond_logits = self.logits_processor(self.speech_head, uncond_hidden_states, sampling_metadata)
+            cond_logits = self.logits_processor(self.speech_head, cond_hidden_states, sampling_metadata)
+            uncond_logits = self.logits_processor(self.speech_head, uncond_hidden_states, sampling_metadata)
 
-        logits = cond_logits + self.cfg_scale * (cond_logits - uncond_logits)
+            logits = cond_logits + self.cfg_scale * (cond_logits - uncond_logits)
+        else:
+            logits = self.logits_processor(self.speech_head, hidden_states, sampling_metadata)
 
         # print("t3/compute_logits/logit with the highest probability (cond, uncond, post-cfg):", cond_logits.argmax(), uncond_logits.argmax(), logits.argmax())
 
-        # HACK: Offset the logits so the resulting speech token is +SPEECH_TOKEN_OFFSET from the normal speech tokens.
-        #       We'll do this by adding SPEECH_TOKEN_OFFSET fake dimensions to the left of the logits.
-        #       This is a hack to help us unbatch batched inputs.
-        logits = torch.cat([torch.zeros(logits.shape[0], SPEECH_TOKEN_OFFSET).to(logits.device), logits], dim=1)
+        # The top of the speech vocabulary is reserved for the (shifted) prompt ids, and must never be sampled
+        logits[:, PREFILL_TOKEN_OFFSET:] = float("-inf")
         return logits
 
 
@@ -619,12 +437,39 @@ class T3VllmModel(nn.Module, VllmModelForTextGeneration, SupportsMultiModal):
         if inputs_embeds is None:
             inputs_embeds = self.get_input_embeddings(input_ids, [])
 
-        # Split the inputs_embeds into the three parts
+        # TODO: Apply speech positional embeddings here
+
+        if not self.use_cfg:
+            # No unconditional half to run
+            return self.tfmr(
+                input_ids=None,
+                positions=positions,
+                intermediate_tensors=None,
+                inputs_embeds=inputs_embeds,
+            )
+
+        # Split the inputs_embeds into the cond and uncond parts
         cond_embeds, uncond_embeds = inputs_embeds.split([self.dim, self.dim], dim=1)
         # print("t3/embeds", embeds.shape, embeds.dtype)
         # print("t3/cfg_embeds", cfg_embeds.shape, cfg_embeds.dtype)
 
-        # TODO: Apply speech positional embeddings here
+        # The uncond rows are stacked after the cond rows, but vLLM's attention metadata only covers the first
+        # len(positions) rows. So the uncond half never writes KV entries of its own and gets no attention output;
+        # the KV of each sequence, conditioning prefix included, is only ever stored once, by the cond half.
+        # That also means an uncond row only matters if it is sampled from. In a prefill step, run the uncond
+        # half for the decode and start of speech rows only, instead of for the whole prompt.
+        uncond_rows, self.uncond_rows = self.uncond_rows, None
+        if uncond_rows is not None and len(uncond_rows) == len(inputs_embeds):
+            uncond_idx = uncond_rows.nonzero().squeeze(1)
+            hidden_states = self.tfmr(
+                input_ids=None,
+                positions=torch.cat([positions, positions[uncond_idx]], dim=0),
+                intermediate_tensors=None,
+                inputs_embeds=torch.cat([cond_embeds, uncond_embeds[uncond_idx]], dim=0)
+            )
+            cond_hidden_states, sampled_uncond_hidden_states = hidden_states.split([len(cond_embeds), len(uncond_idx)], dim=0)
+            uncond_hidden_states = torch.zeros_like(cond_hidden_states).index_copy_(0, uncond_idx, sampled_uncond_hidden_states)
+            return torch.cat([cond_hidden_states, uncond_hidden_states], dim=1)
 
         hidden_states = self.tfmr(
             input_ids=None,
@@ -0,0 +1,373 @@
+"""
+Pure PyTorch T3 decoding, for CPU deployments and for running the pipeline without vLLM's GPU runtime.
+
+`T3TorchModel` is the Llama_520M backbone with T3's embeddings and speech head, loaded from t3_cfg.safetensors.
+`T3TorchEngine` is the `T3Engine` that decodes it with a per-sequence KV cache. Prompts use the same
+<| cond | text | speech |> layout as T3VllmModel (see input_layout.py).
+"""
+from dataclasses import dataclass, field
+from typing import Optional
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .engine import T3CompletionOutput, T3Engine, T3RequestOutput, T3SamplingParams
+from .entokenizer import EnTokenizer
+from .modules.input_layout import CONDITIONING_SIZE, PREFILL_TOKEN_OFFSET
+from .modules.learned_pos_emb import LearnedPositionEmbeddings
+from .modules.t3_config import T3Config
+
+
+@dataclass
+class T3LlamaConfig:
+    """Llama_520M, as in t3-model/config.json (where hidden_size is doubled for vLLM, see T3VllmModel)"""
+    hidden_size: int = 1024
+    intermediate_size: int = 4096
+    num_hidden_layers: int = 30
+    num_attention_heads: int = 16
+    head_dim: int = 64
+    rms_norm_eps: float = 1e-5
+
+    # llama3 rope scaling
+    rope_theta: float = 500000.0
+    rope_factor: float = 8.0
+    rope_low_freq_factor: float = 1.0
+    rope_high_freq_factor: float = 4.0
+    rope_original_max_position_embeddings: int = 8192
+
+
+def llama3_inv_freq(config: T3LlamaConfig) -> torch.Tensor:
+    """Rotary frequencies with Llama 3's scaling: long wavelengths are slowed down by `rope_factor`, with a smooth ramp"""
+    inv_freq = 1.0 / (config.rope_theta ** (torch.arange(0, config.head_dim, 2, dtype=torch.float32) / config.head_dim))
+    low_freq_wavelen = config.rope_original_max_position_embeddings / config.rope_low_freq_factor
+    high_freq_wavelen = config.rope_original_max_position_embeddings / config.rope_high_freq_factor
+
+    wavelen = 2 * math.pi / inv_freq
+    scaled = torch.where(wavelen > low_freq_wavelen, inv_freq / config.rope_factor, inv_freq)
+    smooth = (config.rope_original_max_position_embeddings / wavelen - config.rope_low_freq_factor) / (
+        config.rope_high_freq_factor - config.rope_low_freq_factor
+    )
+    smoothed = (1 - smooth) * scaled / config.rope_factor + smooth * scaled
+    is_medium = (wavelen >= high_freq_wavelen) & (wavelen <= low_freq_wavelen)
+    return torch.where(is_medium, smoothed, scaled)
+
+
+def apply_rotary(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.Tensor:
+    x1, x2 = x.chunk(2, dim=-1)
+    return x * cos + torch.cat([-x2, x1], dim=-1) * sin
+
+
+class RMSNorm(nn.Module):
+    def __init__(self, dim: int, eps: float):
+        super().__init__()
+        self.weight = nn.Parameter(torch.ones(dim))
+        self.eps = eps
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # Normalised in fp32, like the HF and vLLM implementations
+        dtype = x.dtype
+        x = x.float()
+        x = x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
+        return self.weight * x.to(dtype)
+
+
+class T3KVCache:
+    """
+    Keys and values of one sequence, for every layer and both CFG branches: [layers, k/v, branches, heads, T, head_dim].
+    The capacity doubles when it runs out, so short prompts don't reserve `max_model_len` tokens up front.
+    """
+    def __init__(self, config: T3LlamaConfig, n_branches: int, device, dtype, capacity: int = 256):
+        self.n_branches = n_branches
+        self.length = 0
+        self.kv = torch.empty(
+            config.num_hidden_layers, 2, n_branches, config.num_attention_heads, capacity, config.head_dim,
+            device=device, dtype=dtype,
+        )
+
+    def reserve(self, n: int):
+        if self.length + n > self.kv.size(4):
+            kv = self.kv.new_empty(*self.kv.shape[:4], max(2 * self.kv.size(4), self.length + n), self.kv.size(5))
+            kv[:, :, :, :, :self.length] = self.kv[:, :, :, :, :self.length]
+            self.kv = kv
+
+    def update(self, layer: int, k: torch.Tensor, v: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """Store the [branches, heads, T, head_dim] keys and values after the cached ones, returning all of them"""
+        end = self.length + k.size(2)
+        self.kv[layer, 0, :, :, self.length:end] = k
+        self.kv[layer, 1, :, :, self.length:end] = v
+        return self.kv[layer, 0, :, :, :end], self.kv[layer, 1, :, :, :end]
+
+
+class T3LlamaAttention(nn.Module):
+    def __init__(self, config: T3LlamaConfig, layer_idx: int):
+        super().__init__()
+        self.layer_idx = layer_idx
+        self.num_heads = config.num_attention_heads
+        self.head_dim = config.head_dim
+        inner_dim = self.num_heads * self.head_dim
+        self.q_proj = nn.Linear(config.hidden_size, inner_dim, bias=False)
+        self.k_proj = nn.Linear(config.hidden_size, inner_dim, bias=False)
+        self.v_proj = nn.Linear(config.hidden_size, inner_dim, bias=False)
+        self.o_proj = nn.Linear(inner_dim, config.hidden_size, bias=False)
+
+    def forward(self, x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor, caches: list[T3KVCache]) -> torch.Tensor:
+        B, T, _ = x.shape
+        q, k, v = (proj(x).view(B, T, self.num_heads, self.head_dim).transpose(1, 2) for proj in (self.q_proj, self.k_proj, self.v_proj))
+        q = apply_rotary(q, cos, sin)
+        k = apply_rotary(k, cos, sin)
+
+        # The projections run over the rows of every sequence at once, attention over each sequence's own cache.
+        # Prompts are always prefilled from position 0, so a multi-token step is plainly causal.
+        out = torch.empty_like(q)
+        start = 0
+        for cache in caches:
+            rows = slice(start, start + cache.n_branches)
+            keys, values = cache.update(self.layer_idx, k[rows], v[rows])
+            out[rows] = F.scaled_dot_product_attention(q[rows], keys, values, is_causal=T > 1)
+            start += cache.n_branches
+        return self.o_proj(out.transpose(1, 2).reshape(B, T, -1))
+
+
+class T3LlamaMLP(nn.Module):
+    def __init__(self, config: T3LlamaConfig):
+        super().__init__()
+        self.gate_proj = nn.Linear(config.hidden_size, config.intermediate_size, bias=False)
+        self.up_proj = nn.Linear(config.hidden_size, config.intermediate_size, bias=False)
+        self.down_proj = nn.Linear(config.intermediate_size, config.hidden_size, bias=False)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.down_proj(F.silu(self.gate_proj(x)) * self.up_proj(x))
+
+
+class T3LlamaLayer(nn.Module):
+    def __init__(self, config: T3LlamaConfig, layer_idx: int):
+        super().__init__()
+        self.input_layernorm = RMSNorm(config.hidden_size, config.rms_norm_eps)
+        self.self_attn = T3LlamaAttention(config, layer_idx)
+        self.post_attention_layernorm = RMSNorm(config.hidden_size, config.rms_norm_eps)
+        self.mlp = T3LlamaMLP(config)
+
+    def forward(self, x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor, caches: list[T3KVCache]) -> torch.Tensor:
+        x = x + self.self_attn(self.input_layernorm(x), cos, sin, caches)
+        return x + self.mlp(self.post_attention_layernorm(x))
+
+
+class T3Llama(nn.Module):
+    """The Llama backbone, named like HF's LlamaModel so the `tfmr.*` weights load as is"""
+    def __init__(self, config: T3LlamaConfig):
+        super().__init__()
+        self.layers = nn.ModuleList([T3LlamaLayer(config, i) for i in range(config.num_hidden_layers)])
+        self.norm = RMSNorm(config.hidden_size, config.rms_norm_eps)
+        self.register_buffer("inv_freq", llama3_inv_freq(config), persistent=False)
+
+    def forward(self, x: torch.Tensor, positions: torch.Tensor, caches: list[T3KVCache]) -> torch.Tensor:
+        freqs = positions[:, None, :, None].float() * self.inv_freq  # [B, 1, T, head_dim / 2]
+        freqs = torch.cat([freqs, freqs], dim=-1)
+        cos, sin = freqs.cos().to(x.dtype), freqs.sin().to(x.dtype)
+        for layer in self.layers:
+            x = layer(x, cos, sin, caches)
+        return self.norm(x)
+
+
+class T3TorchModel(nn.Module):
+    def __init__(self, config: T3LlamaConfig = T3LlamaConfig(), t3_config: T3Config = T3Config()):
+        super().__init__()
+        self.config = config
+        self.t3conf = t3_config
+        dim = config.hidden_size
+        self.tfmr = T3Llama(config)
+        self.text_emb = nn.Embedding(t3_config.text_tokens_dict_size, dim)
+        self.speech_emb = nn.Embedding(t3_config.speech_tokens_dict_size, dim)
+        self.text_pos_emb = LearnedPositionEmbeddings(t3_config.max_text_tokens + 2, dim)
+        self.speech_pos_emb = LearnedPositionEmbeddings(t3_config.max_speech_tokens + 2 + 2, dim)
+        self.speech_head = nn.Linear(dim, t3_config.speech_tokens_dict_size, bias=False)
+
+    @classmethod
+    def from_state_dict(cls, state_dict: dict[str, torch.Tensor], device: str = "cpu", dtype: torch.dtype = torch.float32) -> 'T3TorchModel':
+        """Load the weights of t3_cfg.safetensors"""
+        model = cls()
+        # The conditioning encoder runs separately (T3CondEnc), and the backbone's token embeddings are unused
+        missing, _ = model.load_state_dict(state_dict, strict=False)
+        if missing:
+            raise RuntimeError(f"Missing T3 weights: {missing}")
+        return model.to(device=device, dtype=dtype).eval()
+
+    def embed_prompt(self, text_ids: torch.Tensor, cond_emb: torch.Tensor, cfg: bool) -> torch.Tensor:
+        """
+        [branches, T, dim] prompt embeddings: the conditionals, the text with its position embeddings, and the start
+        of speech token. The uncond branch zeroes the text, like `build_input_embeddings`.
+        """
+        text = self.text_emb(text_ids) + self.text_pos_emb(text_ids[None])
+        sos = self.speech_emb.weight[self.t3conf.start_speech_token] + self.speech_pos_emb.emb.weight[0]
+        embeds = torch.cat([cond_emb.to(text.dtype), text, sos[None]], dim=0)
+        if not cfg:
+            return embeds[None]
+        uncond = embeds.clone()
+        uncond[CONDITIONING_SIZE:CONDITIONING_SIZE + len(text_ids)] = 0
+        return torch.stack([embeds, uncond])
+
+    def forward(self, embeds: torch.Tensor, caches: list[T3KVCache]) -> torch.Tensor:
+        """
+        Run [B, T, dim] embeddings after what `caches` hold, where the rows of each cache's sequence follow each other,
+        and return the [B, vocab] fp32 logits of the last position.
+        """
+        positions = torch.cat([
+            torch.arange(cache.length, cache.length + embeds.size(1), device=embeds.device).expand(cache.n_branches, -1)
+            for cache in caches
+        ])
+        for cache in caches:
+            cache.reserve(embeds.size(1))
+        hidden_states = self.tfmr(embeds, positions, caches)
+        for cache in caches:
+            cache.length += embeds.size(1)
+        return self.speech_head(hidden_states[:, -1]).float()
+
+
+@dataclass
+class T3Sequence:
+    request_id: str
+    sampling_params: T3SamplingParams
+    prompt_embeds: Optional[torch.Tensor]
+    prompt_len: int
+    cache: T3KVCache
+    generator: torch.Generator
+    token_ids: list[int] = field(default_factory=list)
+
+
+class T3TorchEngine(T3Engine):
+    """
+    Continuous batching over `T3TorchModel`: every `step` prefills the waiting prompts that fit in `max_batch_size`,
+    and decodes one token for the sequences already running. Classifier-free guidance runs the uncond branch of
+    each sequence as an extra batch row with its own KV cache, unless `cfg_scale` is 0.
+    Supports all of T3SamplingParams, with n=1.
+    """
+    def __init__(self, model: T3TorchModel, max_model_len: int = 1000, max_batch_size: int = 10, cfg_scale: float = 0.5):
+        self.model = model
+        self.tokenizer = EnTokenizer.from_pretrained()
+        self.max_model_len = max_model_len
+        self.max_batch_size = max_batch_size
+        self.cfg_scale = cfg_scale
+        self.n_branches = 2 if cfg_scale != 0 else 1
+        self.waiting: list[T3Sequence] = []
+        self.running: list[T3Sequence] = []
+        print("[T3] Torch backend, CFG scale:", cfg_scale if cfg_scale != 0 else "disabled")
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.speech_head.weight.device
+
+    @property
+    def capacity(self) -> int:
+        return self.max_batch_size
+
+    def make_sampling_params(self, *args, **kwargs) -> T3SamplingParams:
+        return T3SamplingParams(*args, **kwargs)
+
+    def submit(self, request_id: str, prompt: str, cond_emb: torch.Tensor, sampling_params: T3SamplingParams):
+        if sampling_params.n != 1:
+            raise ValueError("The torch T3 backend only supports n=1")
+        text_ids = torch.tensor(self.tokenizer.encode(prompt), dtype=torch.long, device=self.device)
+        cond_emb = cond_emb.to(self.device)
+        with torch.inference_mode():
+            prompt_embeds = self.model.embed_prompt(text_ids, cond_emb, cfg=self.n_branches == 2)
+
+        generator = torch.Generator(device=self.device)
+        if sampling_params.seed is not None:
+            generator.manual_seed(sampling_params.seed)
+        else:
+            generator.seed()
+
+        self.waiting.append(T3Sequence(
+            request_id=request_id,
+            sampling_params=sampling_params,
+            prompt_embeds=prompt_embeds,
+            prompt_len=prompt_embeds.size(1),
+            cache=T3KVCache(self.model.config, self.n_branches, self.device, prompt_embeds.dtype),
+            generator=generator,
+        ))
+
+    def abort(self, request_ids: list[str]):
+        request_ids = set(request_ids)
+        self.waiting = [seq for seq in self.waiting if seq.request_id not in request_ids]
+        self.running = [seq for seq in self.running if seq.request_id not in request_ids]
+
+    def has_unfinished_requests(self) -> bool:
+        return bool(self.waiting or self.running)
+
+    @torch.inference_mode()
+    def step(self) -> list[T3RequestOutput]:
+        decoding = list(self.running)
+        outputs = []
+
+        while self.waiting and len(self.running) < self.max_batch_size:
+            seq = self.waiting.pop(0)
+            logits = self.model(seq.prompt_embeds, [seq.cache])
+            seq.prompt_embeds = None
+            self.running.append(seq)
+            outputs += self.sample([seq], logits)
+
+        if decoding:
+            last_tokens = torch.tensor([seq.token_ids[-1] for seq in decoding], device=self.device)
+            embeds = self.model.speech_emb(last_tokens).repeat_interleave(self.n_branches, dim=0)[:, None]
+            logits = self.model(embeds, [seq.cache for seq in decoding])
+            outputs += self.sample(decoding, logits)
+
+        finished = {output.request_id for output in outputs if output.finished}
+        self.running = [seq for seq in self.running if seq.request_id not in finished]
+        return outputs
+
+    def sample(self, seqs: list[T3Sequence], logits: torch.Tensor) -> list[T3RequestOutput]:
+        logits = logits.view(len(seqs), self.n_branches, -1)
+        if self.n_branches == 2:
+            cond_logits, uncond_logits = logits.unbind(1)
+            logits = cond_logits + self.cfg_scale * (cond_logits - uncond_logits)
+        else:
+            logits = logits[:, 0]
+        # The top of the speech vocabulary is reserved for vLLM's shifted prompt ids, see T3VllmModel.compute_logits
+        logits[:, PREFILL_TOKEN_OFFSET:] = float("-inf")
+
+        outputs = []
+        for seq, seq_logits in zip(seqs, logits):
+            sp = seq.sampling_params
+            token = self.sample_token(seq, seq_logits)
+            seq.token_ids.append(token)
+            max_tokens = sp.max_tokens if sp.max_tokens is not None else self.max_model_len
+            finished = (
+                (token in sp.stop_token_ids and len(seq.token_ids) >= sp.min_tokens)
+                or len(seq.token_ids) >= max_tokens
+                or seq.prompt_len + len(seq.token_ids) >= self.max_model_len
+            )
+            outputs.append(T3RequestOutput(seq.request_id, [T3CompletionOutput(list(seq.token_ids))], finished))
+        return outputs
+
+    def sample_token(self, seq: T3Sequence, logits: torch.Tensor) -> int:
+        """Apply the penalties and filters of `seq.sampling_params` to [vocab] logits, in vLLM's order, and sample"""
+        sp = seq.sampling_params
+        if seq.token_ids:
+            output_ids = torch.tensor(seq.token_ids, device=logits.device)
+            if sp.repetition_penalty != 1.0:
+                seen = output_ids.unique()
+                logits[seen] = torch.where(logits[seen] > 0, logits[seen] / sp.repetition_penalty, logits[seen] * sp.repetition_penalty)
+            if sp.frequency_penalty != 0 or sp.presence_penalty != 0:
+                counts = torch.bincount(output_ids, minlength=logits.size(0)).to(logits.dtype)
+                logits -= sp.frequency_penalty * counts + sp.presence_penalty * (counts > 0).to(logits.dtype)
+        if len(seq.token_ids) < sp.min_tokens:
+            logits[list(sp.stop_token_ids)] = float("-inf")
+
+        if sp.temperature < 1e-5:
+            return logits.argmax().item()
+
+        logits = logits / sp.temperature
+        if sp.top_k is not None and sp.top_k > 0:
+            logits[logits < logits.topk(sp.top_k).values[-1]] = float("-inf")
+        probs = logits.softmax(dim=-1)
+        if sp.top_p < 1.0:
+            sorted_probs, sorted_ids = probs.sort(descending=True)
+            # Keep the most likely tokens until their mass reaches top_p, including the one that crosses it
+            sorted_probs[sorted_probs.cumsum(dim=-1) - sorted_probs > sp.top_p] = 0
+            probs = torch.zeros_like(probs).scatter_(0, sorted_ids, sorted_probs)
+        if sp.min_p > 0:
+            probs[probs < sp.min_p * probs.max()] = 0
+        return torch.multinomial(probs, 1, generator=seq.generator).item()
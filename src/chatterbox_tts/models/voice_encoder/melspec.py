@@ -3,6 +3,8 @@ from functools import lru_cache
 from scipy import signal
 import numpy as np
 import librosa
+import torch
+from torch import nn, Tensor
 
 
 @lru_cache()
@@ -76,3 +78,59 @@ def _normalize(s, hp, headroom_db=15):
     min_level_db = 20 * np.log10(hp.stft_magnitude_min)
     s = (s - min_level_db) / (-min_level_db + headroom_db)
     return s
+
+
+class MelSpectrogram(nn.Module):
+    """
+    Torch implementation of `melspectrogram`, matching its output (up to float32 precision) on any device.
+    The filterbank and window are non-persistent buffers, so they follow the module's device
+    without appearing in the state dict.
+    """
+
+    def __init__(self, hp):
+        super().__init__()
+        self.hp = hp
+        self.register_buffer("mel_basis", torch.from_numpy(mel_basis(hp)).float(), persistent=False)
+        # librosa's "hann" window is periodic, like torch's default
+        self.register_buffer("window", torch.hann_window(hp.win_size), persistent=False)
+
+    def forward(self, wav: Tensor, pad=True) -> Tensor:
+        """
+        :param wav: (T,) or (B, T) waveforms
+        :return: (M, T') or (B, M, T') mels
+        """
+        hp = self.hp
+
+        # Run through pre-emphasis
+        if hp.preemphasis > 0:
+            wav = torch.cat([wav[..., :1], wav[..., 1:] - hp.preemphasis * wav[..., :-1]], dim=-1)
+            wav = wav.clamp(-1, 1)
+
+        # Do the stft
+        spec_complex = torch.stft(
+            wav,
+            n_fft=hp.n_fft,
+            hop_length=hp.hop_size,
+            win_length=hp.win_size,
+            window=self.window,
+            center=pad,
+            pad_mode="reflect",
+            return_complex=True,
+        )
+
+        # Get the magnitudes
+        spec_magnitudes = spec_complex.abs()
+
+        if hp.mel_power != 1.0:
+            spec_magnitudes = spec_magnitudes ** hp.mel_power
+
+        # Get the mel and convert magnitudes->db
+        mel = self.mel_basis @ spec_magnitudes
+        if hp.mel_type == "db":
+            mel = 20 * torch.log10(mel.clamp(min=hp.stft_magnitude_min))
+
+        # Normalise the mel from db to 0,1
+        if hp.normalized_mels:
+            mel = _normalize(mel, hp)
+
+        return mel
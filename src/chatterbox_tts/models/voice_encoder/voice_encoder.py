@@ -10,7 +10,7 @@ import torch.nn.functional as F
 from torch import nn, Tensor
 
 from .config import VoiceEncConfig
-from .melspec import melspectrogram
+from .melspec import MelSpectrogram
 
 
 def pack(arrays, seq_len: int=None, pad_value=0):
@@ -128,6 +128,9 @@ class VoiceEncoder(nn.Module):
             self.lstm.flatten_parameters()
         self.proj = nn.Linear(self.hp.ve_hidden_size, self.hp.speaker_embed_size)
 
+        # Mel front end (non-persistent buffers only, so the state dict is unchanged)
+        self.melspec = MelSpectrogram(self.hp)
+
         # Cosine similarity scaling (fixed initial parameter values)
         self.similarity_weight = nn.Parameter(torch.tensor([10.]), requires_grad=True)
         self.similarity_bias = nn.Parameter(torch.tensor([-5.]), requires_grad=True)
@@ -136,6 +139,14 @@ class VoiceEncoder(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
+    def freeze_for_inference(self):
+        """Drop the similarity scaling, which only the training loss uses, and stop tracking gradients"""
+        self.eval()
+        del self.similarity_weight
+        del self.similarity_bias
+        self.lstm.flatten_parameters()
+        self.requires_grad_(False)
+
     def forward(self, mels: torch.FloatTensor):
         """
         Computes the embeddings of a batch of partial utterances.
@@ -178,22 +189,21 @@ class VoiceEncoder(nn.Module):
             pad = torch.full((mels.size(0), len_diff, self.hp.num_mels), 0, dtype=torch.float32)
             mels = torch.cat((mels, pad.to(mels.device)), dim=1)
 
-        # Group all partials together so that we can batch them easily
-        partials = [
-            mel[i * frame_step: i * frame_step + self.hp.ve_partial_frames]
-            for mel, n_partial in zip(mels, n_partials) for i in range(n_partial)
-        ]
-        assert all(partials[0].shape == partial.shape for partial in partials)
-        partials = torch.stack(partials)
+        # Group all partials together so that we can batch them easily: (B, W, P, M) strided view of every
+        # window position, of which the first n_partials of each utterance are kept
+        windows = mels.unfold(1, self.hp.ve_partial_frames, frame_step).transpose(2, 3)
+        n_partials = torch.tensor(n_partials)
+        valid = torch.arange(windows.size(1))[None, :] < n_partials[:, None]
+        partials = windows[valid.to(mels.device)]
 
         # Forward the partials
         n_chunks = int(np.ceil(len(partials) / (batch_size or len(partials))))
         partial_embeds = torch.cat([self(batch) for batch in partials.chunk(n_chunks)], dim=0).cpu()
 
         # Reduce the partial embeds into full embeds and L2-normalize them
-        slices = np.concatenate(([0], np.cumsum(n_partials)))
-        raw_embeds = [torch.mean(partial_embeds[start:end], dim=0) for start, end in zip(slices[:-1], slices[1:])]
-        raw_embeds = torch.stack(raw_embeds)
+        owners = torch.repeat_interleave(torch.arange(len(n_partials)), n_partials)
+        raw_embeds = torch.zeros(len(n_partials), partial_embeds.size(1)).index_add_(0, owners, partial_embeds)
+        raw_embeds = raw_embeds / n_partials[:, None]
         embeds = raw_embeds / torch.linalg.norm(raw_embeds, dim=1, keepdim=True)
 
         return embeds
@@ -218,12 +228,12 @@ class VoiceEncoder(nn.Module):
         return embeds_x @ embeds_y
 
     def embeds_from_mels(
-        self, mels: Union[Tensor, List[np.ndarray]], mel_lens=None, as_spk=False, batch_size=32, **kwargs
+        self, mels: Union[Tensor, List[np.ndarray], List[Tensor]], mel_lens=None, as_spk=False, batch_size=32, **kwargs
     ):
         """
         Convenience function for deriving utterance or speaker embeddings from mel spectrograms.
 
-        :param mels: unscaled mels strictly within [0, 1] as either a (B, T, M) tensor or a list of (Ti, M) arrays.
+        :param mels: unscaled mels strictly within [0, 1] as either a (B, T, M) tensor or a list of (Ti, M) arrays / tensors.
         :param mel_lens: if passing mels as a tensor, individual mel lengths
         :param as_spk: whether to return utterance embeddings or a single speaker embedding
         :param kwargs: args for inference()
@@ -232,7 +242,7 @@ class VoiceEncoder(nn.Module):
         """
         # Load mels in memory and pack them
         if isinstance(mels, List):
-            mels = [np.asarray(mel) for mel in mels]
+            mels = [torch.as_tensor(mel) for mel in mels]
             assert all(m.shape[1] == mels[0].shape[1] for m in mels), "Mels aren't in (B, T, M) format"
             mel_lens = [mel.shape[0] for mel in mels]
             mels = pack(mels)
@@ -269,6 +279,7 @@ class VoiceEncoder(nn.Module):
         if "rate" not in kwargs:
             kwargs["rate"] = 1.3  # Resemble's default value.
 
-        mels = [melspectrogram(w, self.hp).T for w in wavs]
+        with torch.inference_mode():
+            mels = [self.melspec(torch.as_tensor(w, dtype=torch.float32, device=self.device)).T for w in wavs]
 
         return self.embeds_from_mels(mels, as_spk=as_spk, batch_size=batch_size, **kwargs)
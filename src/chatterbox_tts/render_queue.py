@@ -0,0 +1,76 @@
+from concurrent.futures import Executor, Future
+from typing import TYPE_CHECKING, Any
+import threading
+
+import torch
+
+if TYPE_CHECKING:
+    from .tts import ChatterboxTTS
+
+
+class RenderQueue:
+    """
+    Batches S3Gen renders on the model's S3Gen worker thread.
+
+    Speech tokens can be submitted from any thread, one utterance at a time, as soon as T3 finishes them.
+    Everything submitted while S3Gen is busy goes into the next batch, which renders as a single
+    `S3Token2Wav.inference_batch` call. Early prompts therefore start rendering right away, and the rest
+    come in a handful of batched passes. Returns a future per utterance, resolving to its waveform on CPU.
+    """
+
+    def __init__(self, model: "ChatterboxTTS", worker: Executor):
+        self.model = model
+        self.worker = worker
+        self.lock = threading.Lock()
+        self.waiting: list[tuple[torch.Tensor, dict[str, Any], int, Future]] = []
+        self.busy = False
+
+    def submit(self, speech_tokens: torch.Tensor, s3gen_ref: dict[str, Any], diffusion_steps: int = 10) -> Future:
+        future = Future()
+        with self.lock:
+            self.waiting.append((speech_tokens, s3gen_ref, diffusion_steps, future))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        with self.lock:
+            if self.busy or not self.waiting:
+                return
+            batch, self.waiting = self.waiting, []
+            self.busy = True
+
+        try:
+            self.worker.submit(self._render, batch)
+        except RuntimeError:
+            # The worker has been shut down
+            for *_, future in batch:
+                future.cancel()
+            with self.lock:
+                self.busy = False
+            # Cancel whatever was submitted in the meantime too, rather than leave it waiting forever
+            self._dispatch()
+
+    def _render(self, batch: list[tuple[torch.Tensor, dict[str, Any], int, Future]]):
+        try:
+            # Skip utterances whose caller has already given up
+            batch = [item for item in batch if item[3].set_running_or_notify_cancel()]
+
+            for diffusion_steps in sorted({item[2] for item in batch}):
+                items = [item for item in batch if item[2] == diffusion_steps]
+                try:
+                    wavs = self.model.render_speech_tokens_batch(
+                        [speech_tokens for speech_tokens, *_ in items],
+                        [s3gen_ref for _, s3gen_ref, *_ in items],
+                        diffusion_steps,
+                    )
+                except Exception as e:
+                    for *_, future in items:
+                        future.set_exception(e)
+                    continue
+
+                for (*_, future), wav in zip(items, wavs):
+                    future.set_result(wav)
+        finally:
+            with self.lock:
+                self.busy = False
+            self._dispatch()
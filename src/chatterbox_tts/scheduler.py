@@ -0,0 +1,225 @@
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, Iterator, Optional, Union
+import threading
+import time
+
+import torch
+
+from .models.t3.engine import SamplingParams
+from .models.t3.modules.input_layout import CONDITIONING_SIZE
+from .tts import GenerationItem
+
+
+@dataclass
+class PendingChunk:
+    """A single text chunk waiting to be batched, along with everything needed to render it"""
+    prompt: str
+    cond_emb: torch.Tensor  # Exaggeration already applied
+    s3gen_ref: dict[str, Any]
+    sampling_params: SamplingParams
+    diffusion_steps: int = 10
+    future: Future = field(default_factory=Future)
+
+    @property
+    def token_estimate(self) -> int:
+        # Worst case number of KV slots this chunk can occupy
+        return CONDITIONING_SIZE + len(self.prompt) + 2 + self.sampling_params.max_tokens
+
+
+class BatchScheduler:
+    """
+    Micro-batching scheduler in front of a ChatterboxTTS model.
+
+    Chunks submitted by any number of concurrent callers are collected for up to `batch_window` seconds
+    (or until `max_batch_size` chunks / `max_batch_tokens` tokens are pending) and sent to T3 as a single
+    vLLM batch. Each chunk is rendered by S3Gen with its owner's reference as soon as T3 finishes it, and its
+    future resolved.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = 60,
+        max_batch_tokens: Optional[int] = None,
+        batch_window: float = 0.05,
+        lock: Optional[threading.Lock] = None,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.batch_window = batch_window
+
+        # Held while T3 runs, for callers that still use the model directly
+        self.lock = lock or threading.Lock()
+
+        self.pending: deque[PendingChunk] = deque()
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True, name="tts-batch-scheduler")
+        self.thread.start()
+
+    def submit(
+        self,
+        prompts: Union[str, list[str]],
+        s3gen_ref: dict[str, Any],
+        cond_emb: torch.Tensor,
+        exaggeration: float = 0.5,
+        diffusion_steps: int = 10,
+        *args, **kwargs,
+    ) -> list[Future]:
+        """
+        Queue prompts for generation. Accepts the same sampling arguments as `ChatterboxTTS.generate_with_conds`.
+        Returns one future per prompt, resolving to its waveform.
+        """
+        if isinstance(prompts, str):
+            prompts = [prompts]
+
+        sampling_params = self.model.make_sampling_params(*args, **kwargs)
+        if sampling_params.n != 1:
+            raise ValueError("BatchScheduler only supports n=1")
+
+        cond_emb = self.model.update_exaggeration(cond_emb, exaggeration)
+        return self._enqueue([
+            PendingChunk(
+                prompt=prompt,
+                cond_emb=cond_emb,
+                s3gen_ref=s3gen_ref,
+                sampling_params=sampling_params,
+                diffusion_steps=diffusion_steps,
+            )
+            for prompt in prompts
+        ])
+
+    def submit_items(self, items: list[GenerationItem], diffusion_steps: int = 10) -> list[Future]:
+        """Queue a heterogeneous list of prompts, each with its own voice, exaggeration and sampling params"""
+        chunks = []
+        for item in items:
+            sampling_params = self.model.make_sampling_params(**item.sampling_params)
+            if sampling_params.n != 1:
+                raise ValueError("BatchScheduler only supports n=1")
+
+            s3gen_ref, cond_emb = self.model.get_audio_conditionals(item.voice)
+            chunks.append(PendingChunk(
+                prompt=item.text,
+                cond_emb=self.model.update_exaggeration(cond_emb, item.exaggeration),
+                s3gen_ref=s3gen_ref,
+                sampling_params=sampling_params,
+                diffusion_steps=diffusion_steps,
+            ))
+        return self._enqueue(chunks)
+
+    def _enqueue(self, chunks: list[PendingChunk]) -> list[Future]:
+        with self.cond:
+            if not self.running:
+                raise RuntimeError("BatchScheduler has been shut down")
+            self.pending.extend(chunks)
+            self.cond.notify()
+
+        return [chunk.future for chunk in chunks]
+
+    def generate_stream(
+        self,
+        prompts: Union[str, list[str]],
+        audio_prompt_path: Optional[str] = None,
+        *args, **kwargs,
+    ) -> Iterator[torch.Tensor]:
+        """Same as `ChatterboxTTS.generate_stream`, but batched together with all other in-flight requests"""
+        s3gen_ref, cond_emb = self.model.get_audio_conditionals(audio_prompt_path)
+        yield from self._wait(self.submit(prompts, s3gen_ref, cond_emb, *args, **kwargs))
+
+    def generate(self, *args, **kwargs) -> list[torch.Tensor]:
+        return list(self.generate_stream(*args, **kwargs))
+
+    def generate_items_stream(self, items: list[GenerationItem], diffusion_steps: int = 10) -> Iterator[torch.Tensor]:
+        """Same as `ChatterboxTTS.generate_items_stream`, but batched together with all other in-flight requests"""
+        yield from self._wait(self.submit_items(items, diffusion_steps=diffusion_steps))
+
+    def generate_items(self, items: list[GenerationItem], diffusion_steps: int = 10) -> list[torch.Tensor]:
+        return list(self.generate_items_stream(items, diffusion_steps=diffusion_steps))
+
+    def _wait(self, futures: list[Future]) -> Iterator[torch.Tensor]:
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # Caller went away; don't spend GPU time on chunks nobody is waiting for
+            for future in futures:
+                future.cancel()
+
+    def _take_batch(self) -> list[PendingChunk]:
+        """Wait for work, then collect chunks until the batch window closes or the batch is full"""
+        with self.cond:
+            while self.running and not self.pending:
+                self.cond.wait()
+            if not self.running:
+                return []
+
+            deadline = time.time() + self.batch_window
+            while self.running and len(self.pending) < self.max_batch_size and time.time() < deadline:
+                if self.max_batch_tokens is not None and \
+                        sum(c.token_estimate for c in self.pending) >= self.max_batch_tokens:
+                    break
+                self.cond.wait(timeout=max(0.0, deadline - time.time()))
+
+            batch = []
+            batch_tokens = 0
+            while self.pending and len(batch) < self.max_batch_size:
+                chunk = self.pending[0]
+                if self.max_batch_tokens is not None and batch and \
+                        batch_tokens + chunk.token_estimate > self.max_batch_tokens:
+                    break
+                self.pending.popleft()
+                # Skip chunks whose caller has already given up
+                if chunk.future.set_running_or_notify_cancel():
+                    batch.append(chunk)
+                    batch_tokens += chunk.token_estimate
+            return batch
+
+    def _run(self):
+        while self.running:
+            batch = self._take_batch()
+            if not batch:
+                continue
+
+            print(f"[SCHEDULER] Running batch of {len(batch)} chunks")
+            started = set()
+            try:
+                # Each chunk goes to the S3Gen render queue as soon as T3 finishes it. Only T3 needs the lock, so the
+                # next batch can start decoding while the last chunks of this one are still rendering.
+                with self.lock:
+                    for i, speech_tokens in self.model.generate_speech_tokens_stream(
+                        [chunk.prompt for chunk in batch],
+                        cond_embs=[chunk.cond_emb for chunk in batch],
+                        sampling_params=[chunk.sampling_params for chunk in batch],
+                    ):
+                        chunk = batch[i]
+                        render = self.model.renderer.submit(speech_tokens[0], chunk.s3gen_ref, chunk.diffusion_steps)
+                        render.add_done_callback(partial(self._resolve, chunk))
+                        started.add(i)
+            except Exception as e:
+                print(f"[SCHEDULER] Error generating speech tokens: {e}")
+                for i, chunk in enumerate(batch):
+                    if i not in started:
+                        chunk.future.set_exception(e)
+
+    @staticmethod
+    def _resolve(chunk: PendingChunk, render: Future):
+        if render.cancelled():
+            # The chunk's own future is already running, so it can't be cancelled anymore
+            chunk.future.set_exception(RuntimeError("Rendering was cancelled"))
+        elif render.exception() is not None:
+            print(f"[SCHEDULER] Error rendering speech: {render.exception()}")
+            chunk.future.set_exception(render.exception())
+        else:
+            chunk.future.set_result(render.result())
+
+    def shutdown(self):
+        with self.cond:
+            self.running = False
+            pending, self.pending = self.pending, deque()
+            self.cond.notify_all()
+        for chunk in pending:
+            chunk.future.cancel()
@@ -1,11 +1,12 @@
-from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional, Union, Tuple, Any
+from typing import Iterator, Optional, Union, Tuple, Any
+import itertools
+import os
 import time
 
-from vllm import LLM, SamplingParams
-from functools import lru_cache
-
 import librosa
 import torch
 import torch.nn.functional as F
@@ -17,10 +18,14 @@ from chatterbox_tts.models.t3.modules.t3_config import T3Config
 from .models.s3tokenizer import S3_SR, drop_invalid_tokens
 from .models.s3gen import S3GEN_SR, S3Gen
 from .models.voice_encoder import VoiceEncoder
-from .models.t3 import SPEECH_TOKEN_OFFSET
 from .models.t3.modules.cond_enc import T3Cond, T3CondEnc
 from .models.t3.modules.learned_pos_emb import LearnedPositionEmbeddings
+from .models.t3.engine import SamplingParams, T3Engine, T3MockEngine, T3VllmEngine
+from .models.t3.t3_torch import T3TorchEngine, T3TorchModel
 from .text_utils import punc_norm
+from .cache import SpeechCache, dict_fingerprint, tensor_fingerprint
+from .voices import Voice, VoiceRegistry
+from .render_queue import RenderQueue
 
 REPO_ID = "ResembleAI/chatterbox"
 
@@ -51,20 +56,42 @@ class Conditionals:
                 self.gen[k] = v.to(device=device)
         return self
 
+    def save(self, fpath):
+        # Clone so that views into batched tensors don't serialise the whole batch
+        t3 = {
+            k: getattr(self.t3, k).detach().cpu().clone()
+            for k in ('speaker_emb', 'clap_emb', 'cond_prompt_speech_tokens', 'cond_prompt_speech_emb', 'emotion_adv')
+        }
+        gen = {k: v.detach().cpu().clone() if torch.is_tensor(v) else v for k, v in self.gen.items()}
+        torch.save(dict(t3=t3, gen=gen), fpath)
+
     @classmethod
     def load(cls, fpath):
-        kwargs = torch.load(fpath, weights_only=True)
+        kwargs = torch.load(fpath, map_location="cpu", weights_only=True)
         return cls(T3Cond(**kwargs['t3']), kwargs['gen'])
 
 
+@dataclass
+class GenerationItem:
+    """A single prompt of a heterogeneous batch, see `ChatterboxTTS.generate_items`"""
+    text: str
+    voice: Optional[str] = None  # Reference audio of the voice to use; None for the default voice
+    exaggeration: float = 0.5
+
+    # Keyword arguments for `ChatterboxTTS.make_sampling_params` (temperature, top_p, min_p, ...)
+    sampling_params: dict[str, Any] = field(default_factory=dict)
+
+
 class ChatterboxTTS:
     ENC_COND_LEN = 6 * S3_SR
     DEC_COND_LEN = 10 * S3GEN_SR
 
     def __init__(self, target_device: str, max_model_len: int,
-                 t3: LLM, t3_config: T3Config, t3_cond_enc: T3CondEnc, 
+                 t3: T3Engine, t3_config: T3Config, t3_cond_enc: T3CondEnc, 
                  t3_speech_emb: torch.nn.Embedding, t3_speech_pos_emb: LearnedPositionEmbeddings,
-                 s3gen: S3Gen, ve: VoiceEncoder, default_conds: Conditionals):
+                 s3gen: S3Gen, ve: VoiceEncoder, default_conds: Conditionals,
+                 cache: Optional[SpeechCache] = None,
+                 voice_dir: Optional[str | Path] = None, max_voice_bytes: int = 512 * 1024 * 1024):
         self.target_device = target_device
         self.max_model_len = max_model_len
         self.t3 = t3
@@ -77,6 +104,19 @@ class ChatterboxTTS:
         self.ve = ve
         self.default_conds = default_conds
 
+        # Optional cache of speech tokens and rendered audio
+        self.cache = cache
+
+        # Enrolled voices, persisted to voice_dir if set
+        self.voices = VoiceRegistry(self, voice_dir=voice_dir, max_bytes=max_voice_bytes)
+        self.default_voice: Optional[Voice] = None
+
+        # S3Gen runs on its own thread, so audio for finished prompts renders while T3 is still decoding the rest
+        self.s3gen_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="s3gen")
+        # Prompts that finish while S3Gen is busy are rendered together in one batch
+        self.renderer = RenderQueue(self, self.s3gen_worker)
+        self.request_ids = itertools.count()
+
     @property
     def sr(self) -> int:
         """Sample rate of synthesized audio"""
@@ -89,8 +129,78 @@ class ChatterboxTTS:
 
                    # Original Chatterbox defaults this to False. I don't see a substantial performance difference when running with FP16.
                    s3gen_use_fp16: bool = False,
+
+                   # ODE solver and time schedule of the S3Gen flow matching decoder, see models/s3gen/ode_solvers.py.
+                   # Compare them at a given number of estimator evaluations with benchmarks/bench_cfm_solvers.py.
+                   s3gen_solver: str = "euler",
+                   s3gen_t_scheduler: str = "cosine",
+
+                   # Run the S3Gen decoder's mid blocks on every n-th estimator evaluation only, reusing their output
+                   # in between. 1 disables it; see benchmarks/bench_deep_cache.py for the quality/latency trade-off.
+                   s3gen_deep_cache_interval: int = 1,
+
+                   # Only apply S3Gen's classifier-free guidance for t in this interval of the ODE (0 is noise, 1 is
+                   # the mel). The estimator runs at half the batch for the rest; see benchmarks/bench_cfg_interval.py.
+                   s3gen_cfg_interval: tuple[float, float] = (0.0, 1.0),
+
+                   # "sdpa" runs S3Gen's encoder and decoder attention through fused scaled_dot_product_attention
+                   # kernels, "eager" through explicit matmuls. See benchmarks/bench_attention.py.
+                   s3gen_attention_backend: str = "sdpa",
+
+                   # Vocode mels longer than this many frames (50 per second) in overlapping windows, optionally on a
+                   # thread pool, to bound HiFT's memory and use more CPU cores. 0 vocodes the whole mel at once.
+                   # See benchmarks/bench_hift_chunks.py.
+                   s3gen_hift_chunk_frames: int = 0,
+                   s3gen_hift_chunk_workers: int = 1,
+
+                   # Fold BatchNorms and weight norms into the conv weights after loading, see S3Gen.freeze_for_inference
+                   freeze_for_inference: bool = True,
+
+                   # Optional cache of speech tokens and rendered audio, see chatterbox_tts.cache
+                   cache: Optional[SpeechCache] = None,
+
+                   # Directory enrolled voices are persisted to, see chatterbox_tts.voices
+                   voice_dir: Optional[str | Path] = None,
+                   max_voice_bytes: int = 512 * 1024 * 1024,
+
+                   # Classifier-free guidance weight for T3. Defaults to CHATTERBOX_CFG_SCALE, or 0.5.
+                   # 0 disables CFG: T3 then only runs the conditional half, roughly halving its compute.
+                   cfg_scale: Optional[float] = None,
+
+                   # "vllm", or "torch" for the pure PyTorch T3 in models/t3/t3_torch.py. Defaults to vLLM on CUDA and
+                   # torch otherwise, so target_device="cpu" runs the whole pipeline without a GPU.
+                   # "mock" replaces T3 with deterministic tokens at t3_mock_tokens_per_second per sequence, to load
+                   # test everything around it, see models/t3/engine.py and benchmarks/bench_mock_t3.py.
+                   t3_backend: Optional[str] = None,
+                   t3_mock_tokens_per_second: float = 50.0,
+                   # Weights and KV cache dtype of the torch T3 backend. Defaults to bfloat16 on CUDA and float32 on CPU,
+                   # where bfloat16 matmuls are only fast with AVX512-BF16 / AMX.
+                   t3_dtype: Optional[str] = None,
+
+                   # Run S3Gen's flow (conformer encoder and CFM decoder) under autocast to this dtype, e.g. "bfloat16"
+                   # on CPU. HiFT always runs in float32. None keeps everything in float32.
+                   s3gen_dtype: Optional[str] = None,
+
+                   # Intra-op and inter-op thread pools of torch, for CPU deployments. None keeps torch's defaults.
+                   num_threads: Optional[int] = None,
+                   num_interop_threads: Optional[int] = None,
                    **kwargs) -> 'ChatterboxTTS':
         ckpt_dir = Path(ckpt_dir)
+        if cfg_scale is None:
+            cfg_scale = float(os.environ.get("CHATTERBOX_CFG_SCALE", "0.5"))
+        if t3_backend is None:
+            t3_backend = "vllm" if str(target_device).startswith("cuda") else "torch"
+        if t3_backend not in ("vllm", "torch", "mock"):
+            raise ValueError(f"Unknown T3 backend: {t3_backend}")
+
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        if num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError as e:
+                # Can only be set once, before any inter-op parallel work
+                print(f"[CPU] Could not set the inter-op threads: {e}")
 
         t3_config = T3Config()
 
@@ -109,36 +219,35 @@ class ChatterboxTTS:
         t3_speech_pos_emb.load_state_dict({ k.replace('speech_pos_emb.', ''):v for k,v in t3_weights.items() if k.startswith('speech_pos_emb.') })
         t3_speech_pos_emb = t3_speech_pos_emb.to(device=target_device).eval()
 
-        total_gpu_memory = torch.cuda.get_device_properties(0).total_memory
-        unused_gpu_memory = total_gpu_memory - torch.cuda.memory_allocated()
-        
-        # Heuristic: rough calculation for what percentage of GPU memory to give to vLLM.
-        # Tune this until the 'Maximum concurrency for ___ tokens per request: ___x' is just over 1.
-        # This rough heuristic gives 1.55GB for the model weights plus 128KB per token.
-        vllm_memory_needed = (1.55*1024*1024*1024) + (max_batch_size * max_model_len * 1024 * 128)
-        vllm_memory_percent = vllm_memory_needed / unused_gpu_memory
-
-        print(f"Giving vLLM {vllm_memory_percent * 100:.2f}% of GPU memory ({vllm_memory_needed / 1024**2:.2f} MB)")
-
-        base_vllm_kwargs = {
-            "model": "./t3-model",
-            "task": "generate",
-            "tokenizer": "EnTokenizer",
-            "tokenizer_mode": "custom",
-            "gpu_memory_utilization": vllm_memory_percent,
-            "enforce_eager": not compile,
-            "max_model_len": max_model_len,
-        }
-
-        t3 = LLM(**{**base_vllm_kwargs, **kwargs})
+        if t3_backend == "torch":
+            if t3_dtype is None:
+                t3_dtype = "bfloat16" if str(target_device).startswith("cuda") else "float32"
+            t3_model = T3TorchModel.from_state_dict(t3_weights, device=target_device, dtype=getattr(torch, t3_dtype))
+            t3 = T3TorchEngine(t3_model, max_model_len=max_model_len, max_batch_size=max_batch_size, cfg_scale=cfg_scale)
+        elif t3_backend == "mock":
+            t3 = T3MockEngine(max_model_len=max_model_len, max_batch_size=max_batch_size,
+                              tokens_per_second=t3_mock_tokens_per_second)
+        else:
+            t3 = T3VllmEngine.from_model_dir("./t3-model", max_model_len=max_model_len, max_batch_size=max_batch_size,
+                                             cfg_scale=cfg_scale, compile=compile, **kwargs)
 
         ve = VoiceEncoder()
         ve.load_state_dict(load_file(ckpt_dir / "ve.safetensors"))
         ve = ve.to(device=target_device).eval()
-
-        s3gen = S3Gen(use_fp16=s3gen_use_fp16)
+        if freeze_for_inference:
+            ve.freeze_for_inference()
+
+        s3gen = S3Gen(
+            use_fp16=s3gen_use_fp16, solver=s3gen_solver, t_scheduler=s3gen_t_scheduler,
+            deep_cache_interval=s3gen_deep_cache_interval, cfg_interval=s3gen_cfg_interval,
+            attention_backend=s3gen_attention_backend,
+            hift_chunk_frames=s3gen_hift_chunk_frames, hift_chunk_workers=s3gen_hift_chunk_workers,
+            autocast_dtype=getattr(torch, s3gen_dtype) if s3gen_dtype is not None else None,
+        )
         s3gen.load_state_dict(load_file(ckpt_dir / "s3gen.safetensors"), strict=False)
         s3gen = s3gen.to(device=target_device).eval()
+        if freeze_for_inference:
+            s3gen.freeze_for_inference()
 
         default_conds = Conditionals.load(ckpt_dir / "conds.pt")
         default_conds.to(device=target_device)
@@ -146,7 +255,8 @@ class ChatterboxTTS:
         return cls(
             target_device=target_device, max_model_len=max_model_len,
             t3=t3, t3_config=t3_config, t3_cond_enc=t3_enc, t3_speech_emb=t3_speech_emb, t3_speech_pos_emb=t3_speech_pos_emb,
-            s3gen=s3gen, ve=ve, default_conds=default_conds,
+            s3gen=s3gen, ve=ve, default_conds=default_conds, cache=cache,
+            voice_dir=voice_dir, max_voice_bytes=max_voice_bytes,
         )
 
     @classmethod
@@ -165,39 +275,86 @@ class ChatterboxTTS:
 
         return cls.from_local(Path(local_path).parent, *args, **kwargs)
 
-    @lru_cache(maxsize=10)
-    def get_audio_conditionals(self, wav_fpath: Optional[str] = None) -> Tuple[dict[str, Any], torch.Tensor]:
-        if wav_fpath is None:
-            s3gen_ref_dict = self.default_conds.gen
-            t3_cond_prompt_tokens = self.default_conds.t3.cond_prompt_speech_tokens
-            ve_embed = self.default_conds.t3.speaker_emb
+    def get_audio_conditionals(self, voice: Optional[str] = None) -> Tuple[dict[str, Any], torch.Tensor]:
+        """
+        Get the S3Gen reference dict and T3 conditionals embedding of a voice.
+        `voice` is the ID or name of an enrolled voice, or the path to a reference audio file, which is
+        enrolled on first use. None selects the built-in default voice.
+        """
+        if voice is None:
+            if self.default_voice is None:
+                self.default_voice = Voice(
+                    id="default", name=None, s3gen_ref=self.default_conds.gen,
+                    cond_emb=self.embed_conditionals(self.default_conds),
+                )
+            return self.default_voice.s3gen_ref, self.default_voice.cond_emb
+
+        if voice in self.voices:
+            v = self.voices.get(voice)
         else:
-            ## Load reference wav
-            s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
-            ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
+            v = self.voices.enroll(voice)
+        return v.s3gen_ref, v.cond_emb
+
+    def prepare_conditionals(self, wav_fpath: str) -> Conditionals:
+        """Run the full enrollment pipeline over a reference audio file"""
+        return self.prepare_conditionals_batch([wav_fpath])[0]
+
+    def prepare_conditionals_batch(self, wav_fpaths: list[str], num_workers: int = 8) -> list[Conditionals]:
+        """
+        Run the enrollment pipeline over many reference audio files at once.
+        Files are decoded (and resampled once to both 16 kHz and 24 kHz) in parallel threads, then the
+        tokenizer, speaker encoder and voice encoder stages run batched over all clips.
+        """
+        def load(wav_fpath):
+            wav, sr = librosa.load(wav_fpath, sr=None)
+            wav_24k = librosa.resample(wav, orig_sr=sr, target_sr=S3GEN_SR)
+            wav_16k = librosa.resample(wav, orig_sr=sr, target_sr=S3_SR)
+            return wav_24k, wav_16k
+
+        with ThreadPoolExecutor(max_workers=min(num_workers, len(wav_fpaths))) as pool:
+            wavs_24k, wavs_16k = zip(*pool.map(load, wav_fpaths))
 
-            s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-            s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR)
+        with torch.inference_mode():
+            s3gen_ref_dicts = self.s3gen.embed_ref_batch(
+                [wav[:self.DEC_COND_LEN] for wav in wavs_24k],
+                [wav[:self.DEC_COND_LEN * S3_SR // S3GEN_SR] for wav in wavs_16k],
+            )
 
             # Speech cond prompt tokens
             s3_tokzr = self.s3gen.tokenizer
-            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=self.t3_config.speech_cond_prompt_len)
-            t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens)
+            t3_cond_prompt_tokens, t3_cond_prompt_token_lens = s3_tokzr.forward(
+                [wav[:self.ENC_COND_LEN] for wav in wavs_16k], max_len=self.t3_config.speech_cond_prompt_len
+            )
 
-            # Voice-encoder speaker embedding
-            ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR))
-            ve_embed = ve_embed.mean(axis=0, keepdim=True)
+            # Voice-encoder speaker embeddings
+            ve_embeds = torch.from_numpy(self.ve.embeds_from_wavs(list(wavs_16k), sample_rate=S3_SR))
+
+        return [
+            Conditionals(
+                T3Cond(
+                    speaker_emb=ve_embeds[i:i + 1],
+                    cond_prompt_speech_tokens=t3_cond_prompt_tokens[i:i + 1, :t3_cond_prompt_token_lens[i]],
+                    emotion_adv=0.5 * torch.ones(1, 1),
+                ),
+                s3gen_ref_dict,
+            )
+            for i, s3gen_ref_dict in enumerate(s3gen_ref_dicts)
+        ]
 
-        cond_prompt_speech_emb = self.t3_speech_emb(t3_cond_prompt_tokens)[0] + self.t3_speech_pos_emb(t3_cond_prompt_tokens)
+    def embed_conditionals(self, conds: Conditionals) -> torch.Tensor:
+        """Encode the T3 conditionals into the embedding given to vLLM"""
+        with torch.inference_mode():
+            t3_cond_prompt_tokens = conds.t3.cond_prompt_speech_tokens.to(device=self.target_device)
+            cond_prompt_speech_emb = self.t3_speech_emb(t3_cond_prompt_tokens)[0] + self.t3_speech_pos_emb(t3_cond_prompt_tokens)
 
-        cond_emb = self.t3_cond_enc(T3Cond(
-            speaker_emb=ve_embed,
-            cond_prompt_speech_tokens=t3_cond_prompt_tokens,
-            cond_prompt_speech_emb=cond_prompt_speech_emb,
-            emotion_adv=0.5 * torch.ones(1, 1)
-        ).to(device=self.target_device)).to(device="cpu")  # Conditionals need to be given to VLLM in CPU
+            cond_emb = self.t3_cond_enc(T3Cond(
+                speaker_emb=conds.t3.speaker_emb,
+                cond_prompt_speech_tokens=t3_cond_prompt_tokens,
+                cond_prompt_speech_emb=cond_prompt_speech_emb,
+                emotion_adv=0.5 * torch.ones(1, 1)
+            ).to(device=self.target_device)).to(device="cpu")  # Conditionals need to be given to VLLM in CPU
 
-        return s3gen_ref_dict, cond_emb
+        return cond_emb
 
     def update_exaggeration(self, cond_emb: torch.Tensor, exaggeration: float) -> torch.Tensor:
         if exaggeration == 0.5:
@@ -238,7 +395,94 @@ class ChatterboxTTS:
             *args, **kwargs
         )
 
-    def generate_with_conds(
+    def generate_stream(
+        self,
+        prompts: Union[str, list[str]],
+        audio_prompt_path: Optional[str] = None,
+        exaggeration: float = 0.5,
+        temperature: float = 0.8,
+        max_tokens=1000, # Capped at max_model_len
+
+        # From original Chatterbox HF generation args
+        top_p=0.8,
+        repetition_penalty=2.0,
+
+        # Supports anything in https://docs.vllm.ai/en/v0.9.2/api/vllm/index.html?h=samplingparams#vllm.SamplingParams
+        *args, **kwargs,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Same as `generate`, but yields the waveform of each prompt (in order) as soon as S3Gen has rendered it,
+        instead of returning all of them at the end.
+        """
+        s3gen_ref, cond_emb = self.get_audio_conditionals(audio_prompt_path)
+
+        yield from self.generate_with_conds_stream(
+            prompts=prompts,
+            s3gen_ref=s3gen_ref,
+            cond_emb=cond_emb,
+            temperature=temperature,
+            exaggeration=exaggeration,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            *args, **kwargs
+        )
+
+    def generate_incremental_stream(
+        self,
+        prompt: str,
+        audio_prompt_path: Optional[str] = None,
+        exaggeration: float = 0.5,
+        temperature: float = 0.8,
+        max_tokens=1000, # Capped at max_model_len
+        diffusion_steps: int = 10,
+
+        # Speech tokens (25 per second of audio) per streamed chunk. Smaller chunks get the first audio out sooner,
+        # but S3Gen re-runs its flow over the whole utterance for every chunk.
+        token_hop_len: int = 25,
+
+        # From original Chatterbox HF generation args
+        top_p=0.8,
+        repetition_penalty=2.0,
+
+        # Supports anything in https://docs.vllm.ai/en/v0.9.2/api/vllm/index.html?h=samplingparams#vllm.SamplingParams
+        *args, **kwargs,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Stream a single prompt for the lowest latency to first audio. S3Gen renders the speech tokens every
+        `token_hop_len` tokens while T3 is still generating the rest (see `S3Token2Wav.inference_stream`), and the
+        [1, T] waveform chunks are yielded as they come; concatenated, they make up the whole utterance.
+        Unlike the batched paths, this doesn't use the cache. It drives the T3 engine directly, so when the model
+        is shared with a BatchScheduler, hold its lock until the stream is done.
+        """
+        s3gen_ref, cond_emb = self.get_audio_conditionals(audio_prompt_path)
+        sampling_params = self.make_sampling_params(
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            *args, **kwargs,
+        )
+        if sampling_params.n != 1:
+            raise ValueError("Incremental streaming only supports n=1")
+
+        speech_tokens = self._stream_t3_tokens(prompt, self.update_exaggeration(cond_emb, exaggeration), sampling_params)
+        try:
+            for wav in self.s3gen.inference_stream(
+                speech_tokens,
+                ref_dict=s3gen_ref,
+                n_timesteps=diffusion_steps,
+                token_hop_len=token_hop_len,
+            ):
+                yield wav.cpu()
+        finally:
+            # Caller went away; stop T3 too
+            speech_tokens.close()
+
+    def generate_with_conds(self, *args, **kwargs) -> list[any]:
+        return list(self.generate_with_conds_stream(*args, **kwargs))
+
+    def generate_with_conds_stream(
         self,
         prompts: Union[str, list[str]],
         s3gen_ref: dict[str, Any],
@@ -258,70 +502,302 @@ class ChatterboxTTS:
 
         # Supports anything in https://docs.vllm.ai/en/v0.9.2/api/vllm/index.html?h=samplingparams#vllm.SamplingParams
         *args, **kwargs,
-    ) -> list[any]:
+    ) -> Iterator[torch.Tensor]:
         if isinstance(prompts, str):
             prompts = [prompts]
 
         cond_emb = self.update_exaggeration(cond_emb, exaggeration)
 
-        # Norm and tokenize text
-        prompts = ["[START]" + punc_norm(p) + "[STOP]" for p in prompts]
-
-        with torch.inference_mode():
-            start_time = time.time()
-            batch_results = self.t3.generate(
-                [
-                    {
-                        "prompt": text,
-                        "multi_modal_data": {
-                            "conditionals": [cond_emb],
-                        },
-                    }
-                    for text in prompts
-                ],
-                sampling_params=SamplingParams(
+        yield from self.render_stream(
+            self.generate_speech_tokens_stream(
+                prompts,
+                cond_embs=[cond_emb] * len(prompts),
+                sampling_params=self.make_sampling_params(
                     temperature=temperature,
-
-                    stop_token_ids=[self.t3_config.stop_speech_token + SPEECH_TOKEN_OFFSET],
-                    max_tokens=min(max_tokens, self.max_model_len),
+                    max_tokens=max_tokens,
                     top_p=top_p,
                     repetition_penalty=repetition_penalty,
-
                     *args, **kwargs,
+                ),
+            ),
+            s3gen_refs=[s3gen_ref] * len(prompts),
+            diffusion_steps=diffusion_steps,
+        )
+
+    def generate_items(self, items: list[GenerationItem], diffusion_steps: int = 10) -> list[torch.Tensor]:
+        return list(self.generate_items_stream(items, diffusion_steps=diffusion_steps))
+
+    def generate_items_stream(self, items: list[GenerationItem], diffusion_steps: int = 10) -> Iterator[torch.Tensor]:
+        """
+        Generate a batch where every prompt may use its own voice, exaggeration and sampling params.
+        All prompts are scheduled into a single vLLM batch, and each one is rendered by S3Gen with
+        its own voice reference as soon as T3 finishes it. Yields the waveforms in order.
+        """
+        voices = {item.voice: self.get_audio_conditionals(item.voice) for item in items}
+        cond_embs = [self.update_exaggeration(voices[item.voice][1], item.exaggeration) for item in items]
+
+        yield from self.render_stream(
+            self.generate_speech_tokens_stream(
+                [item.text for item in items],
+                cond_embs=cond_embs,
+                sampling_params=[self.make_sampling_params(**item.sampling_params) for item in items],
+            ),
+            s3gen_refs=[voices[item.voice][0] for item in items],
+            diffusion_steps=diffusion_steps,
+        )
+
+    def make_sampling_params(
+        self,
+        temperature: float = 0.8,
+        max_tokens=1000, # Capped at max_model_len
+        top_p=0.8,
+        repetition_penalty=2.0,
+        *args, **kwargs,
+    ) -> SamplingParams:
+        return self.t3.make_sampling_params(
+            temperature=temperature,
+
+            stop_token_ids=[self.t3_config.stop_speech_token],
+            max_tokens=min(max_tokens, self.max_model_len),
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+
+            *args, **kwargs,
+        )
+
+    def generate_speech_tokens(
+        self,
+        prompts: list[str],
+        cond_embs: list[torch.Tensor],
+        sampling_params: Union[SamplingParams, list[SamplingParams]],
+    ) -> list[torch.Tensor]:
+        """
+        Run T3 over a batch of prompts in a single vLLM batch. Every prompt carries its own conditionals
+        (with exaggeration already applied), and optionally its own sampling params.
+        Returns the valid speech tokens of each output, in order (one per prompt unless `n` > 1).
+        """
+        outputs = [None] * len(prompts)
+        for i, prompt_outputs in self.generate_speech_tokens_stream(prompts, cond_embs, sampling_params):
+            outputs[i] = prompt_outputs
+        return [speech_tokens for prompt_outputs in outputs for speech_tokens in prompt_outputs]
+
+    def generate_speech_tokens_stream(
+        self,
+        prompts: list[str],
+        cond_embs: list[torch.Tensor],
+        sampling_params: Union[SamplingParams, list[SamplingParams]],
+    ) -> Iterator[tuple[int, list[torch.Tensor]]]:
+        """
+        Same as `generate_speech_tokens`, but yields `(index, speech_tokens)` for each prompt as soon as it is done,
+        in completion order: cache hits first, then every prompt as soon as vLLM hits its stop token.
+        `speech_tokens` holds one tensor per output.
+        """
+        if not isinstance(sampling_params, list):
+            sampling_params = [sampling_params] * len(prompts)
+
+        # Look up the token cache. Prompts with n > 1 have several outputs and are never cached.
+        keys = [None] * len(prompts)
+        misses = []
+        if self.cache is not None and all(sp.n == 1 for sp in sampling_params):
+            cond_emb_fingerprints = {}
+            for i, (prompt, cond_emb, sp) in enumerate(zip(prompts, cond_embs, sampling_params)):
+                if id(cond_emb) not in cond_emb_fingerprints:
+                    cond_emb_fingerprints[id(cond_emb)] = tensor_fingerprint(cond_emb)
+                keys[i] = self.cache.token_key(
+                    prompt, cond_emb_fingerprints[id(cond_emb)], sp, self.t3.cache_tag, cfg_scale=self.t3.cfg_scale,
                 )
+
+                cached = self.cache.tokens.get(keys[i])
+                if cached is not None:
+                    yield i, [cached.to(self.target_device)]
+                else:
+                    misses.append(i)
+            if len(misses) < len(prompts):
+                print(f"[CACHE] {len(prompts) - len(misses)} of {len(prompts)} prompts found in the token cache")
+        else:
+            misses = list(range(len(prompts)))
+
+        if misses:
+            miss_outputs = self._run_t3_stream(
+                [prompts[i] for i in misses],
+                [cond_embs[i] for i in misses],
+                [sampling_params[i] for i in misses],
             )
-            t3_gen_time = time.time() - start_time
-            print(f"[T3] Speech Token Generation time: {t3_gen_time:.2f}s")
-
-            # run torch gc
-            torch.cuda.empty_cache()
-
-            start_time = time.time()
-            results = []
-            for i, batch_result in enumerate(batch_results):
-                for output in batch_result.outputs:
-                    if i % 5 == 0:
-                        print(f"[S3] Processing prompt {i} of {len(batch_results)}")
-
-                    # Run gc every 10 prompts
-                    if i % 10 == 0:
-                        torch.cuda.empty_cache()
-
-                    speech_tokens = torch.tensor([token - SPEECH_TOKEN_OFFSET for token in output.token_ids], device="cuda")
-                    speech_tokens = drop_invalid_tokens(speech_tokens)
-                    speech_tokens = speech_tokens[speech_tokens < 6561]
-
-                    wav, _ = self.s3gen.inference(
-                        speech_tokens=speech_tokens,
-                        ref_dict=s3gen_ref,
-                        n_timesteps=diffusion_steps,
-                    )
-                    results.append(wav.cpu())
-            s3gen_gen_time = time.time() - start_time
-            print(f"[S3Gen] Wavform Generation time: {s3gen_gen_time:.2f}s")
-
-            return results
-        
+            for j, speech_tokens in miss_outputs:
+                i = misses[j]
+                if keys[i] is not None:
+                    self.cache.tokens.put(keys[i], speech_tokens[0])
+                yield i, speech_tokens
+
+    def _run_t3_stream(
+        self,
+        prompts: list[str],
+        cond_embs: list[torch.Tensor],
+        sampling_params: list[SamplingParams],
+    ) -> Iterator[tuple[int, list[torch.Tensor]]]:
+        """
+        Drive the T3 engine step by step instead of waiting for the whole batch, yielding each prompt's
+        speech tokens as soon as it finishes, while the rest of the batch keeps decoding.
+        """
+        start_time = time.time()
+        pending = {}  # request ID -> index into prompts
+        with torch.inference_mode():
+            for i, (prompt, cond_emb, sp) in enumerate(zip(prompts, cond_embs, sampling_params)):
+                pending[self._add_t3_request(prompt, cond_emb, sp)] = i
+
+        # Closing the stream aborts whatever is left, should the caller go away mid-batch
+        with closing(self.t3.stream(list(pending.keys()))) as request_outputs:
+            while True:
+                # Engine steps and token post-processing run in inference mode, but the results are yielded outside
+                # of it, so the grad mode doesn't leak into the caller while this generator is suspended
+                with torch.inference_mode():
+                    request_output = next(request_outputs, None)
+                    if request_output is None:
+                        break
+                    if not request_output.finished:
+                        continue
+
+                    prompt_outputs = []
+                    for output in request_output.outputs:
+                        speech_tokens = torch.tensor(output.token_ids, device=self.target_device)
+                        speech_tokens = drop_invalid_tokens(speech_tokens)
+                        speech_tokens = speech_tokens[speech_tokens < 6561]
+                        prompt_outputs.append(speech_tokens)
+                yield pending.pop(request_output.request_id), prompt_outputs
+
+        t3_gen_time = time.time() - start_time
+        print(f"[T3] Speech Token Generation time: {t3_gen_time:.2f}s")
+
+        # run torch gc
+        torch.cuda.empty_cache()
+
+    def _add_t3_request(self, prompt: str, cond_emb: torch.Tensor, sampling_params: SamplingParams) -> str:
+        """Queue a prompt in the T3 engine, returning its request ID"""
+        request_id = f"t3-{next(self.request_ids)}"
+
+        # Norm and tokenize text
+        self.t3.submit(request_id, "[START]" + punc_norm(prompt) + "[STOP]", cond_emb, sampling_params)
+        return request_id
+
+    def _stream_t3_tokens(self, prompt: str, cond_emb: torch.Tensor, sampling_params: SamplingParams) -> Iterator[torch.Tensor]:
+        """Run T3 over a single prompt, yielding the valid speech tokens generated by every engine step"""
+        request_id = self._add_t3_request(prompt, cond_emb, sampling_params)
+        num_tokens = 0
+        with closing(self.t3.stream([request_id])) as request_outputs:
+            for request_output in request_outputs:
+                token_ids = request_output.outputs[0].token_ids
+                speech_tokens = torch.tensor(token_ids[num_tokens:], dtype=torch.long, device=self.target_device)
+                num_tokens = len(token_ids)
+                yield speech_tokens[speech_tokens < 6561]
+
+    def render_stream(
+        self,
+        speech_tokens: Iterator[tuple[int, list[torch.Tensor]]],
+        s3gen_refs: list[dict[str, Any]],
+        diffusion_steps: int = 10,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Render the output of `generate_speech_tokens_stream` on the S3Gen worker thread, handing each prompt over
+        as soon as T3 finishes it, so S3Gen overlaps with T3 decoding the rest of the batch. Prompts that finish
+        while S3Gen is busy are rendered together in one batch, see `RenderQueue`.
+        Yields the waveforms in prompt order, each one as soon as it and all the ones before it are rendered.
+        """
+        start_time = time.time()
+        futures: dict[int, list[Future]] = {}
+        next_index = 0
+        try:
+            for n, (i, prompt_outputs) in enumerate(speech_tokens):
+                # Run gc every 10 prompts
+                if n % 10 == 0:
+                    self.s3gen_worker.submit(torch.cuda.empty_cache)
+
+                futures[i] = [
+                    self.renderer.submit(tokens, s3gen_refs[i], diffusion_steps)
+                    for tokens in prompt_outputs
+                ]
+                # Hand out whatever is already rendered, without holding up T3
+                while next_index in futures and all(f.done() for f in futures[next_index]):
+                    for future in futures.pop(next_index):
+                        yield future.result()
+                    next_index += 1
+
+            while next_index in futures:
+                for future in futures.pop(next_index):
+                    yield future.result()
+                next_index += 1
+        finally:
+            # Caller went away; don't spend GPU time on prompts nobody is waiting for
+            for prompt_futures in futures.values():
+                for future in prompt_futures:
+                    future.cancel()
+            if hasattr(speech_tokens, "close"):
+                speech_tokens.close()
+
+        print(f"[S3Gen] Wavform Generation finished {time.time() - start_time:.2f}s after T3 started")
+
+    def wav_key(self, speech_tokens: torch.Tensor, s3gen_ref_fingerprint: str, diffusion_steps: int) -> str:
+        """Cache key of rendered audio, which also depends on how S3Gen is configured to solve the ODE and vocode"""
+        decoder = self.s3gen.flow.decoder
+        return self.cache.wav_key(
+            speech_tokens, s3gen_ref_fingerprint, diffusion_steps,
+            decoder.solver, decoder.t_scheduler, decoder.deep_cache_interval, decoder.cfg_interval,
+            self.s3gen.mel2wav.chunk_frames, self.s3gen.autocast_dtype,
+        )
+
+    def render_speech_tokens(self, speech_tokens: torch.Tensor, s3gen_ref: dict[str, Any], diffusion_steps: int = 10) -> torch.Tensor:
+        """Run S3Gen over the speech tokens of a single prompt, returning the waveform on CPU"""
+        key = None
+        if self.cache is not None:
+            key = self.wav_key(speech_tokens, dict_fingerprint(s3gen_ref), diffusion_steps)
+            cached = self.cache.wavs.get(key)
+            if cached is not None:
+                return cached
+
+        with torch.inference_mode():
+            wav, _ = self.s3gen.inference(
+                speech_tokens=speech_tokens,
+                ref_dict=s3gen_ref,
+                n_timesteps=diffusion_steps,
+            )
+            wav = wav.cpu()
+
+        if key is not None:
+            self.cache.wavs.put(key, wav)
+        return wav
+
+    def render_speech_tokens_batch(
+        self,
+        speech_tokens: list[torch.Tensor],
+        s3gen_refs: list[dict[str, Any]],
+        diffusion_steps: int = 10,
+    ) -> list[torch.Tensor]:
+        """Batched `render_speech_tokens`: every utterance not in the cache goes through one `S3Gen.inference_batch` call"""
+        keys = [None] * len(speech_tokens)
+        wavs = [None] * len(speech_tokens)
+        if self.cache is not None:
+            ref_fingerprints = {}
+            for i, (tokens, s3gen_ref) in enumerate(zip(speech_tokens, s3gen_refs)):
+                if id(s3gen_ref) not in ref_fingerprints:
+                    ref_fingerprints[id(s3gen_ref)] = dict_fingerprint(s3gen_ref)
+                keys[i] = self.wav_key(tokens, ref_fingerprints[id(s3gen_ref)], diffusion_steps)
+                wavs[i] = self.cache.wavs.get(keys[i])
+
+        misses = [i for i in range(len(speech_tokens)) if wavs[i] is None]
+        if misses:
+            with torch.inference_mode():
+                rendered = self.s3gen.inference_batch(
+                    [speech_tokens[i] for i in misses],
+                    [s3gen_refs[i] for i in misses],
+                    n_timesteps=diffusion_steps,
+                )
+            for i, wav in zip(misses, rendered):
+                wavs[i] = wav.cpu()
+                if keys[i] is not None:
+                    self.cache.wavs.put(keys[i], wavs[i])
+        return wavs
+
     def shutdown(self):
+        self.s3gen_worker.shutdown(cancel_futures=True)
+        self.t3.shutdown()
         del self.t3
         torch.cuda.empty_cache()
@@ -0,0 +1,224 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional
+import hashlib
+import json
+import os
+import re
+import threading
+
+import torch
+
+if TYPE_CHECKING:
+    from .tts import ChatterboxTTS
+
+VOICE_ID_PATTERN = re.compile(r"[0-9a-f]{16}")
+
+
+def voice_id_from_bytes(data: bytes) -> str:
+    """Voices are keyed by the content hash of their reference audio"""
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+@dataclass
+class Voice:
+    id: str
+    name: Optional[str]
+    s3gen_ref: dict[str, Any]
+    cond_emb: torch.Tensor  # On CPU, at the default exaggeration of 0.5
+
+    @property
+    def nbytes(self) -> int:
+        tensors = [self.cond_emb] + [v for v in self.s3gen_ref.values() if torch.is_tensor(v)]
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class VoiceRegistry:
+    """
+    Registry of enrolled voices, keyed by the content hash of their reference audio.
+
+    Each voice is stored in `voice_dir` as `<id>.pt` in the `Conditionals` save format, and names are
+    kept in `voices.json`. Loaded voices are held in memory up to `max_bytes`, least recently used first out;
+    evicted voices are reloaded from disk on the next request, which skips the whole enrollment pipeline.
+    """
+
+    def __init__(self, model: "ChatterboxTTS", voice_dir: Optional[str | Path] = None, max_bytes: int = 512 * 1024 * 1024):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.voices: OrderedDict[str, Voice] = OrderedDict()
+        self.size = 0
+        self.names: dict[str, str] = {}  # name -> id
+        self.paths: dict[tuple[str, int, int], str] = {}  # (path, mtime, size) -> id
+        self.lock = threading.RLock()
+
+        self.voice_dir = Path(voice_dir) if voice_dir is not None else None
+        if self.voice_dir is not None:
+            self.voice_dir.mkdir(parents=True, exist_ok=True)
+            if self._names_path().exists():
+                self.names = json.loads(self._names_path().read_text())
+
+    def _names_path(self) -> Path:
+        return self.voice_dir / "voices.json"
+
+    def _voice_path(self, voice_id: str) -> Path:
+        return self.voice_dir / f"{voice_id}.pt"
+
+    def __contains__(self, voice: str) -> bool:
+        return self.resolve(voice) is not None
+
+    def resolve(self, voice: str) -> Optional[str]:
+        """Map a voice ID or name to the ID of an enrolled voice"""
+        with self.lock:
+            if voice in self.voices:
+                return voice
+            if voice in self.names:
+                return self.names[voice]
+            # Only well formed IDs may touch the disk, since voices come straight from API requests
+            if self.voice_dir is not None and VOICE_ID_PATTERN.fullmatch(voice) and self._voice_path(voice).exists():
+                return voice
+            return None
+
+    def list_voices(self) -> list[dict[str, Any]]:
+        with self.lock:
+            ids = set(self.voices.keys())
+            if self.voice_dir is not None:
+                ids.update(p.stem for p in self.voice_dir.glob("*.pt"))
+            id_to_name = {v: k for k, v in self.names.items()}
+            return [{"voice_id": voice_id, "name": id_to_name.get(voice_id), "loaded": voice_id in self.voices} for voice_id in sorted(ids)]
+
+    def get(self, voice: str) -> Voice:
+        """Get an enrolled voice by ID or name, loading it from disk if needed. Raises KeyError if unknown."""
+        with self.lock:
+            voice_id = self.resolve(voice)
+            if voice_id is None:
+                raise KeyError(f"Unknown voice: {voice}")
+
+            if voice_id in self.voices:
+                self.voices.move_to_end(voice_id)
+                return self.voices[voice_id]
+
+            from .tts import Conditionals  # tts imports this module
+            conds = Conditionals.load(self._voice_path(voice_id)).to(device=self.model.target_device)
+            id_to_name = {v: k for k, v in self.names.items()}
+            return self._add(Voice(
+                id=voice_id,
+                name=id_to_name.get(voice_id),
+                s3gen_ref=conds.gen,
+                cond_emb=self.model.embed_conditionals(conds),
+            ))
+
+    def enroll(self, wav_fpath: str | Path, name: Optional[str] = None) -> Voice:
+        """Enroll the reference audio at `wav_fpath`. Enrolling the same audio again is a lookup."""
+        # Avoid re-hashing files that haven't changed since we last saw them
+        stat = os.stat(wav_fpath)
+        path_key = (str(wav_fpath), stat.st_mtime_ns, stat.st_size)
+        voice_id = self.paths.get(path_key)
+        if voice_id is None:
+            voice_id = voice_id_from_bytes(Path(wav_fpath).read_bytes())
+            self.paths[path_key] = voice_id
+
+        with self.lock:
+            if self.resolve(voice_id) is not None:
+                voice = self.get(voice_id)
+                if name is not None and name != voice.name:
+                    self._set_name(voice, name)
+                return voice
+
+        print(f"[VOICES] Enrolling voice {voice_id} from {wav_fpath}")
+        conds = self.model.prepare_conditionals(str(wav_fpath))
+        voice = Voice(id=voice_id, name=None, s3gen_ref=conds.gen, cond_emb=self.model.embed_conditionals(conds))
+
+        with self.lock:
+            if self.voice_dir is not None:
+                conds.save(self._voice_path(voice_id))
+            self._add(voice)
+            if name is not None:
+                self._set_name(voice, name)
+        return voice
+
+    def enroll_batch(self, wav_fpaths: list[str | Path], names: Optional[list[Optional[str]]] = None) -> list[Voice]:
+        """Enroll many reference clips at once; clips that are already enrolled are only looked up"""
+        names = names or [None] * len(wav_fpaths)
+        voice_ids = [voice_id_from_bytes(Path(wav_fpath).read_bytes()) for wav_fpath in wav_fpaths]
+
+        # Only run the pipeline once per new clip, even if it appears several times in the batch
+        with self.lock:
+            new = {}
+            for voice_id, wav_fpath in zip(voice_ids, wav_fpaths):
+                if self.resolve(voice_id) is None and voice_id not in new:
+                    new[voice_id] = wav_fpath
+
+        if new:
+            print(f"[VOICES] Enrolling {len(new)} new voices")
+            for voice_id, conds in zip(new.keys(), self.model.prepare_conditionals_batch([str(p) for p in new.values()])):
+                voice = Voice(id=voice_id, name=None, s3gen_ref=conds.gen, cond_emb=self.model.embed_conditionals(conds))
+                with self.lock:
+                    if self.voice_dir is not None:
+                        conds.save(self._voice_path(voice_id))
+                    self._add(voice)
+
+        voices = []
+        with self.lock:
+            for voice_id, name in zip(voice_ids, names):
+                voice = self.get(voice_id)
+                if name is not None and name != voice.name:
+                    self._set_name(voice, name)
+                voices.append(voice)
+        return voices
+
+    def remove(self, voice: str) -> bool:
+        with self.lock:
+            voice_id = self.resolve(voice)
+            if voice_id is None:
+                return False
+
+            if voice_id in self.voices:
+                self.size -= self.voices.pop(voice_id).nbytes
+            self.names = {k: v for k, v in self.names.items() if v != voice_id}
+            if self.voice_dir is not None:
+                self._voice_path(voice_id).unlink(missing_ok=True)
+                self._save_names()
+            return True
+
+    def preload(self):
+        """Load voices from disk until the memory budget is used up"""
+        if self.voice_dir is None:
+            return
+
+        paths = sorted(self.voice_dir.glob("*.pt"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for path in paths:
+            if self.size >= self.max_bytes:
+                break
+            try:
+                self.get(path.stem)
+            except Exception as e:
+                print(f"[VOICES] Failed to load voice {path.stem}: {e}")
+        print(f"[VOICES] Preloaded {len(self.voices)} of {len(paths)} voices ({self.size / 1024**2:.2f} MB)")
+
+    def _set_name(self, voice: Voice, name: str):
+        previous_id = self.names.get(name)
+        if previous_id in self.voices and previous_id != voice.id:
+            self.voices[previous_id].name = None
+        voice.name = name
+        self.names = {k: v for k, v in self.names.items() if v != voice.id}
+        self.names[name] = voice.id
+        self._save_names()
+
+    def _save_names(self):
+        if self.voice_dir is not None:
+            tmp_path = self._names_path().with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(self.names, indent=2))
+            os.replace(tmp_path, self._names_path())
+
+    def _add(self, voice: Voice) -> Voice:
+        if voice.id in self.voices:
+            self.size -= self.voices.pop(voice.id).nbytes
+        self.voices[voice.id] = voice
+        self.size += voice.nbytes
+
+        # Without a disk store evicted voices would be lost, so only evict when they can be reloaded
+        while self.voice_dir is not None and self.size > self.max_bytes and len(self.voices) > 1:
+            _, evicted = self.voices.popitem(last=False)
+            self.size -= evicted.nbytes
+        return voice
@@ -1,21 +1,56 @@
 import time
+import threading
 from chatterbox_tts.tts import ChatterboxTTS
+from chatterbox_tts.scheduler import BatchScheduler
+from chatterbox_tts.cache import SpeechCache
 import configuration
 
 # Global model variable
 model = None
 
+# Global batch scheduler, coalescing chunks from concurrent requests into a single vLLM batch
+scheduler = None
+
+# The T3 engine is not thread-safe, so every caller running inference must hold this lock
+inference_lock = threading.Lock()
+
 
 def load_model():
     """Startup event handler to load the ChatterboxTTS model"""
-    global model
+    global model, scheduler
     print("[SERVER] Loading ChatterboxTTS model... This may take a while the first time.")
     start_time = time.time()
     
     try:
+        cache = None
+        if configuration.CACHE_ENABLED:
+            cache = SpeechCache(
+                max_token_bytes=configuration.CACHE_MAX_TOKEN_BYTES,
+                max_wav_bytes=configuration.CACHE_MAX_WAV_BYTES,
+                disk_dir=configuration.CACHE_DIR,
+                max_disk_bytes=configuration.CACHE_MAX_DISK_BYTES,
+            )
+
         model = ChatterboxTTS.from_pretrained(
+            target_device=configuration.DEVICE,
+            t3_backend=configuration.T3_BACKEND,
+            t3_mock_tokens_per_second=configuration.T3_MOCK_TOKENS_PER_SECOND,
+            num_threads=configuration.CPU_THREADS,
+            s3gen_dtype=configuration.S3GEN_DTYPE,
             max_batch_size=configuration.BATCH_SIZE,
             max_model_len=configuration.MAX_CHUNK_SIZE * 3,
+            cache=cache,
+            voice_dir=configuration.VOICE_DIR,
+            max_voice_bytes=configuration.VOICE_CACHE_MAX_BYTES,
+            cfg_scale=configuration.CFG_SCALE,
+        )
+        model.voices.preload()
+        scheduler = BatchScheduler(
+            model,
+            max_batch_size=configuration.BATCH_SIZE,
+            max_batch_tokens=configuration.MAX_BATCH_TOKENS,
+            batch_window=configuration.BATCH_WINDOW,
+            lock=inference_lock,
         )
         load_time = time.time() - start_time
         print(f"[SERVER] Model loaded successfully in {load_time:.2f} seconds.")
@@ -27,6 +62,12 @@ def load_model():
 def shutdown_event():
     """Shutdown event handler to clean up the model"""
     global model
+    import job_manager
+    job_manager.shutdown()
+
+    if scheduler is not None:
+        scheduler.shutdown()
+
     if model is not None:
         try:
             model.shutdown()
@@ -39,3 +80,8 @@ def shutdown_event():
 def get_model():
     """Get the global model instance"""
     return model
+
+
+def get_scheduler():
+    """Get the global batch scheduler instance"""
+    return scheduler
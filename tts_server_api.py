@@ -1,15 +1,19 @@
 import io
 import os
+import shutil
+import tempfile
 import time
 import asyncio
 import threading
+from typing import Optional
 
 import torch
 import torchaudio as ta
-from fastapi import HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import File, Form, HTTPException, UploadFile
+from fastapi.responses import FileResponse, StreamingResponse
 import configuration
 import system_events
+import job_manager
 import utils
 import api.acast as acast
 import api.api as api
@@ -42,6 +46,7 @@ def process_queued_article(article_data):
         subtitle = article_data.get("subtitle", "")
         exaggeration = article_data.get("exaggeration", 0.5)
         min_p = article_data.get("min_p", 0.1)
+        voice = article_data.get("voice")
         
         if not text or not showId or not title:
             print(f"[QUEUE] Missing required fields in article data")
@@ -52,25 +57,23 @@ def process_queued_article(article_data):
         if model is None:
             print(f"[QUEUE] Model not loaded, cannot process article")
             return False
+
+        if voice is not None and voice not in model.voices:
+            print(f"[QUEUE] Unknown voice {voice}, cannot process article")
+            return False
         
         print(f"[QUEUE] Generating speech for article: {title}")
         start_time = time.time()
         
         # Split text into chunks using the same logic as speech endpoint
-        text_lines = "\n".join([line for line in text.split("\n") if not line.startswith("#")])
-        text_lines = [i.strip() for i in text_lines.split("\n") if len(i.strip()) > 0]
-        
-        text_chunks = []
-        for line in text_lines:
-            chunks = utils.split_text_by_sentence(line)
-            text_chunks.extend(chunks)
+        text_chunks = utils.split_text_into_chunks(text)
         
         print(f"[QUEUE] Text chunked into {len(text_chunks)} chunks")
         
         # Generate speech
-        audios = model.generate(
+        audios = system_events.get_scheduler().generate(
             text_chunks,
-            audio_prompt_path=configuration.AUDIO_PROMPT_PATH,
+            audio_prompt_path=voice or configuration.AUDIO_PROMPT_PATH,
             exaggeration=exaggeration,
             min_p=min_p,
         )
@@ -152,6 +155,51 @@ def start_polling_thread():
     print("[QUEUE] Started polling thread for queued articles")
 
 
+def stream_speech(model, text_chunks, voice, exaggeration, min_p, start_time):
+    """Generate speech chunk by chunk, yielding each chunk's MP3 frames as soon as it is ready.
+    The chunks are also appended to a file in the audio folder, so only one chunk is held in memory at a time."""
+    output_dir = utils.get_output_dir("audio")
+    filename = f"speech_{int(time.time())}.mp3"
+    autoPath = f"{output_dir}/{filename}"
+
+    # One encoder for the whole response, so the chunks join without gaps
+    mp3 = utils.MP3Stream(model.sr)
+    try:
+        with open(autoPath, "wb") as f:
+            for i, wav in enumerate(system_events.get_scheduler().generate_stream(
+                text_chunks,
+                audio_prompt_path=voice or configuration.AUDIO_PROMPT_PATH,
+                exaggeration=exaggeration,
+                min_p=min_p,
+            )):
+                if i == 0:
+                    print(f"[SPEECH] First chunk ready after {time.time() - start_time:.2f} seconds.")
+
+                data = mp3.write(wav)
+                f.write(data)
+                yield data
+
+            data = mp3.close()
+            f.write(data)
+            yield data
+    except Exception as e:
+        # Headers are already sent at this point, so the best we can do is log and end the stream
+        print(f"[SPEECH] Error while streaming audio: {e}")
+        return
+    finally:
+        mp3.close()
+
+    print(f"[SPEECH] Audio saved to: {autoPath}")
+    generation_time = time.time() - start_time
+    print(f"[SPEECH] Streamed audio from {len(text_chunks)} chunks in {generation_time:.2f} seconds.")
+
+
+def check_voice(model, voice):
+    """Requests may only use enrolled voices (by ID or name); None selects the default voice"""
+    if voice is not None and voice not in model.voices:
+        raise HTTPException(status_code=404, detail=f"Unknown voice: {voice}")
+
+
 def create_api_routes(app):
     """Create and register API routes for the FastAPI app"""
     
@@ -174,8 +222,9 @@ def create_api_routes(app):
             print(f"[API] Error getting queued article: {e}")
             raise HTTPException(status_code=500, detail=f"Failed to get queued article: {str(e)}")
 
+    # Declared as a plain def so FastAPI runs it in its threadpool instead of blocking the event loop
     @app.post("/speech")
-    async def speech(request: dict):
+    def speech(request: dict):
         model = system_events.get_model()
         if model is None:
             raise HTTPException(status_code=503, detail="Model not loaded yet")
@@ -187,6 +236,9 @@ def create_api_routes(app):
         showId = request.get("showId", "")
         title = request.get("title", "")
         subtitle = request.get("subtitle", "")
+        voice = request.get("voice")
+        # Send each chunk's audio as soon as it is generated instead of waiting for the whole text
+        stream = request.get("stream", False)
 
         if not text or not text.strip():
             raise HTTPException(status_code=400, detail="Input text cannot be empty")
@@ -197,29 +249,27 @@ def create_api_routes(app):
         if not title or not title.strip():
             raise HTTPException(status_code=400, detail="title cannot be empty")
 
+        check_voice(model, voice)
+
         print(f"[SPEECH] Processing text: {text[:100]}...")
         start_time = time.time()
 
         try:
             # Split text into chunks using the same logic as process_text_file
-            # Remove lines starting with # (like process_text_file does)
-            text_lines = "\n".join([line for line in text.split("\n") if not line.startswith("#")])
-            
-            # Chunk text by newlines
-            text_lines = [i.strip() for i in text_lines.split("\n") if len(i.strip()) > 0]
-
-            # Split text into chunks
-            text_chunks = []
-            for line in text_lines:
-                chunks = utils.split_text_by_sentence(line)
-                text_chunks.extend(chunks)
+            text_chunks = utils.split_text_into_chunks(text)
             
             print(f"[SPEECH] Text chunked into {len(text_chunks)} chunks")
+
+            if stream:
+                return StreamingResponse(
+                    stream_speech(model, text_chunks, voice, exaggeration, min_p, start_time),
+                    media_type="audio/mpeg",
+                )
             
             # Generate speech
-            audios = model.generate(
+            audios = system_events.get_scheduler().generate(
                 text_chunks,
-                audio_prompt_path=configuration.AUDIO_PROMPT_PATH,
+                audio_prompt_path=voice or configuration.AUDIO_PROMPT_PATH,
                 exaggeration=exaggeration,
                 min_p=min_p,
             )
@@ -255,6 +305,113 @@ def create_api_routes(app):
             print(f"[SPEECH] Generated audio from {len(text_chunks)} chunks in {generation_time:.2f} seconds.")
             return StreamingResponse(buf, media_type="audio/mpeg")
         
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"[SPEECH] Error processing text: {e}")
             raise HTTPException(status_code=500, detail=f"Failed to process text: {str(e)}")
+
+    @app.post("/voices")
+    def enroll_voice(file: UploadFile = File(...), name: Optional[str] = Form(None)):
+        """Enroll a reference audio clip as a voice; enrolling the same audio again returns the existing voice"""
+        model = system_events.get_model()
+        if model is None:
+            raise HTTPException(status_code=503, detail="Model not loaded yet")
+
+        suffix = os.path.splitext(file.filename or "")[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+            shutil.copyfileobj(file.file, f)
+            f.flush()
+            try:
+                voice = model.voices.enroll(f.name, name=name)
+            except Exception as e:
+                print(f"[VOICES] Error enrolling voice: {e}")
+                raise HTTPException(status_code=400, detail=f"Failed to enroll voice: {str(e)}")
+
+        return {"voice_id": voice.id, "name": voice.name}
+
+    @app.post("/voices/batch")
+    def enroll_voices(files: list[UploadFile] = File(...)):
+        """Enroll many reference clips at once; they run through the enrollment models as a batch"""
+        model = system_events.get_model()
+        if model is None:
+            raise HTTPException(status_code=503, detail="Model not loaded yet")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for i, file in enumerate(files):
+                path = os.path.join(tmp_dir, f"{i}{os.path.splitext(file.filename or '')[1]}")
+                with open(path, "wb") as f:
+                    shutil.copyfileobj(file.file, f)
+                paths.append(path)
+
+            try:
+                voices = model.voices.enroll_batch(paths)
+            except Exception as e:
+                print(f"[VOICES] Error enrolling voices: {e}")
+                raise HTTPException(status_code=400, detail=f"Failed to enroll voices: {str(e)}")
+
+        return {"voices": [{"voice_id": voice.id, "name": voice.name} for voice in voices]}
+
+    @app.get("/voices")
+    def list_voices():
+        model = system_events.get_model()
+        if model is None:
+            raise HTTPException(status_code=503, detail="Model not loaded yet")
+        return {"voices": model.voices.list_voices()}
+
+    @app.delete("/voices/{voice}")
+    def delete_voice(voice: str):
+        model = system_events.get_model()
+        if model is None:
+            raise HTTPException(status_code=503, detail="Model not loaded yet")
+        if not model.voices.remove(voice):
+            raise HTTPException(status_code=404, detail=f"Unknown voice: {voice}")
+        return {"status": "ok"}
+
+    @app.post("/jobs", status_code=202)
+    def create_job(request: dict):
+        """Queue a speech generation job and return its ID immediately"""
+        if system_events.get_model() is None:
+            raise HTTPException(status_code=503, detail="Model not loaded yet")
+
+        text = request.get("content", "")
+        voice = request.get("voice")
+        exaggeration = request.get("exaggeration", 0.5)
+        min_p = request.get("min_p", 0.1)
+
+        if not text or not text.strip():
+            raise HTTPException(status_code=400, detail="Input text cannot be empty")
+
+        check_voice(system_events.get_model(), voice)
+
+        text_chunks = utils.split_text_into_chunks(text)
+        if len(text_chunks) == 0:
+            raise HTTPException(status_code=400, detail="Input text cannot be empty")
+
+        try:
+            job = job_manager.get_job_manager().submit(text_chunks, voice=voice, exaggeration=exaggeration, min_p=min_p)
+        except job_manager.QueueFullError as e:
+            raise HTTPException(status_code=429, detail=str(e))
+
+        return job.to_dict()
+
+    @app.get("/jobs/{job_id}")
+    def get_job(job_id: str):
+        """Report the status and per-chunk progress of a job"""
+        job = job_manager.get_job_manager().get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return job.to_dict()
+
+    @app.get("/jobs/{job_id}/audio")
+    def get_job_audio(job_id: str):
+        """Download the generated audio of a finished job"""
+        job = job_manager.get_job_manager().get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        if job.status == "failed":
+            raise HTTPException(status_code=500, detail=f"Job failed: {job.error}")
+        if job.status != "finished":
+            raise HTTPException(status_code=409, detail=f"Job is not finished yet ({job.status})")
+        return FileResponse(job.audio_path, media_type="audio/mpeg", filename=f"{job.id}.mp3")
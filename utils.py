@@ -1,5 +1,9 @@
+import os
 import re
 from typing import List
+
+import torch
+from torchaudio.io import StreamWriter
 from configuration import MAX_CHUNK_SIZE
 
 def split_text_by_sentence(text: str) -> List[str]:
@@ -34,21 +38,75 @@ def split_text_by_sentence(text: str) -> List[str]:
     return chunks
 
 
-def process_text_file(file_path: str) -> List[str]:
-    """Process a text file like benchmark.py does"""
-    with open(file_path, "r") as f:
-        text = f.read()
-    
+def split_text_into_chunks(text: str) -> List[str]:
+    """Split a full text (e.g. an article) into generation chunks, skipping lines starting with #"""
     # Remove lines starting with #
     text = "\n".join([line for line in text.split("\n") if not line.startswith("#")])
 
     # Chunk text by newlines
-    text = [i.strip() for i in text.split("\n") if len(i.strip()) > 0]
+    text_lines = [i.strip() for i in text.split("\n") if len(i.strip()) > 0]
 
     # Split text into chunks
-    text = [split_text_by_sentence(line) for line in text]
+    text_chunks = []
+    for line in text_lines:
+        text_chunks.extend(split_text_by_sentence(line))
+
+    return text_chunks
+
+
+def process_text_file(file_path: str) -> List[str]:
+    """Process a text file like benchmark.py does"""
+    with open(file_path, "r") as f:
+        text = f.read()
+
+    return split_text_into_chunks(text)
+
+
+def get_output_dir(output_dir: str = "audio") -> str:
+    """Create the audio output directory, falling back to the current directory if it is not writable"""
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        return output_dir
+    except PermissionError:
+        print(f"[SPEECH] Warning: Could not create {output_dir} directory, using current directory")
+        return "."
+
+
+class MP3Stream:
+    """Encode a sequence of waveform chunks as one continuous MP3 stream.
+    Encoding each chunk on its own would give every chunk its own header, encoder delay and end padding, heard as a
+    gap or click at each boundary. Here a single encoder runs for the whole stream: `write` returns the MP3 bytes
+    encoded so far, and `close` flushes the frame or so the encoder holds back."""
+
+    def __init__(self, sr: int):
+        # Write-only sink: without `seek`, the muxer treats the output as a stream and never rewrites earlier bytes
+        self.sink = _ByteSink()
+        self.writer = StreamWriter(self.sink, format="mp3", buffer_size=1024)
+        self.writer.add_audio_stream(sample_rate=sr, num_channels=1)
+        self.writer.open()
+        self.closed = False
+
+    def write(self, wav: torch.Tensor) -> bytes:
+        # [1, T] waveform in, [T, 1] frames to the encoder
+        self.writer.write_audio_chunk(0, wav.detach().cpu().float().reshape(-1, 1))
+        return self.sink.take()
+
+    def close(self) -> bytes:
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+        return self.sink.take()
+
+
+class _ByteSink:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self.data += data
+        return len(data)
 
-    # Flatten list
-    text = [item for sublist in text for item in sublist]
-    
-    return text
+    def take(self) -> bytes:
+        data = bytes(self.data)
+        self.data.clear()
+        return data